@@ -1,7 +1,12 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from django.utils.translation import gettext_lazy as _
 
-from .models import Agent, AgentSkill, AgentSkillAssignment, AgentInteraction
+from .models import Agent, AgentSkill, AgentSkillAssignment, AgentInteraction, AgentListeningRule, ResponseDeadLetter, ConversationSummary
+from .rule_profiler import rule_profiler, SORT_FIELDS
+from .async_processor import message_processor
 
 @admin.register(Agent)
 class AgentAdmin(admin.ModelAdmin):
@@ -45,3 +50,77 @@ class AgentInteractionAdmin(admin.ModelAdmin):
     list_filter = ('interaction_type', 'timestamp')
     search_fields = ('initiator__name', 'receiver__name')
     readonly_fields = ('timestamp',)
+
+
+@admin.register(AgentListeningRule)
+class AgentListeningRuleAdmin(admin.ModelAdmin):
+    """代理监听规则管理界面，附带规则性能分析报告"""
+    list_display = ('name', 'agent', 'trigger_type', 'priority', 'is_active', 'trigger_count', 'last_triggered')
+    list_filter = ('trigger_type', 'response_type', 'is_active')
+    search_fields = ('name', 'description', 'agent__name')
+    readonly_fields = ('trigger_count', 'last_triggered', 'created_at', 'updated_at')
+    
+    def get_urls(self):
+        """添加性能分析报告页面"""
+        urls = [
+            path(
+                'profile/',
+                self.admin_site.admin_view(self.profile_view),
+                name='agents_agentlisteningrule_profile'
+            ),
+        ]
+        return urls + super().get_urls()
+    
+    def profile_view(self, request):
+        """规则性能分析报告页面"""
+        if request.method == 'POST':
+            action = request.POST.get('action')
+            if action == 'enable':
+                rule_profiler.enable()
+            elif action == 'disable':
+                rule_profiler.disable()
+            elif action == 'reset':
+                rule_profiler.reset()
+            return redirect(request.get_full_path())
+        
+        sort_by = request.GET.get('sort', 'total_ms')
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': _('规则性能分析'),
+            'report': rule_profiler.report(sort_by=sort_by, limit=100),
+            'sort_fields': SORT_FIELDS,
+        }
+        return TemplateResponse(request, 'admin/agents/agentlisteningrule/profile.html', context)
+
+
+@admin.register(ConversationSummary)
+class ConversationSummaryAdmin(admin.ModelAdmin):
+    """群组对话摘要管理界面"""
+    list_display = ('group', 'message_count', 'updated_at')
+    search_fields = ('group__name', 'summary')
+    readonly_fields = ('group', 'summary', 'state', 'last_group_message_id', 'last_message_at', 'last_message_id', 'message_count', 'updated_at')
+
+
+@admin.register(ResponseDeadLetter)
+class ResponseDeadLetterAdmin(admin.ModelAdmin):
+    """响应死信管理界面，可重新发送选中的死信"""
+    list_display = ('response_type', 'stage', 'attempts', 'last_error', 'created_at', 'replayed_at')
+    list_filter = ('stage', 'response_type', 'created_at', 'replayed_at')
+    search_fields = ('response_type', 'last_error')
+    readonly_fields = ('stage', 'response_type', 'response', 'context', 'attempts', 'last_error', 'created_at', 'replayed_at')
+    actions = ['replay']
+    
+    def has_add_permission(self, request):
+        """死信只由消息处理器写入"""
+        return False
+    
+    @admin.action(description=_('重新发送选中的死信'))
+    def replay(self, request, queryset):
+        """重新发送选中的死信"""
+        replayed = sum(message_processor.replay_dead_letter(dead_letter) for dead_letter in queryset)
+        failed = queryset.count() - replayed
+        if failed:
+            self.message_user(request, _('重新发送成功 {} 条，失败 {} 条').format(replayed, failed), messages.WARNING)
+        else:
+            self.message_user(request, _('重新发送成功 {} 条').format(replayed), messages.SUCCESS)
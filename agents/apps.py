@@ -1,7 +1,31 @@
+import os
+import sys
+
 from django.apps import AppConfig
 from django.utils.translation import gettext_lazy as _
 
 
+# ASGI入口在 django.setup() 之前设置该环境变量，声明当前进程处理实际请求
+SERVING_PROCESS_ENV = 'AGENTS_SERVING_PROCESS'
+
+
+def is_serving_process():
+    """
+    当前进程是否处理实际请求
+
+    只有显式声明的服务进程返回True：通过 chatbot_platform.asgi 启动的 Daphne 等 ASGI
+    服务进程（设置了 AGENTS_SERVING_PROCESS=1），以及 runserver 的子进程（或 --noreload）。
+    manage.py 的其他命令（migrate、shell、replay_rules 等）、runserver 自动重载的父进程、
+    调用 django.setup() 的脚本和 celery 等进程不启动异步处理器，也不接管持久化日志中的消息
+    """
+    if os.environ.get(SERVING_PROCESS_ENV) == '1':
+        return True
+    program = os.path.basename(sys.argv[0]) if sys.argv else ''
+    if program not in ('manage.py', 'django-admin') or len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+
+
 class AgentsConfig(AppConfig):
     """代理应用配置类"""
     
@@ -24,7 +48,31 @@ class AgentsConfig(AppConfig):
         from agents.handlers import register_handlers
         
         # 在非测试模式下启动异步处理器并注册处理函数
-        import sys
-        if 'test' not in sys.argv and 'pytest' not in sys.argv:
-            init_async_processor()
+        # （python -m pytest 启动时argv中没有pytest，需检查已加载的模块；
+        # 规则匹配进程池的工作进程也不启动后台线程）
+        from agents.rule_pool import POOL_WORKER_ENV, rule_pool
+        if (
+            'test' not in sys.argv and 'pytest' not in sys.argv and 'pytest' not in sys.modules
+            and not os.environ.get(POOL_WORKER_ENV)
+        ):
+            # 只有服务进程启动处理器并重放持久化日志
+            if is_serving_process():
+                init_async_processor()
             register_handlers()
+            
+            # 启动规则触发统计的后台写回线程
+            from agents.rule_stats import rule_stats
+            rule_stats.start()
+            
+            # 启动规则任务的批量写入线程
+            from agents.task_writer import task_writer
+            task_writer.start()
+            
+            # 打开知识索引，之后由信号增量维护
+            from agents.knowledge_index import knowledge_index
+            if knowledge_index is not None:
+                knowledge_index.open()
+            
+            # 开启进程池模式时预先启动并预热工作进程
+            if rule_pool.enabled:
+                rule_pool.start()
@@ -1,150 +1,1124 @@
 import asyncio
+import atexit
+import itertools
 import logging
 import json
+import queue
+import random
 import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import Future
 from typing import Dict, List, Any, Optional, Callable
+from django.conf import settings
+from django.db import close_old_connections
 from django.utils import timezone
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
+from .metrics import LatencyHistogram
+from .models import ResponseDeadLetter
+from .processor_journal import ProcessorJournal, json_safe
 from .services import RuleEngine
 
 logger = logging.getLogger(__name__)
 
+# 默认的工作线程数量
+DEFAULT_WORKERS = 4
+
+# 默认的队列容量
+DEFAULT_QUEUE_SIZE = 1000
+
+# 队列已满时入队的默认等待时间（秒），超时后丢弃消息
+DEFAULT_ENQUEUE_TIMEOUT = 0.5
+
+# 合并评估时一组消息的最大数量
+DEFAULT_COALESCE_MAX = 50
+
+# 处理函数出错时 _build_message 的返回值
+_FAILED = object()
+
+# 响应发送失败时的默认重试次数（含第一次发送）和退避时间（秒）
+DEFAULT_RETRY_ATTEMPTS = 5
+DEFAULT_RETRY_BASE_DELAY = 0.5
+DEFAULT_RETRY_MAX_DELAY = 30.0
+
+# 优先级通道：直接消息和提及、普通群组消息、批量或后台回放
+LANE_MENTION = 'mention'
+LANE_GROUP = 'group'
+LANE_BULK = 'bulk'
+
+# 各通道的默认调度权重
+DEFAULT_LANE_WEIGHTS = {
+    LANE_MENTION: 8,
+    LANE_GROUP: 3,
+    LANE_BULK: 1,
+}
+
+
+class PriorityLaneQueue:
+    """
+    带优先级通道的线程安全有界队列
+    
+    每个通道是一个独立的有界FIFO，取出时按平滑加权轮询在非空通道之间调度：
+    权重高的通道优先且获得更多的处理机会，权重低的通道也按比例得到处理，不会饿死。
+    
+    放入时可以指定分区键（如群组）：同一分区键的元素严格按放入顺序取出。
+    轮询选中的元素如果还有同一分区键更早的元素在其他通道中排队，先取出更早的那个。
+    """
+    
+    def __init__(self, weights=None, maxsize=DEFAULT_QUEUE_SIZE):
+        """
+        参数:
+        - weights: 通道名到调度权重的字典
+        - maxsize: 每个通道的容量
+        """
+        self.weights = dict(weights or DEFAULT_LANE_WEIGHTS)
+        self.maxsize = maxsize
+        # 通道中的条目为 [通道, 分区键, 元素, 是否已取出]，提前取出的条目在到达队首时清理
+        self._lanes = {lane: deque() for lane in self.weights}
+        self._sizes = {lane: 0 for lane in self.weights}
+        self._current = {lane: 0 for lane in self.weights}
+        self._keys = {}
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+    
+    def put(self, item, lane=LANE_GROUP, timeout=None, key=None):
+        """
+        放入一个元素
+        
+        参数:
+        - item: 元素
+        - lane: 通道名
+        - timeout: 通道已满时的等待时间（秒），0表示不等待，None表示一直等待
+        - key: 分区键，同一分区键的元素按放入顺序取出
+        
+        异常:
+        - queue.Full: 等待超时后通道仍然已满
+        """
+        with self._not_full:
+            if timeout is not None and timeout <= 0:
+                if self._sizes[lane] >= self.maxsize:
+                    raise queue.Full
+            else:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._sizes[lane] >= self.maxsize:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Full
+                    self._not_full.wait(remaining)
+            
+            entry = [lane, key, item, False]
+            self._lanes[lane].append(entry)
+            self._sizes[lane] += 1
+            if key is not None:
+                self._keys.setdefault(key, deque()).append(entry)
+            self._not_empty.notify()
+    
+    def get(self, timeout=None):
+        """
+        按加权轮询取出一个元素
+        
+        参数:
+        - timeout: 所有通道都为空时的等待时间（秒），None表示一直等待
+        
+        返回:
+        - (通道名, 元素)
+        
+        异常:
+        - queue.Empty: 等待超时后所有通道仍为空
+        """
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not any(self._sizes.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+            
+            entry = self._head(self._select_lane())
+            key = entry[1]
+            if key is not None:
+                # 同一分区键更早的元素优先，保证分区内的顺序
+                pending = self._keys[key]
+                entry = pending.popleft()
+                if not pending:
+                    del self._keys[key]
+            self._take(entry)
+            self._not_full.notify_all()
+            return entry[0], entry[2]
+    
+    def _head(self, lane):
+        """通道中第一个未取出的条目（调用方需持有锁且通道非空）"""
+        items = self._lanes[lane]
+        while items[0][3]:
+            items.popleft()
+        return items[0]
+    
+    def _take(self, entry):
+        """标记条目已取出"""
+        lane = entry[0]
+        entry[3] = True
+        self._sizes[lane] -= 1
+        items = self._lanes[lane]
+        while items and items[0][3]:
+            items.popleft()
+        if not self._sizes[lane]:
+            # 通道清空后不保留累积的调度额度
+            self._current[lane] = 0
+    
+    def _select_lane(self):
+        """平滑加权轮询：非空通道累加权重，选出额度最高的通道并扣除总权重"""
+        total = 0
+        selected = None
+        for lane, size in self._sizes.items():
+            if not size:
+                continue
+            self._current[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if selected is None or self._current[lane] > self._current[selected]:
+                selected = lane
+        self._current[selected] -= total
+        return selected
+    
+    def get_key(self, key, timeout=None):
+        """
+        取出指定分区键最早的元素
+        
+        参数:
+        - key: 分区键
+        - timeout: 没有该分区键的元素时的等待时间（秒），None表示一直等待
+        
+        返回:
+        - (通道名, 元素)
+        
+        异常:
+        - queue.Empty: 等待超时后仍没有该分区键的元素
+        """
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while key not in self._keys:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+            
+            pending = self._keys[key]
+            entry = pending.popleft()
+            if not pending:
+                del self._keys[key]
+            self._take(entry)
+            self._not_full.notify_all()
+            return entry[0], entry[2]
+    
+    def peek(self, lane):
+        """
+        查看通道中最早入队的元素（不取出）
+        
+        参数:
+        - lane: 通道名
+        
+        返回:
+        - 元素，通道为空时返回None
+        """
+        with self._mutex:
+            return self._head(lane)[2] if self._sizes[lane] else None
+    
+    def qsize(self, lane=None):
+        """
+        获取队列长度
+        
+        参数:
+        - lane: 通道名，为None时返回所有通道的总长度
+        """
+        with self._mutex:
+            if lane is not None:
+                return self._sizes[lane]
+            return sum(self._sizes.values())
+    
+    def key_sizes(self):
+        """
+        获取各分区键排队中的元素数量
+        
+        返回:
+        - 分区键到元素数量的字典
+        """
+        with self._mutex:
+            return {key: len(entries) for key, entries in self._keys.items()}
+
+
+class ProcessorMetrics:
+    """
+    异步消息处理器的运行指标
+    
+    - wait: 按通道统计的排队耗时（入队到工作线程取出）
+    - lag: 按通道统计的处理延迟（入队到规则执行完成）
+    - rules: 规则引擎处理单条消息的耗时
+    - send: 按响应类型统计的发送耗时（channel layer 和注册的处理函数）、次数和失败次数
+    """
+    
+    def __init__(self, lanes):
+        """
+        参数:
+        - lanes: 通道名列表
+        """
+        self._lanes = list(lanes)
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """清空所有指标"""
+        with self._lock:
+            self.wait = {lane: LatencyHistogram() for lane in self._lanes}
+            self.lag = {lane: LatencyHistogram() for lane in self._lanes}
+            self.rules = LatencyHistogram()
+            self.send = {}
+            self.send_errors = {}
+    
+    def observe_wait(self, lane, elapsed):
+        """记录一条消息的排队耗时（秒）"""
+        self.wait[lane].observe(elapsed)
+    
+    def observe_lag(self, lane, elapsed):
+        """记录一条消息从入队到规则执行完成的耗时（秒）"""
+        if lane in self.lag:
+            self.lag[lane].observe(elapsed)
+    
+    def observe_rules(self, elapsed):
+        """记录规则引擎处理一条消息的耗时（秒）"""
+        self.rules.observe(elapsed)
+    
+    def observe_send(self, response_type, elapsed, failed=False):
+        """
+        记录一次响应发送
+        
+        参数:
+        - response_type: 响应类型
+        - elapsed: 耗时（秒）
+        - failed: 是否发送失败
+        """
+        response_type = response_type or 'unknown'
+        with self._lock:
+            histogram = self.send.get(response_type)
+            if histogram is None:
+                histogram = self.send[response_type] = LatencyHistogram()
+                self.send_errors[response_type] = 0
+            if failed:
+                self.send_errors[response_type] += 1
+        histogram.observe(elapsed)
+    
+    def snapshot(self):
+        """
+        导出指标摘要
+        
+        返回:
+        - 包含各通道排队耗时和处理延迟、规则耗时、各响应类型发送耗时和失败率的字典
+        """
+        with self._lock:
+            send = dict(self.send)
+            send_errors = dict(self.send_errors)
+        
+        responses = {}
+        for response_type, histogram in send.items():
+            summary = histogram.snapshot()
+            summary['errors'] = send_errors[response_type]
+            summary['error_rate'] = round(send_errors[response_type] / summary['count'], 4) if summary['count'] else 0.0
+            responses[response_type] = summary
+        
+        return {
+            'wait': {lane: histogram.snapshot() for lane, histogram in self.wait.items()},
+            'lag': {lane: histogram.snapshot() for lane, histogram in self.lag.items()},
+            'rules': self.rules.snapshot(),
+            'responses': responses,
+        }
+
+
+class QueuedMessage:
+    """处理队列中的一条消息"""
+    
+    __slots__ = ('message', 'context', 'callback', 'journal_key', 'enqueued_at', 'future')
+    
+    def __init__(self, message, context, callback=None, journal_key=None):
+        """
+        参数:
+        - message: 消息内容
+        - context: 上下文信息
+        - callback: 处理完成后的回调函数
+        - journal_key: 消息在持久化日志中的ID
+        """
+        self.message = message
+        self.context = context
+        self.callback = callback
+        self.journal_key = journal_key
+        self.enqueued_at = time.monotonic()
+        self.future = Future()
+
+
+def partition_key(message, context=None):
+    """
+    获取消息的分区键，同一分区键的消息按顺序处理
+    
+    参数:
+    - message: 消息内容
+    - context: 上下文信息
+    
+    返回:
+    - 群组消息为 group:<群组ID>，私聊消息为 direct:<会话双方ID>，无法判断时返回None
+    """
+    context = context or {}
+    message = message if isinstance(message, dict) else {}
+    group_id = message.get('group_id') or context.get('group_id')
+    if group_id:
+        return f'group:{group_id}'
+    
+    conversation_id = message.get('conversation_id') or context.get('conversation_id')
+    if conversation_id:
+        return f'direct:{conversation_id}'
+    participants = [
+        str(participant) for participant in (
+            message.get('sender') or context.get('sender'),
+            message.get('recipient') or context.get('recipient'),
+        )
+        if participant
+    ]
+    if participants:
+        return 'direct:' + ':'.join(sorted(participants))
+    return None
+
+
+def classify_lane(message, context=None):
+    """
+    判断消息应进入的优先级通道
+    
+    参数:
+    - message: 消息内容
+    - context: 上下文信息，可通过 lane 字段显式指定通道
+    
+    返回:
+    - 通道名
+    """
+    context = context or {}
+    if context.get('lane') in DEFAULT_LANE_WEIGHTS:
+        return context['lane']
+    if isinstance(message, dict):
+        content = message.get('content')
+        group_id = message.get('group_id') or context.get('group_id')
+        if not group_id or message.get('mentions') or (isinstance(content, str) and '@' in content):
+            return LANE_MENTION
+    return LANE_GROUP
+
+
 class AsyncMessageProcessor:
     """
     异步消息处理器
     
-    负责异步处理消息并发送代理响应
+    负责异步处理消息并发送代理响应。
+    
+    消息按分区键（群组或私聊会话，见 partition_key）哈希到N个分片，每个分片由一个
+    工作线程处理：同一群组的消息始终由同一个工作线程按顺序处理（冷却、上下文窗口、
+    独占规则依赖这一顺序），不同群组的消息并行处理，不需要全局锁。
+    每个分片是一个带优先级通道的有界队列（见 PriorityLaneQueue）：直接消息和提及
+    优先，其次是普通群组消息，最后是批量或后台回放，各通道按权重公平调度。
+    规则引擎在工作线程中同步执行，单条规则耗时过长只会阻塞它所在的分片；
+    响应的发送（channel layer、注册的处理函数）是异步的，统一提交到一个专用事件循环线程执行。
+    通道已满时入队最多等待 enqueue_timeout 秒（对调用方形成背压），超时则丢弃该消息。
+    配置了 ProcessorJournal 时，消息入队前先写入本地日志，处理器重启后重放未完成的消息。
+    开启合并窗口时，工作线程取出一条群组消息后在窗口内继续收集同一群组的消息，
+    上下文感知和所有消息规则对这组消息只评估一次。
     """
     
-    def __init__(self):
-        """初始化消息处理器"""
-        self.queue = asyncio.Queue()
+    def __init__(self, workers=None, queue_size=None, enqueue_timeout=None, lane_weights=None,
+                 journal=None, coalesce_window_ms=None):
+        """
+        初始化消息处理器
+        
+        参数:
+        - workers: 工作线程（分片）数量，默认读取 RULE_ENGINE_CONFIG['PROCESSOR_WORKERS']
+        - queue_size: 每个分片每个通道的容量，默认读取 RULE_ENGINE_CONFIG['PROCESSOR_QUEUE_SIZE']
+        - enqueue_timeout: 通道已满时入队的等待时间（秒），0表示不等待，
+          默认读取 RULE_ENGINE_CONFIG['PROCESSOR_ENQUEUE_TIMEOUT']
+        - lane_weights: 各通道的调度权重，默认读取 RULE_ENGINE_CONFIG['PROCESSOR_LANE_WEIGHTS']
+        - journal: 持久化日志（ProcessorJournal），为None时队列只保存在内存中
+        - coalesce_window_ms: 同一群组突发消息的合并窗口（毫秒），0表示不合并，
+          默认读取 RULE_ENGINE_CONFIG['PROCESSOR_COALESCE_WINDOW_MS']
+        """
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        self.worker_count = workers or config.get('PROCESSOR_WORKERS', DEFAULT_WORKERS)
+        self.enqueue_timeout = (
+            enqueue_timeout if enqueue_timeout is not None
+            else config.get('PROCESSOR_ENQUEUE_TIMEOUT', DEFAULT_ENQUEUE_TIMEOUT)
+        )
+        self.lane_weights = dict(lane_weights or config.get('PROCESSOR_LANE_WEIGHTS', DEFAULT_LANE_WEIGHTS))
+        self.queue_size = queue_size or config.get('PROCESSOR_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        self.shards = [
+            PriorityLaneQueue(weights=self.lane_weights, maxsize=self.queue_size)
+            for _ in range(self.worker_count)
+        ]
+        self._unkeyed = itertools.count()
+        self.journal = journal
         self.channel_layer = get_channel_layer()
         self.running = False
-        self.worker_thread = None
+        self._exit_registered = False
+        self.workers = []
+        self.loop = None
+        self.loop_thread = None
         self.handlers = {}  # 注册的处理函数
+        self._state_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.processed_count = 0
+        self.dropped_count = 0
+        self.error_count = 0
+        self.coalesce_window = (
+            coalesce_window_ms if coalesce_window_ms is not None
+            else config.get('PROCESSOR_COALESCE_WINDOW_MS', 0)
+        ) / 1000
+        self.coalesce_max = config.get('PROCESSOR_COALESCE_MAX', DEFAULT_COALESCE_MAX)
+        self.coalesced_count = 0
+        self.retry_attempts = config.get('RESPONSE_RETRY_ATTEMPTS', DEFAULT_RETRY_ATTEMPTS)
+        self.retry_base_delay = config.get('RESPONSE_RETRY_BASE_DELAY', DEFAULT_RETRY_BASE_DELAY)
+        self.retry_max_delay = config.get('RESPONSE_RETRY_MAX_DELAY', DEFAULT_RETRY_MAX_DELAY)
+        self._pending_retries = {}
+        self.retry_count = 0
+        self.dead_letter_count = 0
+        self.lane_dropped = {lane: 0 for lane in self.lane_weights}
+        self.shard_processed = [0] * self.worker_count
+        self.metrics = ProcessorMetrics(self.lane_weights)
+    
+    @property
+    def worker_thread(self):
+        """第一个工作线程（兼容只有一个工作线程时的接口）"""
+        return self.workers[0] if self.workers else None
         
-    def start(self):
-        """启动消息处理器"""
-        if self.running:
-            logger.warning("消息处理器已经在运行")
-            return
+    def start(self, recover=True):
+        """
+        启动消息处理器
+        
+        参数:
+        - recover: 开启日志时是否接管并重放未完成的消息；只有服务进程（apps.ready）
+          显式启动时重放，入队时自动启动（如管理命令、shell中）不重放。
+          重放的进程之后继续接管租约过期的其他进程留下的消息
+        
+        进程退出时自动停止处理器，日志中的持有者随之注销，剩余的消息可立即由其他进程接管
+        """
+        with self._state_lock:
+            if self.running:
+                logger.warning("消息处理器已经在运行")
+                return
+                
+            self.running = True
+            
+            # 发送响应使用的事件循环
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(
+                target=self._run_loop, name='message-processor-loop', daemon=True
+            )
+            self.loop_thread.start()
             
-        self.running = True
-        self.worker_thread = threading.Thread(target=self._run_worker)
-        self.worker_thread.daemon = True
-        self.worker_thread.start()
-        logger.info("异步消息处理器已启动")
+            self.workers = []
+            for index in range(self.worker_count):
+                worker = threading.Thread(
+                    target=self._run_worker, args=(index,), name=f'message-processor-{index}', daemon=True
+                )
+                worker.start()
+                self.workers.append(worker)
+                
+            if not self._exit_registered:
+                atexit.register(self.stop)
+                self._exit_registered = True
+                
+            recovered = []
+            if self.journal is not None:
+                self.journal.open()
+                if recover:
+                    recovered = self.journal.recover(handler=self._replay_later)
+        logger.info(f"异步消息处理器已启动，工作线程 {self.worker_count} 个，每个分片的通道容量 {self.queue_size}")
+        
+        # 重放上次退出时尚未完成的消息（工作线程已在运行，通道满时等待其消化）
+        self._replay(recovered)
+        
+    def _replay(self, recovered):
+        """
+        把从日志接管的消息放回队列
+        
+        参数:
+        - recovered: (消息ID, 通道, 消息, 上下文) 列表
+        """
+        for message_id, lane, message, context in recovered:
+            key = partition_key(message, context)
+            self.shards[self._shard_index(key)].put(
+                QueuedMessage(message, context, journal_key=message_id), lane, key=key
+            )
+        if recovered:
+            logger.info(f"已从处理器日志重放 {len(recovered)} 条未完成的消息")
+            
+    def _replay_later(self, recovered):
+        """在单独的线程中重放日志写线程定期接管的消息，通道已满时不阻塞日志提交"""
+        threading.Thread(
+            target=self._replay, args=(recovered,), name='message-processor-replay', daemon=True
+        ).start()
         
     def stop(self):
-        """停止消息处理器"""
-        if not self.running:
-            return
+        """
+        停止消息处理器，工作线程处理完手上的消息后退出
+        
+        队列中剩余的消息不再处理，开启日志时会在下次启动后重放
+        """
+        with self._state_lock:
+            if not self.running:
+                return
+                
+            self.running = False
+            for worker in self.workers:
+                worker.join(timeout=5.0)
+            self.workers = []
             
-        self.running = False
-        if self.worker_thread:
-            self.worker_thread.join(timeout=5.0)
-            self.worker_thread = None
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop_thread.join(timeout=5.0)
+                self.loop.close()
+                self.loop = None
+                self.loop_thread = None
+                
+            # 尚未执行的重试直接写入死信，不随事件循环一起丢失
+            with self._stats_lock:
+                retries, self._pending_retries = list(self._pending_retries.values()), {}
+                self.dead_letter_count += len(retries)
+            for stage, response, context, attempt, error in retries:
+                self._store_dead_letter(stage, response, context, attempt, str(error))
+                
+            if self.journal is not None:
+                # 剩余的消息由下次启动时的重放处理，不在内存中保留
+                for shard in self.shards:
+                    while True:
+                        try:
+                            lane, item = shard.get(timeout=0)
+                        except queue.Empty:
+                            break
+                        item.future.cancel()
+                self.journal.close()
         logger.info("异步消息处理器已停止")
         
-    def _run_worker(self):
-        """运行工作线程"""
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
+    def _run_loop(self):
+        """运行发送响应的事件循环"""
+        asyncio.set_event_loop(self.loop)
         try:
-            loop.run_until_complete(self._process_queue())
+            self.loop.run_forever()
         except Exception as e:
-            logger.error(f"消息处理器异常: {str(e)}", exc_info=True)
-        finally:
-            loop.close()
+            logger.error(f"消息处理器事件循环异常: {str(e)}", exc_info=True)
             
-    async def _process_queue(self):
-        """处理消息队列"""
+    def _run_worker(self, index=0):
+        """
+        运行工作线程
+        
+        参数:
+        - index: 工作线程负责的分片序号
+        """
+        shard = self.shards[index]
         while self.running:
             try:
-                # 从队列获取消息，超时1秒
-                message, context, callback = await asyncio.wait_for(self.queue.get(), timeout=1.0)
+                # 按通道权重获取消息，超时后重新检查运行状态
+                lane, item = shard.get(timeout=0.5)
+            except queue.Empty:
+                continue
                 
-                try:
-                    # 处理消息
-                    responses = RuleEngine.process_message(message, context)
-                    
-                    # 如果有回调函数，调用它
-                    if callback:
-                        callback(responses)
-                        
-                    # 发送响应
-                    for response in responses:
-                        await self._send_response(response, context)
-                        
-                except Exception as e:
-                    logger.error(f"处理消息时出错: {str(e)}", exc_info=True)
-                    
-                finally:
-                    # 标记任务完成
-                    self.queue.task_done()
-                    
-            except asyncio.TimeoutError:
+            if not self._claim(lane, item):
                 continue
-            except Exception as e:
-                logger.error(f"消息队列处理异常: {str(e)}", exc_info=True)
+            burst = self._collect_burst(shard, lane, item)
+            if len(burst) > 1:
+                self._process_burst(burst)
+            else:
+                self._process(item, lane)
+            with self._stats_lock:
+                self.shard_processed[index] += len(burst)
                 
-    async def _send_response(self, response, context):
-        """发送响应"""
-        try:
-            # 如果上下文中有WebSocket组，则通过WebSocket发送响应
-            if 'group_id' in context:
-                group_id = str(context['group_id'])
+    def _claim(self, lane, item):
+        """
+        工作线程取出消息后开始处理前调用
+        
+        返回:
+        - 是否需要处理；调用方已取消的消息不再处理
+        """
+        self.metrics.observe_wait(lane, time.monotonic() - item.enqueued_at)
+        if item.future.set_running_or_notify_cancel():
+            return True
+        if item.journal_key is not None:
+            self.journal.complete(item.journal_key)
+        return False
                 
-                # 构建通知消息
-                message = {
-                    'type': 'agent.message',
-                    'message': response
-                }
+    def _process(self, item, lane=None, responses=None):
+        """
+        处理一条消息：执行规则引擎、完成future、调用回调并发送响应
+        
+        参数:
+        - item: 队列中的消息（QueuedMessage）
+        - lane: 消息所在的优先级通道
+        - responses: 已经合并评估得到的规则响应，提供时不再执行规则引擎
+        """
+        context = item.context
+        try:
+            if responses is None:
+                # 规则引擎在工作线程中同步执行，不占用事件循环
+                started_at = time.monotonic()
+                responses = RuleEngine.process_message(item.message, context)
+                self.metrics.observe_rules(time.monotonic() - started_at)
+            self.metrics.observe_lag(lane, time.monotonic() - item.enqueued_at)
+            
+            # 调用方通过future等待规则响应，不必等待响应发送完成
+            item.future.set_result(responses)
+            
+            # 如果有回调函数，调用它（协程函数的回调在处理器的事件循环中执行）
+            if item.callback:
+                result = item.callback(responses)
+                if asyncio.iscoroutine(result):
+                    asyncio.run_coroutine_threadsafe(result, self.loop).result()
                 
-                # 发送到群组
-                await self.channel_layer.group_send(
-                    f"group_{group_id}",
-                    message
+            # 发送响应
+            if responses:
+                future = asyncio.run_coroutine_threadsafe(
+                    self._send_responses(responses, context), self.loop
                 )
+                future.result()
                 
-                logger.debug(f"已发送代理响应到群组 {group_id}")
-                
-            # 调用注册的处理函数
-            handler_type = response.get('type', '')
-            if handler_type in self.handlers:
-                await self.handlers[handler_type](response, context)
+            with self._stats_lock:
+                self.processed_count += 1
                 
         except Exception as e:
-            logger.error(f"发送响应时出错: {str(e)}", exc_info=True)
+            if not item.future.done():
+                item.future.set_exception(e)
+            with self._stats_lock:
+                self.error_count += 1
+            logger.error(f"处理消息时出错: {str(e)}", exc_info=True)
             
-    def add_message(self, message: Dict, context: Dict = None, callback: Callable = None):
+        finally:
+            # 出错的消息同样标记完成，避免重启后反复重放
+            if item.journal_key is not None:
+                self.journal.complete(item.journal_key)
+            # 工作线程长期运行，释放过期的数据库连接
+            close_old_connections()
+            
+    def _collect_burst(self, shard, lane, item):
+        """
+        收集同一群组在合并窗口内到达的消息
+        
+        参数:
+        - shard: 工作线程负责的分片
+        - lane: 第一条消息所在的通道
+        - item: 第一条消息
+        
+        返回:
+        - [(通道, 消息)] 列表，第一条消息在最前
+        """
+        burst = [(lane, item)]
+        key = partition_key(item.message, item.context)
+        if self.coalesce_window <= 0 or key is None or not key.startswith('group:'):
+            return burst
+        
+        deadline = time.monotonic() + self.coalesce_window
+        while len(burst) < self.coalesce_max:
+            try:
+                lane, item = shard.get_key(key, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if self._claim(lane, item):
+                burst.append((lane, item))
+        return burst
+    
+    def _process_burst(self, burst):
+        """
+        合并评估同一群组的一组消息
+        
+        上下文感知和所有消息规则只对最后一条消息评估一次，提及、关键词等规则仍逐条评估
+        （见 RuleEngine.process_batch 的 coalesce 参数），之后逐条完成future、调用回调并发送响应
+        
+        参数:
+        - burst: [(通道, 消息)] 列表
+        """
+        results = None
+        try:
+            # 每条消息的上下文（消息ID等）并入消息本身，整批不共享上下文
+            messages = []
+            for lane, item in burst:
+                merged = dict(item.message) if isinstance(item.message, dict) else {'content': item.message}
+                merged.update({key: value for key, value in item.context.items() if key not in merged})
+                messages.append(merged)
+            
+            started_at = time.monotonic()
+            results = RuleEngine.process_batch(messages, coalesce=True)
+            self.metrics.observe_rules(time.monotonic() - started_at)
+            with self._stats_lock:
+                self.coalesced_count += len(burst) - 1
+        except Exception as e:
+            # 合并评估失败时逐条处理
+            logger.error(f"合并评估 {len(burst)} 条消息时出错，改为逐条处理: {str(e)}", exc_info=True)
+        
+        for position, (lane, item) in enumerate(burst):
+            self._process(item, lane, responses=results[position] if results is not None else None)
+            
+    async def _send_responses(self, responses, context):
+        """
+        发送一条消息产生的所有响应
+        
+        注册了处理函数的响应先由处理函数生成推送给客户端的消息（各处理函数并发执行），
+        没有处理函数的响应原样推送；所有消息合并为一个 agent.batch 事件发送到群组
+        （没有群组的会话消息发送到会话的频道组，见 _channel_group），每个客户端只收到一帧。
+        生成失败的响应交给重试（见 _schedule_retry），不影响其他响应；
+        上下文中没有可发送的频道组时直接写入死信
+        """
+        started_at = time.monotonic()
+        context = {**context, 'sent_at': timezone.now()}
+        messages = await asyncio.gather(*(self._build_message(response, context) for response in responses))
+        failed = {index for index, message in enumerate(messages) if message is _FAILED}
+        
+        batch = [message for message in messages if message is not None and message is not _FAILED]
+        if batch:
+            event = self._batch_event(batch, context)
+            if self._channel_group(context) is None:
+                failed.update(range(len(responses)))
+                self._dead_letter(ResponseDeadLetter.Stage.CHANNEL, event, context, 1,
+                                  ValueError("上下文中没有群组或会话频道组"))
+            else:
+                try:
+                    await self._deliver(ResponseDeadLetter.Stage.CHANNEL, event, context)
+                except Exception as e:
+                    failed.update(range(len(responses)))
+                    logger.error(f"发送响应到群组时出错: {str(e)}", exc_info=True)
+                    self._schedule_retry(ResponseDeadLetter.Stage.CHANNEL, event, context, 1, e)
+        
+        elapsed = time.monotonic() - started_at
+        for index, response in enumerate(responses):
+            self.metrics.observe_send(response.get('type', ''), elapsed, index in failed)
+    
+    async def _build_message(self, response, context):
+        """
+        生成一条响应推送给客户端的消息
+        
+        返回:
+        - 消息字典；处理函数不需要推送时返回None，处理函数出错时返回 _FAILED
+        """
+        handler = self.handlers.get(response.get('type', ''))
+        if handler is None:
+            return response
+        try:
+            return await handler(response, context)
+        except Exception as e:
+            logger.error(f"处理响应时出错（{response.get('type', '')}）: {str(e)}", exc_info=True)
+            self._schedule_retry(ResponseDeadLetter.Stage.HANDLER, response, context, 1, e)
+            return _FAILED
+    
+    @staticmethod
+    def _batch_event(messages, context):
+        """合并后的群组事件"""
+        return {
+            'type': 'agent.batch',
+            'message_id': context.get('message_id'),
+            'messages': messages,
+        }
+    
+    @staticmethod
+    def _channel_group(context):
+        """
+        响应发送到的频道组
+        
+        群组消息发送到 group_<群组ID>，没有群组的会话消息发送到上下文中的 room_group_name
+        
+        返回:
+        - 频道组名称；两者都没有时返回None
+        """
+        if context.get('group_id') is not None:
+            return f"group_{context['group_id']}"
+        return context.get('room_group_name') or None
+    
+    async def _deliver(self, stage, payload, context):
+        """
+        执行一个发送阶段，失败时抛出异常（重试和重放死信时调用）
+        
+        参数:
+        - stage: 发送阶段（ResponseDeadLetter.Stage）
+        - payload: CHANNEL阶段为 agent.batch 事件，HANDLER阶段为规则响应
+        - context: 上下文信息
+        """
+        if stage == ResponseDeadLetter.Stage.HANDLER:
+            # 重新调用处理函数，生成的消息单独推送
+            message = await self.handlers[payload.get('type', '')](payload, context)
+            if message is None:
+                return
+            payload = self._batch_event([message], context)
+        
+        channel_group = self._channel_group(context)
+        if channel_group is None:
+            raise ValueError("上下文中没有群组或会话频道组")
+        await self.channel_layer.group_send(channel_group, payload)
+        logger.debug(f"已发送 {len(payload['messages'])} 条代理响应到 {channel_group}")
+    
+    def _schedule_retry(self, stage, response, context, attempt, error):
+        """
+        安排失败的发送阶段重试（在事件循环中延时执行，不占用工作线程）
+        
+        第 attempt 次失败后等待 retry_base_delay * 2^(attempt-1) 秒（不超过 retry_max_delay，
+        并加入随机抖动），尝试 retry_attempts 次仍失败时写入死信
+        
+        参数:
+        - stage: 发送阶段
+        - response: 规则响应
+        - context: 上下文信息
+        - attempt: 已经尝试的次数
+        - error: 最后一次失败的异常
+        """
+        if attempt >= self.retry_attempts:
+            self._dead_letter(stage, response, context, attempt, error)
+            return
+        
+        delay = min(self.retry_base_delay * (2 ** (attempt - 1)), self.retry_max_delay)
+        delay *= random.uniform(0.5, 1.5)
+        retry = (stage, response, context, attempt, error)
+        with self._stats_lock:
+            self._pending_retries[id(retry)] = retry
+        self.loop.call_later(delay, lambda: asyncio.ensure_future(self._retry(retry)))
+    
+    async def _retry(self, retry):
+        """重试一个发送阶段"""
+        stage, response, context, attempt, error = retry
+        with self._stats_lock:
+            if self._pending_retries.pop(id(retry), None) is None:
+                return
+            self.retry_count += 1
+        attempt += 1
+        try:
+            await self._deliver(stage, response, context)
+            logger.info(f"第 {attempt} 次发送响应成功（{stage}）")
+        except Exception as e:
+            logger.warning(f"第 {attempt} 次发送响应失败（{stage}）: {str(e)}")
+            self._schedule_retry(stage, response, context, attempt, e)
+    
+    def _dead_letter(self, stage, response, context, attempts, error):
+        """
+        记录重试次数用尽的响应（在线程池中写数据库，不阻塞事件循环）
+        """
+        with self._stats_lock:
+            self.dead_letter_count += 1
+        logger.error(f"响应发送 {attempts} 次仍失败，已写入死信（{stage}）: {str(error)}")
+        self.loop.run_in_executor(
+            None, self._store_dead_letter, stage, response, context, attempts, str(error)
+        )
+    
+    @staticmethod
+    def _store_dead_letter(stage, response, context, attempts, error):
+        """写入死信记录"""
+        try:
+            ResponseDeadLetter.objects.create(
+                stage=stage,
+                response_type=response.get('type', ''),
+                response=json_safe(response),
+                context=json_safe(context),
+                attempts=attempts,
+                last_error=error
+            )
+        except Exception as e:
+            logger.error(f"写入响应死信失败: {str(e)}", exc_info=True)
+        finally:
+            close_old_connections()
+    
+    def replay_dead_letter(self, dead_letter, timeout=30):
+        """
+        重放一条死信（管理后台和接口调用）
+        
+        参数:
+        - dead_letter: ResponseDeadLetter实例
+        - timeout: 等待发送完成的最长时间（秒）
+        
+        返回:
+        - 是否发送成功；成功时记录重放时间，失败时累加尝试次数并更新错误信息
+        """
+        args = (dead_letter.stage, dead_letter.response, dead_letter.context)
+        try:
+            if self.running:
+                asyncio.run_coroutine_threadsafe(self._deliver(*args), self.loop).result(timeout)
+            else:
+                async_to_sync(self._deliver)(*args)
+        except Exception as e:
+            dead_letter.attempts += 1
+            dead_letter.last_error = str(e)
+            dead_letter.save(update_fields=['attempts', 'last_error'])
+            return False
+        
+        dead_letter.attempts += 1
+        dead_letter.replayed_at = timezone.now()
+        dead_letter.save(update_fields=['attempts', 'replayed_at'])
+        return True
+            
+    def add_message(self, message: Dict, context: Dict = None, callback: Callable = None,
+                    lane: Optional[str] = None, enqueue_timeout: Optional[float] = None) -> Future:
         """
         添加消息到处理队列
         
+        通道已满时最多等待 enqueue_timeout 秒，仍然无法入队则丢弃该消息
+        
         参数:
         - message: 消息内容
         - context: 上下文信息
         - callback: 处理完成后的回调函数
+        - lane: 优先级通道（mention、group、bulk），为None时按消息内容判断
+        - enqueue_timeout: 本次入队的等待时间（秒），为None时使用处理器的设置
+        
+        返回:
+        - concurrent.futures.Future，规则引擎处理完成后结果为规则响应列表；
+          消息被丢弃时以 queue.Full 异常结束，重复的消息直接以空列表结束。
+          在消息开始处理前取消future，消息不再处理。
         """
         if context is None:
             context = {}
+        if lane not in self.lane_weights:
+            lane = classify_lane(message, context)
+        if enqueue_timeout is None:
+            enqueue_timeout = self.enqueue_timeout
             
-        # 确保异步队列可用
+        # 确保工作线程已启动（不重放日志中其他进程留下的消息）
         if not self.running:
-            self.start()
+            self.start(recover=False)
             
-        # 在同步环境中调用异步方法
-        loop = asyncio.new_event_loop()
-        try:
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(self.queue.put((message, context, callback)))
-        finally:
-            loop.close()
+        item = QueuedMessage(message, context, callback)
+        if self.journal is not None:
+            item.journal_key = self._journal_key(message, context)
+            if not self.journal.append(item.journal_key, lane, message, context):
+                logger.debug(f"消息 {item.journal_key} 已在处理中或已处理，忽略重复入队")
+                item.future.set_result([])
+                return item.future
             
+        key = partition_key(message, context)
+        index = self._shard_index(key)
+        try:
+            self.shards[index].put(item, lane, timeout=enqueue_timeout, key=key)
+        except queue.Full as e:
+            if item.journal_key is not None:
+                self.journal.complete(item.journal_key)
+            with self._stats_lock:
+                self.dropped_count += 1
+                self.lane_dropped[lane] += 1
+            logger.warning(f"消息处理分片 {index} 的通道 {lane} 已满（容量 {self.queue_size}），丢弃消息")
+            item.future.set_exception(e)
+        return item.future
+    
+    async def process(self, message: Dict, context: Dict = None, lane: Optional[str] = None,
+                      timeout: Optional[float] = None) -> List[Dict]:
+        """
+        在调用方的事件循环中提交消息并等待规则响应
+        
+        入队不等待（通道已满时立即失败）；开启持久化日志时追加记录要等待日志批次提交（fsync），
+        在线程池中执行，不阻塞调用方的事件循环；
+        结果通过调用方的事件循环返回，不需要额外的线程切换；等待超时或调用方被取消时，尚未开始处理的消息不再处理。
+        
+        参数:
+        - message: 消息内容
+        - context: 上下文信息
+        - lane: 优先级通道，为None时按消息内容判断
+        - timeout: 等待规则响应的最长时间（秒），None表示一直等待
+        
+        返回:
+        - 规则响应列表
+        
+        异常:
+        - queue.Full: 通道已满，消息被丢弃
+        - asyncio.TimeoutError: 等待超时
+        """
+        if self.journal is not None:
+            future = await sync_to_async(self.add_message, thread_sensitive=False)(
+                message, context, lane=lane, enqueue_timeout=0
+            )
+        else:
+            future = self.add_message(message, context, lane=lane, enqueue_timeout=0)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    
+    def _shard_index(self, key):
+        """
+        分区键对应的分片序号
+        
+        参数:
+        - key: 分区键，为None时轮流分配到各分片
+        """
+        if key is None:
+            return next(self._unkeyed) % self.worker_count
+        return zlib.crc32(key.encode('utf-8')) % self.worker_count
+    
+    @staticmethod
+    def _journal_key(message, context):
+        """消息在持久化日志中的ID，没有消息ID时生成一个"""
+        message_id = context.get('message_id')
+        if not message_id and isinstance(message, dict):
+            message_id = message.get('id')
+        return str(message_id) if message_id else uuid.uuid4().hex
+        
+    def stats(self):
+        """
+        获取处理器运行状态
+        
+        返回:
+        - 包含工作线程数、队列长度、已处理/丢弃/出错消息数以及各通道状态的字典
+        """
+        with self._stats_lock:
+            return {
+                'running': self.running,
+                'workers': len(self.workers),
+                'queue_size': sum(shard.qsize() for shard in self.shards),
+                'queue_capacity': self.queue_size,
+                'processed': self.processed_count,
+                'dropped': self.dropped_count,
+                'errors': self.error_count,
+                'coalesced': self.coalesced_count,
+                'retry_pending': len(self._pending_retries),
+                'retries': self.retry_count,
+                'dead_letters': self.dead_letter_count,
+                'journal_pending': self.journal.pending_count() if self.journal is not None else None,
+                'lanes': {
+                    lane: {
+                        'weight': weight,
+                        'queue_size': sum(shard.qsize(lane) for shard in self.shards),
+                        'dropped': self.lane_dropped[lane],
+                    }
+                    for lane, weight in self.lane_weights.items()
+                },
+                'shards': [
+                    {'queue_size': shard.qsize(), 'processed': self.shard_processed[index]}
+                    for index, shard in enumerate(self.shards)
+                ],
+            }
+    
+    def hot_partitions(self, limit=10):
+        """
+        获取排队消息最多的分区（热点群组）
+        
+        参数:
+        - limit: 最多返回的分区数量
+        
+        返回:
+        - 按排队消息数降序排列的 {'key', 'shard', 'queue_size'} 列表
+        """
+        partitions = [
+            {'key': key, 'shard': index, 'queue_size': size}
+            for index, shard in enumerate(self.shards)
+            for key, size in shard.key_sizes().items()
+        ]
+        partitions.sort(key=lambda partition: partition['queue_size'], reverse=True)
+        return partitions[:limit]
+        
+    def snapshot(self):
+        """
+        获取处理器运行状态和延迟指标
+        
+        返回:
+        - stats() 的内容，加上各通道最早一条消息的等待时间、热点分区和 ProcessorMetrics 的指标摘要
+        """
+        snapshot = self.stats()
+        now = time.monotonic()
+        for lane, lane_stats in snapshot['lanes'].items():
+            oldest = [item.enqueued_at for item in (shard.peek(lane) for shard in self.shards) if item is not None]
+            lane_stats['oldest_wait_ms'] = round((now - min(oldest)) * 1000, 3) if oldest else 0.0
+        snapshot['hot_partitions'] = self.hot_partitions()
+        snapshot.update(self.metrics.snapshot())
+        return snapshot
+        
     def register_handler(self, response_type: str, handler: Callable):
         """
         注册响应处理函数
@@ -156,7 +1130,7 @@ class AsyncMessageProcessor:
         self.handlers[response_type] = handler
         
 # 全局实例
-message_processor = AsyncMessageProcessor()
+message_processor = AsyncMessageProcessor(journal=ProcessorJournal.from_settings())
 
 # 应用启动时初始化
 def init_async_processor():
@@ -0,0 +1,356 @@
+"""
+群组上下文窗口
+
+每个群组在进程内维护一个有界的最近消息环形缓冲区，由 WebSocket 消费者、
+REST 发送接口和规则引擎写入，供上下文感知规则（CONTEXT_AWARE）读取，
+评估时不需要查询数据库。
+
+窗口增量维护所有消息小写文本的拼接结果，取最近若干条消息的上下文文本
+只需一次切片；每条消息的词向量之和在首次使用时计算并缓存在窗口条目上，
+后续消息的上下文主题评估直接复用，代价为 O(窗口大小)。
+
+上下文包含当前消息本身：当前消息和它之前时间窗口内的消息一起参与上下文感知规则的评估。
+"""
+
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 默认每个群组保留的最近消息数量
+DEFAULT_WINDOW_SIZE = 50
+
+# 默认最多保留上下文窗口的群组数量
+DEFAULT_MAX_GROUPS = 1000
+
+
+def parse_timestamp(value):
+    """
+    解析消息时间戳
+
+    参数:
+    - value: ISO格式字符串或datetime
+
+    返回:
+    - 带时区的datetime，无法解析时返回None
+    """
+    if isinstance(value, str):
+        try:
+            value = timezone.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, timezone.datetime):
+        return None
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+class ContextEntry:
+    """
+    上下文窗口中的一条消息
+
+    vector（词向量之和, 词数）在首次使用时由 MessageFeatures 计算并写入
+    """
+
+    __slots__ = ('id', 'sender', 'content', 'lower_content', 'timestamp', 'vector')
+
+    def __init__(self, message):
+        """
+        参数:
+        - message: 消息字典
+        """
+        content = message.get('content', '')
+        if not isinstance(content, str):
+            content = ''
+        message_id = message.get('id')
+        self.id = str(message_id) if message_id else None
+        self.sender = message.get('sender')
+        self.content = content
+        self.lower_content = content.lower()
+        self.timestamp = parse_timestamp(message.get('timestamp')) or timezone.now()
+        self.vector = None
+
+    def to_dict(self):
+        """导出为消息字典"""
+        return {
+            'id': self.id,
+            'sender': self.sender,
+            'content': self.content,
+            'timestamp': self.timestamp.isoformat(),
+        }
+
+
+class ContextView:
+    """
+    上下文窗口在某条消息处的只读快照（包含该消息本身）
+    """
+
+    def __init__(self, entries, text, offsets):
+        """
+        参数:
+        - entries: 按时间顺序排列的ContextEntry列表
+        - text: 所有条目小写文本以空格拼接的结果
+        - offsets: 每个条目在text中的起始位置
+        """
+        self.entries = entries
+        self._text = text
+        self._offsets = offsets
+
+    def select(self, context_size, time_window, reference_time=None):
+        """
+        选择最近的、位于时间窗口内的连续若干条消息
+
+        参数:
+        - context_size: 最多考虑的消息数量
+        - time_window: 时间窗口（秒）
+        - reference_time: 时间窗口的参照时间，默认为最后一条消息的时间
+
+        返回:
+        - 起始条目的下标，没有有效消息时返回None
+        """
+        if not self.entries or context_size <= 0:
+            return None
+        if reference_time is None:
+            reference_time = self.entries[-1].timestamp
+
+        start = None
+        lowest = max(0, len(self.entries) - context_size)
+        for index in range(len(self.entries) - 1, lowest - 1, -1):
+            if (reference_time - self.entries[index].timestamp).total_seconds() > time_window:
+                break
+            start = index
+        return start
+
+    def content(self, start):
+        """
+        获取从指定条目开始的拼接小写文本
+
+        参数:
+        - start: 起始条目的下标
+
+        返回:
+        - 拼接后的文本
+        """
+        return self._text[self._offsets[start]:]
+
+
+class ContextWindow:
+    """
+    单个群组的最近消息环形缓冲区
+    """
+
+    def __init__(self, max_size=DEFAULT_WINDOW_SIZE):
+        """
+        参数:
+        - max_size: 最多保留的消息数量，超出时淘汰最早的消息
+        """
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self._entries = deque()
+        self._by_id = {}
+        # 所有条目的小写文本，每条后跟一个空格；_base 为已淘汰部分的长度
+        self._text = ''
+        self._offsets = deque()
+        self._base = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, message):
+        """
+        追加一条消息，带ID的消息重复追加时返回已有条目
+
+        参数:
+        - message: 消息字典
+
+        返回:
+        - 对应的ContextEntry
+        """
+        message_id = message.get('id')
+        with self._lock:
+            if message_id:
+                existing = self._by_id.get(str(message_id))
+                if existing is not None:
+                    return existing
+
+            entry = ContextEntry(message)
+            self._entries.append(entry)
+            self._offsets.append(self._base + len(self._text))
+            self._text += entry.lower_content + ' '
+            if entry.id:
+                self._by_id[entry.id] = entry
+
+            while len(self._entries) > self.max_size:
+                evicted = self._entries.popleft()
+                self._offsets.popleft()
+                removed = len(evicted.lower_content) + 1
+                self._text = self._text[removed:]
+                self._base += removed
+                if evicted.id and self._by_id.get(evicted.id) is evicted:
+                    del self._by_id[evicted.id]
+            return entry
+
+    def view(self, entry=None):
+        """
+        获取截至指定条目（包含）的快照
+
+        参数:
+        - entry: ContextEntry，为None或已被淘汰时截至最新的消息
+
+        返回:
+        - ContextView
+        """
+        with self._lock:
+            entries = list(self._entries)
+            end = len(entries)
+            if entry is not None:
+                for index in range(end - 1, -1, -1):
+                    if entries[index] is entry:
+                        end = index + 1
+                        break
+            entries = entries[:end]
+            offsets = [offset - self._base for offset in list(self._offsets)[:end]]
+            text_end = offsets[-1] + len(entries[-1].lower_content) if entries else 0
+            return ContextView(entries, self._text[:text_end], offsets)
+
+    def messages(self):
+        """导出窗口中的消息字典列表"""
+        with self._lock:
+            return [entry.to_dict() for entry in self._entries]
+
+    @classmethod
+    def from_messages(cls, messages):
+        """
+        由消息列表构建临时窗口（用于调用方显式提供的上下文消息）
+
+        参数:
+        - messages: 按时间顺序排列的消息字典列表
+
+        返回:
+        - ContextWindow
+        """
+        window = cls(max_size=max(len(messages), 1))
+        for message in messages:
+            window.append(message)
+        return window
+
+
+class GroupContextStore:
+    """
+    按群组保存上下文窗口
+
+    群组数量有上限，超出时淘汰最久未活跃的群组。
+    """
+
+    def __init__(self, window_size=None, max_groups=None):
+        """
+        参数:
+        - window_size: 每个群组保留的消息数量，默认读取 RULE_ENGINE_CONFIG['CONTEXT_WINDOW_SIZE']
+        - max_groups: 最多保留的群组数量，默认读取 RULE_ENGINE_CONFIG['CONTEXT_MAX_GROUPS']
+        """
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        self._lock = threading.Lock()
+        self.window_size = window_size or config.get('CONTEXT_WINDOW_SIZE', DEFAULT_WINDOW_SIZE)
+        self.max_groups = max_groups or config.get('CONTEXT_MAX_GROUPS', DEFAULT_MAX_GROUPS)
+        self._windows = OrderedDict()
+
+    def get_window(self, group_id, create=True):
+        """
+        获取群组的上下文窗口
+
+        参数:
+        - group_id: 群组ID
+        - create: 不存在时是否创建
+
+        返回:
+        - ContextWindow，不存在且不创建时返回None
+        """
+        key = str(group_id)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None:
+                self._windows.move_to_end(key)
+                return window
+            if not create:
+                return None
+
+            window = ContextWindow(self.window_size)
+            self._windows[key] = window
+            while len(self._windows) > self.max_groups:
+                self._windows.popitem(last=False)
+            return window
+
+    def record(self, group_id, message):
+        """
+        记录一条群组消息，同一消息（按ID）多次记录只保留一份
+
+        参数:
+        - group_id: 群组ID
+        - message: 消息字典
+
+        返回:
+        - (ContextWindow, ContextEntry)，group_id为空时返回(None, None)
+        """
+        if not group_id:
+            return None, None
+        try:
+            window = self.get_window(group_id)
+            return window, window.append(message)
+        except Exception as e:
+            logger.error(f"记录群组上下文时出错: {str(e)}", exc_info=True)
+            return None, None
+
+    def record_stored_message(self, stored_message):
+        """
+        记录一条已保存的群组消息
+
+        参数:
+        - stored_message: GroupMessage或messaging.Message实例
+
+        返回:
+        - (ContextWindow, ContextEntry)，不是群组消息时返回(None, None)
+        """
+        content = stored_message.content
+        # GroupMessage使用timestamp字段，messaging.Message使用created_at字段
+        sent_at = getattr(stored_message, 'timestamp', None) or stored_message.created_at
+        return self.record(stored_message.group_id, {
+            'id': str(stored_message.id),
+            'content': content.get('text', '') if isinstance(content, dict) else str(content),
+            'sender': str(stored_message.sender_user_id) if stored_message.sender_user_id else None,
+            'timestamp': sent_at,
+        })
+
+    def get_messages(self, group_id):
+        """
+        获取群组上下文窗口中的消息
+
+        参数:
+        - group_id: 群组ID
+
+        返回:
+        - 消息字典列表
+        """
+        window = self.get_window(group_id, create=False)
+        return window.messages() if window is not None else []
+
+    def clear(self, group_id=None):
+        """
+        清空上下文
+
+        参数:
+        - group_id: 群组ID，为None时清空所有群组
+        """
+        with self._lock:
+            if group_id is None:
+                self._windows.clear()
+            else:
+                self._windows.pop(str(group_id), None)
+
+
+# 全局实例
+context_store = GroupContextStore()
@@ -0,0 +1,250 @@
+"""
+消息特征
+
+规则引擎处理一条消息时创建一个 MessageFeatures 对象并传给每条规则的匹配方法。
+小写文本、分词、提及、情感得分、上下文文本、主题向量等特征都在首次使用时才计算，
+并在该消息范围内缓存，无论有多少条规则使用同一特征，最多只计算一次。
+
+批量处理时，同一批消息共享一个 FeatureCache，按文本缓存分词、情感得分和主题向量，
+相同的文本（如重复消息、相邻消息重叠的上下文窗口）在整批中也只计算一次。
+"""
+
+import logging
+from functools import cached_property
+
+from .context_store import ContextWindow
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureCache:
+    """
+    按文本缓存的特征计算结果，可在多条消息之间共享
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.sentiment = {}
+        self.vectors = {}
+
+
+class MessageFeatures:
+    """
+    单条消息的惰性特征
+
+    属性（首次访问时计算）:
+    - content: 消息文本
+    - lower_content: 小写的消息文本
+    - tokens: 消息文本的分词结果
+    - mentions: 消息中被提及对象（代理ID或名称）的集合
+    - mentioned_agent_ids: 被提及的（拥有提及规则的）代理ID集合
+    - sentiment: 消息文本的情感得分（-1.0 到 1.0）
+    - context: 消息所在的上下文窗口快照（包含当前消息）
+
+    方法（按参数缓存）:
+    - context_content: 指定窗口内的上下文文本
+    - context_sentiment: 指定窗口内上下文拼接文本的情感得分
+    - context_topic_similarity: 指定窗口内上下文与主题的相似度
+    - text_sentiment: 任意文本的情感得分
+    - topic_similarity: 文本与主题的相似度
+    """
+
+    def __init__(self, message, cache=None, context_window=None, context_entry=None):
+        """
+        参数:
+        - message: 标准化的消息
+        - cache: 可选的共享特征缓存（FeatureCache），为None时只在本消息范围内缓存
+        - context_window: 消息所在群组的上下文窗口（ContextWindow），见 context_store.py
+        - context_entry: 当前消息在上下文窗口中的条目
+        """
+        self.message = message
+        self._cache = cache if cache is not None else FeatureCache()
+        self._context_window = context_window
+        self._context_entry = context_entry
+        self._context_cache = {}
+
+    @cached_property
+    def content(self):
+        """消息文本"""
+        content = self.message.get('content', '')
+        return content if isinstance(content, str) else ''
+
+    @cached_property
+    def lower_content(self):
+        """小写的消息文本"""
+        return self.content.lower()
+
+    @cached_property
+    def tokens(self):
+        """消息文本的分词结果"""
+        return self.tokenize(self.content)
+
+    @cached_property
+    def mentions(self):
+        """消息中被提及对象的集合"""
+        return frozenset(str(mention) for mention in self.message.get('mentions') or [])
+
+    @cached_property
+    def mentioned_agent_ids(self):
+        """通过提及路由索引解析出的被提及代理ID集合"""
+        from .rule_index import rule_index
+        return rule_index.resolve_mentions(self.mentions, self.lower_content)
+
+    @cached_property
+    def sentiment(self):
+        """消息文本的情感得分，调用方已提供情感信息时直接使用"""
+        provided = self.message.get('sentiment')
+        if isinstance(provided, dict) and 'score' in provided:
+            return provided['score']
+        return self.text_sentiment(self.content)
+
+    def tokenize(self, text):
+        """
+        分词
+
+        参数:
+        - text: 待分词的文本
+
+        返回:
+        - 词列表
+        """
+        tokens = self._cache.tokens.get(text)
+        if tokens is None:
+            import jieba
+            tokens = jieba.lcut(text) if text else []
+            self._cache.tokens[text] = tokens
+        return tokens
+
+    def text_sentiment(self, text):
+        """
+        计算文本的情感得分
+
+        参数:
+        - text: 待分析的文本
+
+        返回:
+        - 情感得分（-1.0 到 1.0）
+        """
+        score = self._cache.sentiment.get(text)
+        if score is None:
+            from agents.utils.sentiment_analyzer import analyze_sentiment
+            score = analyze_sentiment(text)
+            self._cache.sentiment[text] = score
+        return score
+
+    @cached_property
+    def context(self):
+        """
+        消息所在的上下文窗口快照（包含当前消息）
+
+        调用方显式提供 context_messages 时由其构建临时窗口，
+        否则使用规则引擎传入的群组上下文窗口
+        """
+        provided = self.message.get('context_messages')
+        if provided is not None or self._context_window is None:
+            window = ContextWindow.from_messages(list(provided or []) + [self.message])
+            return window.view()
+        return self._context_window.view(self._context_entry)
+
+    def _context_start(self, context_size, time_window):
+        """选择窗口内有效上下文的起始下标（按参数缓存）"""
+        key = (context_size, time_window)
+        if key not in self._context_cache:
+            self._context_cache[key] = self.context.select(context_size, time_window)
+        return self._context_cache[key]
+
+    def context_content(self, context_size, time_window):
+        """
+        获取时间窗口内最近几条消息（包含当前消息）合并后的小写文本
+
+        参数:
+        - context_size: 最多考虑的消息数量
+        - time_window: 时间窗口（秒）
+
+        返回:
+        - 合并后的文本，没有有效的上下文消息时返回None
+        """
+        start = self._context_start(context_size, time_window)
+        return None if start is None else self.context.content(start)
+
+    def context_sentiment(self, context_size, time_window):
+        """
+        获取时间窗口内最近几条消息合并后文本的情感得分
+
+        对拼接后的小写文本整体做一次情感分析（不是各条消息得分的平均值），
+        相同窗口配置的规则共享结果
+
+        参数:
+        - context_size: 最多考虑的消息数量
+        - time_window: 时间窗口（秒）
+
+        返回:
+        - 情感得分（-1.0 到 1.0），没有有效的上下文消息时返回None
+        """
+        content = self.context_content(context_size, time_window)
+        return None if content is None else self.text_sentiment(content)
+
+    def context_topic_similarity(self, context_size, time_window, topic):
+        """
+        计算时间窗口内最近几条消息与主题的相似度
+
+        上下文向量是拼接文本中所有词的词向量平均值：每条消息的词向量之和与词数
+        缓存在上下文窗口条目上，只计算一次，合并后与对拼接文本整体计算的结果相同
+
+        参数:
+        - context_size: 最多考虑的消息数量
+        - time_window: 时间窗口（秒）
+        - topic: 主题描述
+
+        返回:
+        - 相似度得分（0.0 到 1.0），没有有效的上下文消息时返回None
+        """
+        start = self._context_start(context_size, time_window)
+        if start is None:
+            return None
+
+        from agents.utils.topic_analyzer import get_word_vector_sum, vector_similarity
+
+        vector_sum = None
+        word_count = 0
+        for entry in self.context.entries[start:]:
+            if entry.vector is None:
+                entry.vector = get_word_vector_sum(entry.lower_content, self.tokenize(entry.lower_content))
+            vector, count = entry.vector
+            vector_sum = vector if vector_sum is None else vector_sum + vector
+            word_count += count
+
+        # 没有词向量时与整体计算一样使用零向量
+        context_vector = vector_sum / word_count if word_count else vector_sum
+        return vector_similarity(context_vector, self.topic_vector(topic))
+
+    def topic_vector(self, text):
+        """
+        获取文本的主题向量
+
+        参数:
+        - text: 输入文本
+
+        返回:
+        - 文本的向量表示
+        """
+        vector = self._cache.vectors.get(text)
+        if vector is None:
+            from agents.utils.topic_analyzer import get_text_vector
+            vector = get_text_vector(text, self.tokenize(text))
+            self._cache.vectors[text] = vector
+        return vector
+
+    def topic_similarity(self, text, topic):
+        """
+        计算文本与主题的相似度，两侧的主题向量都在消息范围内缓存
+
+        参数:
+        - text: 文本
+        - topic: 主题描述
+
+        返回:
+        - 相似度得分（0.0 到 1.0）
+        """
+        from agents.utils.topic_analyzer import vector_similarity
+        return vector_similarity(self.topic_vector(text), self.topic_vector(topic))
@@ -2,24 +2,55 @@
 代理响应处理器
 
 定义各种类型响应的异步处理函数
+
+处理函数生成推送给客户端的消息并返回（不需要推送时返回None），由异步消息处理器把
+同一条源消息的所有响应合并为一个 agent.batch 事件发送到群组；
+同一批次的消息使用相同的时间（context['sent_at']）
+
+处理函数失败时抛出异常，由异步消息处理器按指数退避重试，重试次数用尽后写入响应死信
 """
 
 import logging
-import json
-import asyncio
-from asgiref.sync import async_to_sync
+import uuid
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from django.utils import timezone
-from django.db import transaction
-from channels.layers import get_channel_layer
 
 from .async_processor import message_processor
-from groups.models import GroupMessage, Group
-from .models import Agent, AgentListeningRule, AgentInteraction
+from .summarizer import conversation_summarizer
+from .knowledge_index import DEFAULT_SEARCH_LIMIT, SOURCE_GROUP_MESSAGE, SOURCE_MESSAGE, knowledge_index
+from .task_writer import task_writer
 
 logger = logging.getLogger(__name__)
 
-# 获取公共的channel_layer
-channel_layer = get_channel_layer()
+
+def agent_message(message_type, response, context, payload, metadata):
+    """
+    生成推送给客户端的代理消息
+    
+    参数:
+    - message_type: 消息类型（agent_response、notification等）
+    - response: 规则引擎生成的响应数据
+    - context: 上下文信息，sent_at 为同一批次共用的发送时间
+    - payload: 消息内容
+    - metadata: 附加信息
+    
+    返回:
+    - 消息字典
+    """
+    sent_at = context.get('sent_at') or timezone.now()
+    return {
+        'id': str(uuid.uuid4()),
+        'message_type': message_type,
+        'sender': {
+            'id': response.get('agent_id'),
+            'type': 'agent',
+            'name': response.get('agent_name', '代理')
+        },
+        'payload': payload,
+        'timestamp': sent_at.isoformat(),
+        'metadata': {**metadata, 'rule_engine': 'v1.0'}
+    }
 
 async def auto_reply_handler(response, context):
     """
@@ -28,6 +59,9 @@ async def auto_reply_handler(response, context):
     参数:
     - response: 规则引擎生成的响应数据
     - context: 上下文信息
+    
+    返回:
+    - 推送给客户端的消息
     """
     try:
         # 记录自动回复
@@ -36,47 +70,28 @@ async def auto_reply_handler(response, context):
             extra={'response': response, 'context': context}
         )
         
-        group_id = context.get('group_id')
-        if not group_id:
-            logger.warning("自动回复缺少群组ID")
-            return
-        
         # 创建消息内容
-        agent_id = response.get('agent_id')
         content = response.get('content', '无内容')
         
         # 生成消息对象字典
-        message_data = {
-            'type': 'agent.message',
-            'message': {
-                'id': str(timezone.now().timestamp()),
-                'message_type': 'agent_response',
-                'sender': {
-                    'id': agent_id,
-                    'type': 'agent',
-                    'name': response.get('agent_name', '代理')
-                },
-                'payload': {
-                    'text': content,
-                    'rule_id': response.get('rule_id'),
-                    'rule_name': response.get('rule_name'),
-                    'message_id': context.get('message_id'),
-                    'confidence': response.get('confidence', 1.0)
-                },
-                'timestamp': timezone.now().isoformat(),
-                'metadata': {
-                    'response_type': 'auto_reply',
-                    'rule_engine': 'v1.0'
-                }
-            }
-        }
-        
-        # 发送到群组
-        room_group_name = f"group_{group_id}"
-        await channel_layer.group_send(room_group_name, message_data)
+        return agent_message(
+            'agent_response',
+            response,
+            context,
+            payload={
+                'text': content,
+                'rule_id': response.get('rule_id'),
+                'rule_name': response.get('rule_name'),
+                'message_id': context.get('message_id'),
+                'confidence': response.get('confidence', 1.0)
+            },
+            metadata={'response_type': 'auto_reply'}
+        )
         
     except Exception as e:
-        logger.error(f"处理自动回复响应时出错: {str(e)}", exc_info=True)
+        logger.error(f"处理自动回复响应时出错: {str(e)}")
+        # 交给异步处理器重试，重试次数用尽后写入死信
+        raise
 
 async def notification_handler(response, context):
     """
@@ -85,6 +100,9 @@ async def notification_handler(response, context):
     参数:
     - response: 规则引擎生成的响应数据
     - context: 上下文信息
+    
+    返回:
+    - 推送给客户端的消息
     """
     try:
         # 记录通知
@@ -93,54 +111,38 @@ async def notification_handler(response, context):
             extra={'response': response, 'context': context}
         )
         
-        group_id = context.get('group_id')
-        if not group_id:
-            logger.warning("通知缺少群组ID")
-            return
-        
         # 创建通知内容
-        agent_id = response.get('agent_id')
         content = response.get('content', '无内容')
         
         # 生成通知对象字典
-        notification_data = {
-            'type': 'agent.notification',
-            'message': {
-                'id': str(timezone.now().timestamp()),
-                'message_type': 'notification',
-                'sender': {
-                    'id': agent_id,
-                    'type': 'agent',
-                    'name': response.get('agent_name', '代理')
-                },
-                'payload': {
-                    'text': content,
-                    'rule_id': response.get('rule_id'),
-                    'severity': 'info',
-                    'message_id': context.get('message_id')
-                },
-                'timestamp': timezone.now().isoformat(),
-                'metadata': {
-                    'response_type': 'notification',
-                    'rule_engine': 'v1.0'
-                }
-            }
-        }
-        
-        # 发送到群组
-        room_group_name = f"group_{group_id}"
-        await channel_layer.group_send(room_group_name, notification_data)
+        return agent_message(
+            'notification',
+            response,
+            context,
+            payload={
+                'text': content,
+                'rule_id': response.get('rule_id'),
+                'severity': 'info',
+                'message_id': context.get('message_id')
+            },
+            metadata={'response_type': 'notification'}
+        )
         
     except Exception as e:
-        logger.error(f"处理通知响应时出错: {str(e)}", exc_info=True)
+        logger.error(f"处理通知响应时出错: {str(e)}")
+        # 交给异步处理器重试，重试次数用尽后写入死信
+        raise
 
 async def task_handler(response, context):
     """
-    处理任务创建类型的响应
+    处理任务创建类型的响应（由 agents.task_writer 批量写入）
     
     参数:
     - response: 规则引擎生成的响应数据
     - context: 上下文信息
+    
+    返回:
+    - None，不随本条消息的其他响应一起推送
     """
     try:
         # 记录任务创建
@@ -149,45 +151,14 @@ async def task_handler(response, context):
             extra={'response': response, 'context': context}
         )
         
-        group_id = context.get('group_id')
-        if not group_id:
-            logger.warning("任务创建缺少群组ID")
-            return
-        
-        # 这里应该实现任务创建的实际逻辑
-        # TODO: 集成任务管理系统API
-        
-        # 生成任务创建通知
-        task_notification = {
-            'type': 'agent.task_created',
-            'message': {
-                'id': str(timezone.now().timestamp()),
-                'message_type': 'task_created',
-                'sender': {
-                    'id': response.get('agent_id'),
-                    'type': 'agent',
-                    'name': response.get('agent_name', '代理')
-                },
-                'payload': {
-                    'task_title': response.get('task_title', '新任务'),
-                    'task_description': response.get('task_description', ''),
-                    'rule_id': response.get('rule_id'),
-                    'message_id': context.get('message_id')
-                },
-                'timestamp': timezone.now().isoformat(),
-                'metadata': {
-                    'response_type': 'task',
-                    'rule_engine': 'v1.0'
-                }
-            }
-        }
-        
-        # 发送到群组
-        room_group_name = f"group_{group_id}"
-        await channel_layer.group_send(room_group_name, task_notification)
+        # 放入批量写入器，任务创建通知在写入后按群组每批广播一次
+        task_writer.submit(response, context)
+        return None
         
     except Exception as e:
-        logger.error(f"处理任务创建响应时出错: {str(e)}", exc_info=True)
+        logger.error(f"处理任务创建响应时出错: {str(e)}")
+        # 交给异步处理器重试，重试次数用尽后写入死信
+        raise
 
 async def action_handler(response, context):
     """
@@ -196,6 +167,9 @@ async def action_handler(response, context):
     参数:
     - response: 规则引擎生成的响应数据
     - context: 上下文信息
+    
+    返回:
+    - 推送给客户端的消息
     """
     try:
         # 记录动作执行
@@ -211,89 +185,90 @@ async def action_handler(response, context):
         # 根据不同的动作名称执行不同的操作
         if action_name == 'summarize_conversation':
             # 执行对话总结
-            await execute_summarize_action(response, context)
+            return await execute_summarize_action(response, context)
         elif action_name == 'search_knowledge_base':
             # 搜索知识库
-            await execute_search_action(response, context)
+            return await execute_search_action(response, context)
         else:
             logger.warning(f"未知的动作类型: {action_name}")
+            return None
             
     except Exception as e:
-        logger.error(f"处理动作响应时出错: {str(e)}", exc_info=True)
+        logger.error(f"处理动作响应时出错: {str(e)}")
+        # 交给异步处理器重试，重试次数用尽后写入死信
+        raise
 
 async def execute_summarize_action(response, context):
-    """执行对话总结动作"""
-    # 实际环境中，可能会调用AI接口生成摘要
+    """执行对话总结动作（增量更新群组的滚动摘要，见 agents.summarizer）"""
     group_id = context.get('group_id')
+    if not group_id:
+        logger.warning("对话总结缺少群组ID")
+        return None
     
-    # 模拟总结过程
-    await asyncio.sleep(2)
+    # 摘要需要查询数据库并做分词计算，在线程中执行，不阻塞事件循环
+    summary = await database_sync_to_async(conversation_summarizer.summarize, thread_sensitive=False)(group_id)
     
-    # 发送总结结果
-    summary_message = {
-        'type': 'agent.action_result',
-        'message': {
-            'id': str(timezone.now().timestamp()),
-            'message_type': 'action_result',
-            'sender': {
-                'id': response.get('agent_id'),
-                'type': 'agent',
-                'name': response.get('agent_name', '代理')
-            },
-            'payload': {
-                'action_name': 'summarize_conversation',
-                'text': "我已经总结了最近的对话: 这里是模拟的总结内容...",
-                'message_id': context.get('message_id')
-            },
-            'timestamp': timezone.now().isoformat(),
-            'metadata': {
-                'response_type': 'action',
-                'action': 'summarize_conversation',
-                'rule_engine': 'v1.0'
-            }
+    # 生成总结结果
+    return agent_message(
+        'action_result',
+        response,
+        context,
+        payload={
+            'action_name': 'summarize_conversation',
+            'text': f"我已经总结了最近的对话:\n{summary.summary}" if summary.summary else "最近没有可以总结的对话",
+            'message_id': context.get('message_id'),
+            'summarized_messages': summary.message_count
+        },
+        metadata={
+            'response_type': 'action',
+            'action': 'summarize_conversation'
         }
-    }
-    
-    # 发送到群组
-    room_group_name = f"group_{group_id}"
-    await channel_layer.group_send(room_group_name, summary_message)
+    )
 
 async def execute_search_action(response, context):
-    """执行知识库搜索动作"""
-    # 实际环境中，可能会调用搜索API
-    group_id = context.get('group_id')
+    """执行知识库搜索动作（查询本地全文索引，见 agents.knowledge_index）"""
+    action_params = response.get('action_params') or {}
+    query = action_params.get('query') or response.get('message_content', '')
     
-    # 模拟搜索过程
-    await asyncio.sleep(1)
+    # 触发消息保存时已经进入索引，不能作为搜索结果返回给提问的人
+    message_id = context.get('message_id')
+    exclude = [(SOURCE_GROUP_MESSAGE, message_id), (SOURCE_MESSAGE, message_id)] if message_id else None
     
-    # 发送搜索结果
-    search_message = {
-        'type': 'agent.action_result',
-        'message': {
-            'id': str(timezone.now().timestamp()),
-            'message_type': 'action_result',
-            'sender': {
-                'id': response.get('agent_id'),
-                'type': 'agent',
-                'name': response.get('agent_name', '代理')
-            },
-            'payload': {
-                'action_name': 'search_knowledge_base',
-                'text': "我在知识库中找到了以下相关信息: 这里是模拟的搜索结果...",
-                'message_id': context.get('message_id')
-            },
-            'timestamp': timezone.now().isoformat(),
-            'metadata': {
-                'response_type': 'action',
-                'action': 'search_knowledge_base',
-                'rule_engine': 'v1.0'
-            }
-        }
-    }
+    results = []
+    if knowledge_index is not None:
+        results = await sync_to_async(knowledge_index.search, thread_sensitive=False)(
+            query,
+            group_id=context.get('group_id'),
+            sources=action_params.get('sources'),
+            limit=action_params.get('limit', DEFAULT_SEARCH_LIMIT),
+            exclude=exclude
+        )
     
-    # 发送到群组
-    room_group_name = f"group_{group_id}"
-    await channel_layer.group_send(room_group_name, search_message)
+    if results:
+        text = "我在知识库中找到了以下相关信息:\n" + '\n'.join(
+            f"{index}. {result['title'] + ': ' if result['title'] else ''}{result['snippet']}"
+            for index, result in enumerate(results, start=1)
+        )
+    else:
+        text = "知识库中没有找到相关信息"
+    
+    # 生成搜索结果
+    return agent_message(
+        'action_result',
+        response,
+        context,
+        payload={
+            'action_name': 'search_knowledge_base',
+            'text': text,
+            'query': query,
+            'results': results,
+            'message_id': context.get('message_id')
+        },
+        metadata={
+            'response_type': 'action',
+            'action': 'search_knowledge_base'
+        }
+    )
 
 def register_handlers():
     """注册各种响应类型的处理函数"""
@@ -0,0 +1,455 @@
+"""
+本地全文知识索引
+
+search_knowledge_base 动作使用的倒排索引，保存在独立的SQLite文件中（FTS5，WAL模式）：
+
+- 收录群组消息（GroupMessage、messaging.Message）、任务标题和描述、代理技能描述
+- 中文和英文文本先用 jieba 分词（搜索引擎模式）再写入 FTS5，查询按 bm25 排序并返回摘录
+- 文档表以 (来源, 对象ID) 为唯一键，FTS5 表通过触发器同步（external content），
+  更新和删除单个对象只需按键定位，不需要扫描
+- 每个文档带有范围标记：群组内容为 g<群组ID>，不属于群组的个人任务为 u<创建者ID>，
+  公共内容（代理技能）为 global。群组内的搜索只返回本群组和公共的文档，
+  不在群组中的搜索只返回公共文档，范围在 FTS5 中直接过滤
+
+索引由 post_save / post_delete 信号增量维护：信号只把变更放入缓冲区，
+写线程在后台分词并按批次在一个事务中提交，不阻塞保存数据的请求。
+已有数据可用 python manage.py rebuild_knowledge_index 一次性导入。
+
+开启方式: RULE_ENGINE_CONFIG['KNOWLEDGE_INDEX_PATH'] = 索引文件路径（为空表示关闭）
+"""
+
+import atexit
+import logging
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+
+from groups.models import GroupMessage
+from messaging.models import Message
+from task_management.models import Task
+from .models import AgentSkill
+
+logger = logging.getLogger(__name__)
+
+# 文档来源
+SOURCE_GROUP_MESSAGE = 'group_message'
+SOURCE_MESSAGE = 'message'
+SOURCE_TASK = 'task'
+SOURCE_SKILL = 'skill'
+
+# 公共文档（代理技能）的范围标记
+GLOBAL_SCOPE = 'global'
+
+# 默认返回的搜索结果数量
+DEFAULT_SEARCH_LIMIT = 5
+
+# 摘录的长度（字符）
+SNIPPET_LENGTH = 80
+
+# 标题和正文在 bm25 中的权重
+TITLE_WEIGHT = 3.0
+BODY_WEIGHT = 1.0
+
+# 写线程每个事务最多提交的变更数量
+WRITE_BATCH_SIZE = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    title TEXT NOT NULL,
+    body TEXT NOT NULL,
+    title_tokens TEXT NOT NULL,
+    body_tokens TEXT NOT NULL,
+    UNIQUE (source, object_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    title_tokens, body_tokens, scope,
+    content='documents', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts (rowid, title_tokens, body_tokens, scope)
+    VALUES (new.id, new.title_tokens, new.body_tokens, new.scope);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, title_tokens, body_tokens, scope)
+    VALUES ('delete', old.id, old.title_tokens, old.body_tokens, old.scope);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_au AFTER UPDATE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, title_tokens, body_tokens, scope)
+    VALUES ('delete', old.id, old.title_tokens, old.body_tokens, old.scope);
+    INSERT INTO documents_fts (rowid, title_tokens, body_tokens, scope)
+    VALUES (new.id, new.title_tokens, new.body_tokens, new.scope);
+END;
+'''
+
+_TOKEN = re.compile(r'\w', re.UNICODE)
+
+
+def tokenize(text, for_search=False):
+    """
+    把中英文混合文本切分为FTS5可以索引的词
+
+    参数:
+    - text: 文本
+    - for_search: 是否为查询分词（精确模式）；建立索引时使用搜索引擎模式，同时收录长词和其中的短词
+
+    返回:
+    - 小写的词列表
+    """
+    import jieba
+
+    if not text:
+        return []
+    words = jieba.lcut(text.lower()) if for_search else jieba.lcut_for_search(text.lower())
+    return [word.strip() for word in words if word.strip() and _TOKEN.search(word)]
+
+
+def scope_for(group_id):
+    """群组文档的范围标记"""
+    return f'g{group_id}'
+
+
+def private_scope(user_id):
+    """不属于群组的个人文档的范围标记，任何搜索都不会返回"""
+    return f'u{user_id}'
+
+
+def _quote(term):
+    """FTS5查询中的字符串字面量"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def make_snippet(text, terms, length=SNIPPET_LENGTH):
+    """
+    截取正文中第一个命中词附近的片段
+
+    参数:
+    - text: 原文
+    - terms: 查询词
+    - length: 片段长度
+
+    返回:
+    - 片段，前后有省略时加省略号
+    """
+    if len(text) <= length:
+        return text
+    lower = text.lower()
+    positions = [lower.find(term) for term in terms]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - length // 4) if positions else 0
+    end = min(len(text), start + length)
+    start = max(0, end - length)
+    return ('…' if start > 0 else '') + text[start:end] + ('…' if end < len(text) else '')
+
+
+def document_key(instance):
+    """
+    对象在索引中的键
+
+    返回:
+    - (来源, 对象ID)，不是索引收录的模型时返回None
+    """
+    for model, source in (
+        (GroupMessage, SOURCE_GROUP_MESSAGE),
+        (Message, SOURCE_MESSAGE),
+        (Task, SOURCE_TASK),
+        (AgentSkill, SOURCE_SKILL),
+    ):
+        if isinstance(instance, model):
+            return source, str(instance.pk)
+    return None
+
+
+def knowledge_document(instance):
+    """
+    生成对象的索引文档
+
+    参数:
+    - instance: GroupMessage、messaging.Message、Task 或 AgentSkill 实例
+
+    返回:
+    - (范围标记, 标题, 正文)，不需要收录时（非文本消息、私聊消息）返回None
+    """
+    if isinstance(instance, GroupMessage):
+        if instance.message_type != GroupMessage.MessageType.TEXT:
+            return None
+        content = instance.content
+        return scope_for(instance.group_id), '', content.get('text', '') if isinstance(content, dict) else str(content)
+    if isinstance(instance, Message):
+        # 私聊消息不进入共享的知识索引
+        if instance.message_type != Message.MessageType.CHAT or not instance.group_id:
+            return None
+        content = instance.content
+        return scope_for(instance.group_id), '', content.get('text', '') if isinstance(content, dict) else str(content)
+    if isinstance(instance, Task):
+        # 不属于群组的任务只对创建者可见，不能进入公共范围
+        scope = scope_for(instance.group_id) if instance.group_id else private_scope(instance.creator_id)
+        return scope, instance.title, instance.description
+    if isinstance(instance, AgentSkill):
+        return GLOBAL_SCOPE, instance.name, instance.description or ''
+    return None
+
+
+class KnowledgeIndex:
+    """
+    基于SQLite FTS5的知识索引
+
+    数据说明:
+    - documents 表保存原文和分词结果，documents_fts 为其全文索引
+    - _pending: 等待写线程提交的变更，(来源, 对象ID) 相同的变更只保留最后一个
+    """
+
+    def __init__(self, path):
+        """
+        参数:
+        - path: 索引文件路径
+        """
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}
+        self._writing = False
+        self._local = threading.local()
+        self._connection = None
+        self._thread = None
+        self._running = False
+
+    @classmethod
+    def from_settings(cls):
+        """
+        按 RULE_ENGINE_CONFIG['KNOWLEDGE_INDEX_PATH'] 创建索引
+
+        返回:
+        - KnowledgeIndex实例，未配置路径时返回None
+        """
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        path = config.get('KNOWLEDGE_INDEX_PATH')
+        return cls(path) if path else None
+
+    @property
+    def running(self):
+        """索引是否已打开"""
+        return self._running
+
+    def _connect(self):
+        """打开一个连接"""
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def open(self):
+        """创建索引表并启动写线程"""
+        with self._lock:
+            if self._running:
+                return
+            connection = self._connect()
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='knowledge-index', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+        logger.info(f"知识索引已打开: {self.path}")
+
+    def close(self):
+        """提交剩余的变更并关闭索引"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._has_work.notify()
+        self._thread.join(timeout=10.0)
+        self._thread = None
+        self._connection.close()
+        self._connection = None
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def upsert(self, source, object_id, scope, title, body):
+        """
+        添加或更新一个文档（在写线程中提交）
+
+        参数:
+        - source: 文档来源
+        - object_id: 对象ID
+        - scope: 范围标记（scope_for、private_scope 或 GLOBAL_SCOPE）
+        - title: 标题
+        - body: 正文
+        """
+        self._enqueue((source, str(object_id)), (scope, title or '', body or ''))
+
+    def index(self, instance):
+        """
+        按对象的当前内容更新索引（信号和重建命令调用）
+
+        参数:
+        - instance: 索引收录的模型实例
+        """
+        key = document_key(instance)
+        if key is None:
+            return
+        document = knowledge_document(instance)
+        if document is None:
+            self.delete(*key)
+        else:
+            self.upsert(*key, *document)
+
+    def delete(self, source, object_id):
+        """
+        删除一个文档（在写线程中提交）
+
+        参数:
+        - source: 文档来源
+        - object_id: 对象ID
+        """
+        self._enqueue((source, str(object_id)), None)
+
+    def _enqueue(self, key, document):
+        """放入待提交的变更，索引未打开时忽略"""
+        with self._lock:
+            if not self._running:
+                return
+            self._pending[key] = document
+            self._has_work.notify()
+
+    def flush(self, timeout=10.0):
+        """
+        等待已缓冲的变更全部提交
+
+        返回:
+        - 是否在超时前提交完成
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def _run(self):
+        """写线程：每次取出一批变更，分词后在一个事务中提交"""
+        while True:
+            with self._lock:
+                while self._running and not self._pending:
+                    self._has_work.wait()
+                if not self._pending:
+                    self._idle.notify_all()
+                    return
+                keys = list(self._pending)[:WRITE_BATCH_SIZE]
+                batch = [(key, self._pending.pop(key)) for key in keys]
+                self._writing = True
+
+            try:
+                self._commit(batch)
+            finally:
+                with self._lock:
+                    self._writing = False
+                    if not self._pending:
+                        self._idle.notify_all()
+
+    def _commit(self, batch):
+        """提交一批变更"""
+        rows = []
+        deletes = []
+        for (source, object_id), document in batch:
+            if document is None:
+                deletes.append((source, object_id))
+                continue
+            scope, title, body = document
+            rows.append((
+                source, object_id, scope, title, body,
+                ' '.join(tokenize(title)), ' '.join(tokenize(body))
+            ))
+
+        connection = self._connection
+        try:
+            connection.execute('BEGIN')
+            if deletes:
+                connection.executemany('DELETE FROM documents WHERE source = ? AND object_id = ?', deletes)
+            if rows:
+                connection.executemany(
+                    'INSERT INTO documents (source, object_id, scope, title, body, title_tokens, body_tokens) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (source, object_id) DO UPDATE SET '
+                    'scope = excluded.scope, title = excluded.title, body = excluded.body, '
+                    'title_tokens = excluded.title_tokens, body_tokens = excluded.body_tokens',
+                    rows
+                )
+            connection.execute('COMMIT')
+        except sqlite3.Error as e:
+            logger.error(f"写入知识索引失败: {str(e)}", exc_info=True)
+            try:
+                connection.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+
+    def search(self, query, group_id=None, sources=None, limit=DEFAULT_SEARCH_LIMIT, exclude=None):
+        """
+        搜索知识索引
+
+        参数:
+        - query: 查询文本
+        - group_id: 群组ID；指定时只返回该群组和公共的文档，为空时只返回公共文档
+        - sources: 只返回这些来源的文档（可选）
+        - limit: 最多返回的结果数量
+        - exclude: 不返回的文档，(来源, 对象ID) 列表（如触发搜索的消息本身）
+
+        返回:
+        - 按相关度排序的结果列表，每项包含 source、object_id、title、snippet、score
+        """
+        if not self._running:
+            return []
+        terms = list(dict.fromkeys(tokenize(query, for_search=True)))
+        if not terms:
+            return []
+
+        expression = '{title_tokens body_tokens} : (' + ' OR '.join(_quote(term) for term in terms) + ')'
+        if group_id:
+            expression += f' AND scope : ({_quote(scope_for(group_id))} OR {_quote(GLOBAL_SCOPE)})'
+        else:
+            expression += f' AND scope : {_quote(GLOBAL_SCOPE)}'
+
+        sql = (
+            f'SELECT d.source, d.object_id, d.title, d.body, '
+            f'bm25(documents_fts, {TITLE_WEIGHT}, {BODY_WEIGHT}, 0.0) AS rank '
+            'FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid '
+            'WHERE documents_fts MATCH ?'
+        )
+        params = [expression]
+        if sources:
+            sql += f" AND d.source IN ({', '.join('?' for _ in sources)})"
+            params.extend(sources)
+        for source, object_id in exclude or ():
+            sql += ' AND NOT (d.source = ? AND d.object_id = ?)'
+            params.extend((source, str(object_id)))
+        sql += ' ORDER BY rank LIMIT ?'
+        params.append(limit)
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        try:
+            rows = connection.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"搜索知识索引失败: {str(e)}", exc_info=True)
+            return []
+
+        return [
+            {
+                'source': source,
+                'object_id': object_id,
+                'title': title,
+                'snippet': make_snippet(body or title, terms),
+                'score': round(-rank, 4),
+            }
+            for source, object_id, title, body, rank in rows
+        ]
+
+
+# 全局实例（未配置路径时为None）
+knowledge_index = KnowledgeIndex.from_settings()
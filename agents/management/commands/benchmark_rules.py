@@ -0,0 +1,138 @@
+"""
+规则引擎吞吐量基准测试
+
+以试运行模式把存储的历史消息（groups.GroupMessage 和 messaging.Message）
+逐条送入规则引擎，不产生触发统计、冷却和交互记录等副作用，
+报告每秒处理消息数、单条消息延迟分位数和各规则的触发次数。
+
+用法示例:
+    python manage.py benchmark_rules --limit 10000
+    python manage.py benchmark_rules --source group --warmup 200 --profile
+"""
+
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agents.context_store import GroupContextStore
+from agents.rule_index import rule_index
+from agents.rule_profiler import rule_profiler
+from agents.services import RuleEngine
+from groups.models import GroupMessage
+from messaging.models import Message
+
+
+class Command(BaseCommand):
+    help = '以试运行模式回放历史消息，测量规则引擎的吞吐量和延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            choices=['all', 'group', 'messaging'],
+            default='all',
+            help='消息来源：group（群组消息）、messaging（消息中心）或all，默认all'
+        )
+        parser.add_argument('--limit', type=int, help='每个来源最多读取的消息数量')
+        parser.add_argument('--warmup', type=int, default=100, help='预热消息数量，不计入结果，默认100')
+        parser.add_argument('--top', type=int, default=20, help='显示触发次数最多的规则数量，默认20')
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            help='同时开启规则级性能分析，输出耗时最多的规则'
+        )
+
+    def handle(self, *args, **options):
+        if options['warmup'] < 0:
+            raise CommandError('--warmup不能小于0')
+
+        # 规则索引和自动机在计时开始前构建
+        rule_index.rebuild()
+        rule_index.get_keyword_automaton()
+        rule_index.get_regex_prefilter()
+
+        profiling_was_enabled = rule_profiler.enabled
+        if options['profile']:
+            rule_profiler.reset()
+            rule_profiler.enable()
+
+        latencies = []
+        fired_rules = Counter()
+        warmup = options['warmup']
+        context_store = GroupContextStore()
+
+        try:
+            for message in self._stream_messages(options['source'], options['limit']):
+                started = time.perf_counter()
+                responses = RuleEngine.process_batch(
+                    [message], dry_run=True, context_store=context_store
+                )[0]
+                elapsed = time.perf_counter() - started
+
+                if warmup:
+                    warmup -= 1
+                    if warmup == 0 and options['profile']:
+                        rule_profiler.reset()
+                    continue
+
+                latencies.append(elapsed)
+                for response in responses:
+                    metadata = response.get('rule_metadata', {})
+                    fired_rules[f"{metadata.get('rule_name')} (ID: {metadata.get('rule_id')})"] += 1
+        finally:
+            if options['profile'] and not profiling_was_enabled:
+                rule_profiler.disable()
+
+        self._report(latencies, fired_rules, options)
+
+    def _stream_messages(self, source, limit):
+        """按时间顺序逐条读取历史消息并转换为规则引擎格式"""
+        querysets = []
+        if source in ('all', 'group'):
+            querysets.append(
+                GroupMessage.objects.filter(message_type=GroupMessage.MessageType.TEXT)
+                .prefetch_related('mentioned_agents').order_by('timestamp', 'id')
+            )
+        if source in ('all', 'messaging'):
+            querysets.append(
+                Message.objects.filter(message_type=Message.MessageType.CHAT)
+                .prefetch_related('mentioned_agents').order_by('created_at', 'id')
+            )
+
+        for queryset in querysets:
+            if limit:
+                queryset = queryset[:limit]
+            for stored_message in queryset.iterator(chunk_size=500):
+                yield RuleEngine.message_from_group_message(stored_message)
+
+    def _report(self, latencies, fired_rules, options):
+        """输出基准测试结果"""
+        if not latencies:
+            self.stdout.write(self.style.WARNING('没有可用于测试的消息'))
+            return
+
+        latencies.sort()
+        total = sum(latencies)
+        count = len(latencies)
+
+        def percentile(q):
+            return latencies[min(count - 1, int(q * count))] * 1000
+
+        self.stdout.write(f"消息数量: {count}")
+        self.stdout.write(f"规则引擎耗时: {total:.3f} 秒")
+        self.stdout.write(f"吞吐量: {count / total if total else 0:.1f} 条/秒")
+        self.stdout.write(
+            f"单条延迟: p50 {percentile(0.5):.3f} ms, p99 {percentile(0.99):.3f} ms, "
+            f"最大 {latencies[-1] * 1000:.3f} ms"
+        )
+        self.stdout.write(f"规则触发总数: {sum(fired_rules.values())}")
+        for rule_name, fire_count in fired_rules.most_common(options['top']):
+            self.stdout.write(f"  {rule_name}: {fire_count}")
+
+        if options['profile']:
+            self.stdout.write('耗时最多的规则:')
+            for item in rule_profiler.report(sort_by='total_ms', limit=10)['rules']:
+                self.stdout.write(
+                    f"  {item['rule_name']} ({item['trigger_type']}): "
+                    f"总计 {item['total_ms']} ms, p99 {item['p99_ms']} ms, 命中率 {item['hit_ratio']}"
+                )
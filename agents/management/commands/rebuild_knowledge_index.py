@@ -0,0 +1,61 @@
+"""
+把已有的消息、任务和代理技能导入知识索引
+
+索引上线后由信号增量维护，这个命令只用于首次导入或索引文件丢失后重建。
+
+用法示例:
+    python manage.py rebuild_knowledge_index --source group_message --batch-size 1000
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agents.knowledge_index import (
+    knowledge_index, SOURCE_GROUP_MESSAGE, SOURCE_MESSAGE, SOURCE_TASK, SOURCE_SKILL
+)
+from agents.models import AgentSkill
+from groups.models import GroupMessage
+from messaging.models import Message
+from task_management.models import Task
+
+
+class Command(BaseCommand):
+    help = '把已有的消息、任务和代理技能导入知识索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            choices=['all', SOURCE_GROUP_MESSAGE, SOURCE_MESSAGE, SOURCE_TASK, SOURCE_SKILL],
+            default='all',
+            help='导入的数据来源，默认all'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批导入的对象数量，默认1000')
+
+    def handle(self, *args, **options):
+        if knowledge_index is None:
+            raise CommandError("未配置 RULE_ENGINE_CONFIG['KNOWLEDGE_INDEX_PATH']")
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError('--batch-size必须大于0')
+
+        querysets = {
+            SOURCE_GROUP_MESSAGE: GroupMessage.objects.filter(message_type=GroupMessage.MessageType.TEXT),
+            SOURCE_MESSAGE: Message.objects.filter(message_type=Message.MessageType.CHAT, group__isnull=False),
+            SOURCE_TASK: Task.objects.all(),
+            SOURCE_SKILL: AgentSkill.objects.all(),
+        }
+        if options['source'] != 'all':
+            querysets = {options['source']: querysets[options['source']]}
+
+        knowledge_index.open()
+        for source, queryset in querysets.items():
+            count = 0
+            for instance in queryset.order_by('pk').iterator(chunk_size=batch_size):
+                knowledge_index.index(instance)
+                count += 1
+                # 每批等待写线程提交，避免缓冲区无限增长
+                if count % batch_size == 0:
+                    knowledge_index.flush(timeout=None)
+            knowledge_index.flush(timeout=None)
+            self.stdout.write(f"{source}: 导入 {count} 条")
+
+        self.stdout.write(self.style.SUCCESS('知识索引导入完成'))
@@ -0,0 +1,100 @@
+"""
+回放群组历史消息，用当前的监听规则批量评估
+
+用法示例:
+    python manage.py replay_rules --group 3 --since 2024-01-01 --dry-run
+"""
+
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+from agents.context_store import GroupContextStore
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+from groups.models import GroupMessage
+
+
+class Command(BaseCommand):
+    help = '用当前的监听规则回放群组历史消息'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help='只回放指定群组的消息')
+        parser.add_argument('--since', help='起始时间（ISO格式日期或时间）')
+        parser.add_argument('--until', help='结束时间（ISO格式日期或时间）')
+        parser.add_argument('--limit', type=int, help='最多回放的消息数量')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批处理的消息数量，默认500')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='试运行，只统计匹配结果，不记录触发统计和交互'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError('--batch-size必须大于0')
+
+        queryset = GroupMessage.objects.filter(
+            message_type=GroupMessage.MessageType.TEXT
+        ).prefetch_related('mentioned_agents').order_by('timestamp', 'id')
+
+        if options['group']:
+            queryset = queryset.filter(group_id=options['group'])
+        if options['since']:
+            queryset = queryset.filter(timestamp__gte=self._parse_time(options['since'], '--since'))
+        if options['until']:
+            queryset = queryset.filter(timestamp__lte=self._parse_time(options['until'], '--until'))
+        if options['limit']:
+            queryset = queryset[:options['limit']]
+
+        # 回放使用独立的上下文窗口，跨批次保留历史消息的上下文，不影响线上消息
+        self.context_store = GroupContextStore()
+
+        message_count = 0
+        response_count = 0
+        fired_rules = Counter()
+
+        batch = []
+        for group_message in queryset.iterator(chunk_size=batch_size):
+            batch.append(RuleEngine.message_from_group_message(group_message))
+            if len(batch) >= batch_size:
+                response_count += self._process(batch, options['dry_run'], fired_rules)
+                message_count += len(batch)
+                batch = []
+        if batch:
+            response_count += self._process(batch, options['dry_run'], fired_rules)
+            message_count += len(batch)
+
+        if not options['dry_run']:
+            rule_stats.flush()
+
+        self.stdout.write(f"回放消息 {message_count} 条，规则响应 {response_count} 个")
+        for rule_name, count in fired_rules.most_common():
+            self.stdout.write(f"  {rule_name}: {count}")
+        self.stdout.write(self.style.SUCCESS('回放完成' + ('（试运行）' if options['dry_run'] else '')))
+
+    def _process(self, batch, dry_run, fired_rules):
+        """处理一批消息，返回响应数量"""
+        results = RuleEngine.process_batch(batch, dry_run=dry_run, context_store=self.context_store)
+        count = 0
+        for responses in results:
+            for response in responses:
+                metadata = response.get('rule_metadata', {})
+                fired_rules[f"{metadata.get('rule_name')} (ID: {metadata.get('rule_id')})"] += 1
+                count += 1
+        return count
+
+    def _parse_time(self, value, option):
+        """解析日期或时间参数"""
+        parsed = parse_datetime(value)
+        if parsed is None:
+            date = parse_date(value)
+            if date is None:
+                raise CommandError(f'{option}格式无效: {value}')
+            parsed = timezone.datetime.combine(date, timezone.datetime.min.time())
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
@@ -0,0 +1,289 @@
+"""
+规则匹配器
+
+提供规则引擎在热路径上使用的共享匹配结构:
+- KeywordAutomaton: 基于Aho-Corasick算法的多关键词自动机，
+  由所有激活的关键词规则（以及上下文规则中的keyword条目）共同构建，
+  一次扫描即可得到所有命中的规则
+- 正则表达式缓存: compile_pattern 对每个模式只编译一次；
+  required_literals 从模式中提取必须出现的字面子串，
+  由所有正则规则的字面子串构建的区分大小写的自动机作为预过滤器，
+  文本中不包含任何必需子串的正则规则无需执行
+- KeywordScanner: 单条消息范围内的扫描器，按文本缓存扫描结果
+"""
+
+import logging
+import re
+from collections import deque
+from functools import lru_cache
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+logger = logging.getLogger(__name__)
+
+
+class KeywordAutomaton:
+    """
+    多关键词自动机（Aho-Corasick）
+
+    每个关键词关联一个所有者（如规则ID），扫描文本时返回所有命中关键词的所有者集合。
+    默认不区分大小写，扫描代价与文本长度成正比，与关键词数量无关。
+    """
+
+    def __init__(self, entries=(), case_sensitive=False):
+        """
+        参数:
+        - entries: (关键词, 所有者) 二元组的可迭代对象
+        - case_sensitive: 是否区分大小写，默认不区分
+        """
+        self.case_sensitive = case_sensitive
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+        # 空关键词与任何文本都匹配（与 '' in text 的语义一致）
+        self._always = set()
+        self.size = 0
+
+        for keyword, owner in entries:
+            self._add(keyword, owner)
+        self._build()
+
+    def _add(self, keyword, owner):
+        """向字典树中添加一个关键词"""
+        if not isinstance(keyword, str):
+            logger.debug(f"忽略非字符串关键词: {keyword!r}")
+            return
+
+        if not self.case_sensitive:
+            keyword = keyword.lower()
+        self.size += 1
+        if not keyword:
+            self._always.add(owner)
+            return
+
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+                self._goto[node][char] = next_node
+            node = next_node
+        self._output[node].add(owner)
+
+    def _build(self):
+        """按广度优先顺序计算失败指针，并合并输出集合"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                candidate = self._goto[fail].get(char, 0)
+                self._fail[child] = candidate if candidate != child else 0
+                self._output[child] |= self._output[self._fail[child]]
+
+        # 输出集合构建完成后转为不可变对象，扫描时可安全共享
+        self._output = [frozenset(output) for output in self._output]
+
+    def scan(self, text):
+        """
+        扫描文本
+
+        参数:
+        - text: 待扫描的文本
+
+        返回:
+        - 命中关键词的所有者集合
+        """
+        hits = set(self._always)
+        if not text:
+            return hits
+
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        if not self.case_sensitive:
+            text = text.lower()
+
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                hits |= output[node]
+        return hits
+
+
+# 正则表达式编译缓存的容量，需大于所有激活规则的模式数量
+PATTERN_CACHE_SIZE = 4096
+
+_REPEAT_OPS = {
+    getattr(sre_constants, name)
+    for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_constants, name)
+}
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern, flags=0):
+    """
+    编译正则表达式并缓存结果
+
+    参数:
+    - pattern: 正则表达式字符串
+    - flags: 正则表达式标志
+
+    返回:
+    - 已编译的正则表达式对象
+
+    异常:
+    - re.error: 正则表达式无效
+    """
+    return re.compile(pattern, flags)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def required_literals(pattern, flags=0):
+    """
+    提取正则表达式匹配时必须出现的字面子串
+
+    返回的子串之间是"任一"关系：文本中不包含其中任何一个时，模式一定不匹配。
+    忽略大小写的模式不做提取。
+
+    参数:
+    - pattern: 正则表达式字符串
+    - flags: 正则表达式标志
+
+    返回:
+    - 字面子串元组，为空表示无法提取（不能预过滤）
+
+    异常:
+    - re.error: 正则表达式无效
+    """
+    if flags & re.IGNORECASE:
+        return ()
+
+    parsed = sre_parse.parse(pattern, flags)
+    if parsed.state.flags & re.IGNORECASE:
+        return ()
+    return tuple(_sequence_literals(parsed) or ())
+
+
+def _sequence_literals(items):
+    """
+    在一个顺序序列中选出最具区分度的必需字面子串集合
+
+    序列中的每一项都必须匹配，因此任一项的必需子串都是整个序列的必需子串；
+    在候选中选择最短子串最长的一组。
+    """
+    best = None
+    run = []
+
+    def consider(candidate):
+        nonlocal best
+        if candidate and all(candidate) and (
+            best is None or min(map(len, candidate)) > min(map(len, best))
+        ):
+            best = candidate
+
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+
+        if run:
+            consider([''.join(run)])
+            run = []
+
+        if op == sre_constants.SUBPATTERN:
+            _group, add_flags, _del_flags, sub_pattern = av
+            if not add_flags & re.IGNORECASE:
+                consider(_sequence_literals(sub_pattern))
+        elif op in _REPEAT_OPS:
+            min_repeat, _max_repeat, sub_pattern = av
+            if min_repeat >= 1:
+                consider(_sequence_literals(sub_pattern))
+        elif op == sre_constants.BRANCH:
+            alternatives = []
+            for branch in av[1]:
+                literals = _sequence_literals(branch)
+                if not literals:
+                    alternatives = None
+                    break
+                alternatives.extend(literals)
+            consider(alternatives)
+        elif op == getattr(sre_constants, 'ATOMIC_GROUP', None):
+            consider(_sequence_literals(av))
+
+    if run:
+        consider([''.join(run)])
+    return best
+
+
+class KeywordScanner:
+    """
+    单条消息范围内的关键词扫描器
+
+    同一段文本（消息内容或上下文内容）只扫描一次，
+    之后所有关键词规则都直接查询缓存的命中集合；
+    提供正则预过滤自动机时，正则规则同样只查询候选集合。
+    """
+
+    def __init__(self, automaton, regex_prefilter=None):
+        """
+        参数:
+        - automaton: 关键词自动机（KeywordAutomaton实例）
+        - regex_prefilter: 可选的正则预过滤自动机（区分大小写的KeywordAutomaton实例）
+        """
+        self._automaton = automaton
+        self._regex_prefilter = regex_prefilter
+        self._cache = {}
+        self._regex_cache = {}
+
+    def hits(self, text):
+        """
+        获取文本的关键词命中集合
+
+        参数:
+        - text: 待扫描的文本
+
+        返回:
+        - 命中关键词的所有者集合
+        """
+        text = text or ''
+        hits = self._cache.get(text)
+        if hits is None:
+            hits = self._automaton.scan(text)
+            self._cache[text] = hits
+        return hits
+
+    def regex_candidates(self, text):
+        """
+        获取文本可能匹配的正则规则集合
+
+        参数:
+        - text: 待匹配的文本
+
+        返回:
+        - 可能匹配的所有者集合，未提供预过滤自动机时返回None（不过滤）
+        """
+        if self._regex_prefilter is None:
+            return None
+
+        text = text or ''
+        candidates = self._regex_cache.get(text)
+        if candidates is None:
+            candidates = self._regex_prefilter.scan(text)
+            self._regex_cache[text] = candidates
+        return candidates
@@ -0,0 +1,103 @@
+"""
+运行时指标工具
+
+提供进程内的延迟直方图，供规则性能分析等模块记录耗时分布。
+"""
+
+import bisect
+import threading
+
+# 直方图桶上界（秒），覆盖 50 微秒 到 10 秒
+DEFAULT_LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class LatencyHistogram:
+    """
+    固定桶的延迟直方图
+
+    记录样本数、总耗时、最大值以及各桶计数，分位数按桶内线性插值估算。
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        参数:
+        - buckets: 递增的桶上界（秒），最后一个桶之上的样本计入溢出桶
+        """
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        记录一个样本
+
+        参数:
+        - value: 耗时（秒）
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        估算分位数
+
+        参数:
+        - q: 分位（0到1之间）
+
+        返回:
+        - 估算的耗时（秒），没有样本时返回0
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+            maximum = self.max
+
+        if not count:
+            return 0.0
+
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if not bucket_count:
+                continue
+            if cumulative + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else maximum
+                fraction = (rank - cumulative) / bucket_count
+                return min(lower + (upper - lower) * fraction, maximum)
+            cumulative += bucket_count
+        return maximum
+
+    @property
+    def mean(self):
+        """平均耗时（秒）"""
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        """
+        导出统计摘要
+
+        返回:
+        - 包含样本数、平均值、分位数和最大值（毫秒）的字典
+        """
+        return {
+            'count': self.count,
+            'total_ms': round(self.total * 1000, 3),
+            'mean_ms': round(self.mean * 1000, 3),
+            'p50_ms': round(self.quantile(0.5) * 1000, 3),
+            'p90_ms': round(self.quantile(0.9) * 1000, 3),
+            'p99_ms': round(self.quantile(0.99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
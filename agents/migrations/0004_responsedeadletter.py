@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0003_alter_agentlisteningrule_trigger_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseDeadLetter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(choices=[('channel', '群组推送'), ('handler', '处理函数')], max_length=20, verbose_name='发送阶段')),
+                ('response_type', models.CharField(blank=True, max_length=50, verbose_name='响应类型')),
+                ('response', models.JSONField(verbose_name='响应内容')),
+                ('context', models.JSONField(default=dict, verbose_name='上下文')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='尝试次数')),
+                ('last_error', models.TextField(blank=True, verbose_name='错误信息')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('replayed_at', models.DateTimeField(blank=True, null=True, verbose_name='重放时间')),
+            ],
+            options={
+                'verbose_name': '响应死信',
+                'verbose_name_plural': '响应死信',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agents', '0004_responsedeadletter'),
+        ('groups', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('summary', models.TextField(blank=True, verbose_name='摘要')),
+                ('state', models.JSONField(blank=True, default=dict, verbose_name='摘要状态')),
+                ('last_group_message_id', models.BigIntegerField(default=0, verbose_name='最后总结的群组消息ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True, verbose_name='最后总结的消息时间')),
+                ('last_message_id', models.UUIDField(blank=True, null=True, verbose_name='最后总结的消息ID')),
+                ('message_count', models.PositiveIntegerField(default=0, verbose_name='已总结消息数')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summary', to='groups.group', verbose_name='群组')),
+            ],
+            options={
+                'verbose_name': '对话摘要',
+                'verbose_name_plural': '对话摘要',
+            },
+        ),
+    ]
@@ -7,8 +7,20 @@ from django.utils import timezone
 import re
 import logging
 
+from .features import MessageFeatures
+from .matchers import compile_pattern
+from .rule_stats import rule_stats
+
 logger = logging.getLogger(__name__)
 
+# 上下文感知规则中各类条件的评估顺序（按耗时从低到高）
+CONTEXT_RULE_COST_ORDER = {
+    'keyword': 0,
+    'regex': 1,
+    'sentiment': 2,
+    'topic': 3,
+}
+
 class Agent(models.Model):
     """
     AI代理模型，定义代理的角色、技能和权限
@@ -430,25 +442,118 @@ class AgentListeningRule(models.Model):
     
     def __str__(self):
         return f"{self.name} ({self.agent.name})"
-    
+
+    # 由规则触发统计（agents.rule_stats）以 F() 表达式批量写回的字段
+    STATS_FIELDS = ('trigger_count', 'last_triggered')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """从数据库加载规则，记录读取时的最近触发时间"""
+        instance = super().from_db(db, field_names, values)
+        if 'last_triggered' in instance.__dict__:
+            instance._saved_last_triggered = instance.last_triggered
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        保存规则前编译并校验正则表达式，无效的模式不允许保存
+
+        只更新其他字段时（如启停规则、写回触发统计）不校验，
+        已保存的带有无效模式的旧规则仍然可以被禁用。
+
+        已有规则的完整保存不写入触发统计字段：trigger_count 只由统计写回累加，
+        last_triggered 只在调用方修改了读取时的值（如重置冷却）时写入，
+        避免管理后台或API用读取时的旧值覆盖后台写回的统计
+        """
+        if kwargs.get('update_fields') is None and not self._state.adding and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.STATS_FIELDS
+                and field.attname not in deferred
+            ]
+            if hasattr(self, '_saved_last_triggered') and self.last_triggered != self._saved_last_triggered:
+                update_fields.append('last_triggered')
+            kwargs['update_fields'] = update_fields
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'trigger_type', 'trigger_condition'} & set(update_fields):
+            self.validate_patterns()
+        super().save(*args, **kwargs)
+        if update_fields is None or 'last_triggered' in update_fields:
+            self._saved_last_triggered = self.last_triggered
+
+    def clean(self):
+        """验证模型数据"""
+        self.validate_patterns()
+
+    def get_patterns(self):
+        """
+        获取触发条件中的所有正则表达式
+
+        返回:
+        - 正则表达式列表（正则规则的pattern及上下文规则中regex类型条目的value）
+        """
+        condition = self.trigger_condition if isinstance(self.trigger_condition, dict) else {}
+        patterns = []
+
+        if self.trigger_type == self.TriggerType.REGEX and 'pattern' in condition:
+            patterns.append(condition['pattern'])
+        elif self.trigger_type == self.TriggerType.CONTEXT_AWARE:
+            for rule in condition.get('context_rules') or []:
+                if isinstance(rule, dict) and rule.get('type') == 'regex':
+                    patterns.append(rule.get('value', ''))
+
+        return patterns
+
+    def validate_patterns(self):
+        """
+        编译触发条件中的正则表达式，编译结果进入共享缓存
+
+        异常:
+        - ValidationError: 存在无效的正则表达式
+        """
+        from django.core.exceptions import ValidationError
+
+        errors = []
+        for pattern in self.get_patterns():
+            if not isinstance(pattern, str):
+                errors.append(_('正则表达式必须是字符串: {}').format(pattern))
+                continue
+            try:
+                compile_pattern(pattern)
+            except re.error as e:
+                errors.append(_('无效的正则表达式 {}: {}').format(pattern, e))
+
+        if errors:
+            raise ValidationError({'trigger_condition': errors})
+
     def is_on_cooldown(self):
-        """检查规则是否处于冷却期"""
-        if not self.cooldown_period or not self.last_triggered:
+        """检查规则是否处于冷却期（最近触发时间以进程内统计为准，无需读取数据库）"""
+        if not self.cooldown_period:
             return False
         
-        cooldown_ends_at = self.last_triggered + timedelta(seconds=self.cooldown_period)
+        last_triggered = rule_stats.get_last_triggered(self)
+        if not last_triggered:
+            return False
+        
+        cooldown_ends_at = last_triggered + timedelta(seconds=self.cooldown_period)
         return timezone.now() < cooldown_ends_at
     
     def can_trigger(self):
         """检查规则是否可以触发"""
         return self.is_active and not self.is_on_cooldown()
     
-    def match_message(self, message):
+    def match_message(self, message, keyword_scanner=None, features=None):
         """
         检查消息是否匹配规则条件
         
         参数:
         - message: 消息对象，包含消息内容、发送者、接收者等信息
+        - keyword_scanner: 可选的共享关键词扫描器（KeywordScanner），
+          由规则引擎传入时关键词类条件直接查询一次扫描的命中结果
+        - features: 可选的消息特征（MessageFeatures），由规则引擎传入时
+          所有规则共享同一份惰性计算的特征，未提供时为本次匹配单独创建
         
         返回:
         - 布尔值，表示是否匹配
@@ -456,30 +561,50 @@ class AgentListeningRule(models.Model):
         if not self.can_trigger():
             return False
             
+        return self.match_conditions(message, keyword_scanner, features)
+    
+    def match_conditions(self, message, keyword_scanner=None, features=None):
+        """
+        只检查触发条件是否匹配，不检查激活状态和冷却时间
+        
+        供进程池工作进程使用：冷却状态只在主进程中维护，由主进程在执行响应前检查
+        
+        参数同 match_message
+        
+        返回:
+        - 布尔值，表示是否匹配
+        """
+        if features is None:
+            features = MessageFeatures(message)
+            
         # 根据不同的触发类型进行匹配
         if self.trigger_type == self.TriggerType.KEYWORD:
-            return self._match_keyword(message)
+            return self._match_keyword(message, features, keyword_scanner)
         elif self.trigger_type == self.TriggerType.REGEX:
-            return self._match_regex(message)
+            return self._match_regex(message, features, keyword_scanner)
         elif self.trigger_type == self.TriggerType.MENTION:
-            return self._match_mention(message)
+            return self._match_mention(message, features)
         elif self.trigger_type == self.TriggerType.ALL_MESSAGES:
             return True
         elif self.trigger_type == self.TriggerType.SENTIMENT:
-            return self._match_sentiment(message)
+            return self._match_sentiment(message, features)
         elif self.trigger_type == self.TriggerType.CONTEXT_AWARE:
-            return self._match_context_aware(message)
+            return self._match_context_aware(message, features, keyword_scanner)
         elif self.trigger_type == self.TriggerType.CUSTOM:
-            return self._match_custom(message)
+            return self._match_custom(message, features)
         
         return False
     
-    def _match_keyword(self, message):
+    def _match_keyword(self, message, features, keyword_scanner=None):
         """关键词匹配"""
         if 'keywords' not in self.trigger_condition:
             return False
             
-        message_content = message.get('content', '').lower()
+        # 共享自动机已对消息内容扫描过一次，直接查询命中结果
+        if keyword_scanner is not None:
+            return self.id in keyword_scanner.hits(features.content)
+            
+        message_content = features.lower_content
         keywords = [k.lower() for k in self.trigger_condition['keywords']]
         
         for keyword in keywords:
@@ -487,49 +612,40 @@ class AgentListeningRule(models.Model):
                 return True
         return False
     
-    def _match_regex(self, message):
+    def _match_regex(self, message, features, keyword_scanner=None):
         """正则表达式匹配"""
         if 'pattern' not in self.trigger_condition:
             return False
             
-        message_content = message.get('content', '')
+        message_content = features.content
         pattern = self.trigger_condition['pattern']
         
+        # 文本中不包含模式的任何必需子串时，无需执行正则
+        if keyword_scanner is not None:
+            candidates = keyword_scanner.regex_candidates(message_content)
+            if candidates is not None and self.id not in candidates:
+                return False
+        
         try:
-            return bool(re.search(pattern, message_content))
-        except:
+            return bool(compile_pattern(pattern).search(message_content))
+        except (re.error, TypeError) as e:
+            logger.error(f"规则 {self.id} 的正则表达式无效: {pattern} ({e})")
             return False
     
-    def _match_mention(self, message):
-        """提及代理匹配"""
-        message_content = message.get('content', '').lower()
-        agent_name = self.agent.name.lower()
-        
-        # 检查是否明确提到了代理名称
-        if f"@{agent_name}" in message_content:
-            return True
-            
-        # 检查mentions字段（如果消息格式包含此字段）
-        mentions = message.get('mentions', [])
-        if str(self.agent.id) in mentions or self.agent.name in mentions:
-            return True
-            
-        return False
+    def _match_mention(self, message, features):
+        """提及代理匹配（提及的代理ID和"@名称"已由提及路由索引统一解析）"""
+        return str(self.agent_id) in features.mentioned_agent_ids
     
-    def _match_sentiment(self, message):
+    def _match_sentiment(self, message, features):
         """情绪分析匹配"""
         if 'target_sentiment' not in self.trigger_condition:
             return False
             
-        message_content = message.get('content', '')
-        
-        # 使用简单的情绪词典进行匹配
         target_sentiment = self.trigger_condition['target_sentiment']
         sentiment_threshold = self.trigger_condition.get('threshold', 0.5)
         
-        # 计算情绪得分（实际环境中应使用NLP服务）
-        from agents.utils.sentiment_analyzer import analyze_sentiment
-        sentiment_score = analyze_sentiment(message_content)
+        # 情绪得分在消息范围内只计算一次（实际环境中应使用NLP服务）
+        sentiment_score = features.sentiment
         
         if target_sentiment == 'positive':
             return sentiment_score >= sentiment_threshold
@@ -540,63 +656,67 @@ class AgentListeningRule(models.Model):
         
         return False
         
-    def _match_context_aware(self, message):
+    def _match_context_aware(self, message, features, keyword_scanner=None):
         """上下文感知匹配"""
         if 'context_rules' not in self.trigger_condition:
             return False
             
         context_rules = self.trigger_condition['context_rules']
-        message_content = message.get('content', '').lower()
-        context_messages = message.get('context_messages', [])
         
         # 获取配置参数
         context_size = self.trigger_condition.get('context_size', 5)  # 默认考虑最近5条消息
         time_window = self.trigger_condition.get('time_window', 300)  # 默认5分钟时间窗口
         match_threshold = self.trigger_condition.get('match_threshold', 0.7)  # 默认匹配阈值
         
-        # 确保上下文消息在时间窗口内
-        current_time = timezone.now()
-        valid_context = []
-        
-        for ctx_msg in context_messages[-context_size:]:
-            msg_time = timezone.datetime.fromisoformat(ctx_msg.get('timestamp', ''))
-            if (current_time - msg_time).total_seconds() <= time_window:
-                valid_context.append(ctx_msg)
+        # 合并时间窗口内的上下文消息内容（包含当前消息，相同窗口配置的规则共享结果）
+        context_content = features.context_content(context_size, time_window)
         
         # 如果没有有效的上下文消息，返回False
-        if not valid_context:
+        if context_content is None:
             return False
         
-        # 合并所有上下文消息内容
-        context_content = ' '.join([
-            msg.get('content', '').lower()
-            for msg in valid_context
-        ])
-        
-        # 评估每个上下文规则
+        # 评估每个上下文规则：耗时低的条件（关键词、正则）先评估，分数已经达到阈值、
+        # 或剩余条件全部满足也达不到阈值时提前结束，不再调用情感和主题分析
         matched_rules = 0
         total_rules = len(context_rules)
+        ordered_rules = sorted(
+            enumerate(context_rules),
+            key=lambda item: CONTEXT_RULE_COST_ORDER.get(item[1].get('type', 'keyword'), 0)
+        )
+        remaining_gain = sum(max(rule.get('weight', 1.0), 0) for rule in context_rules)
+        remaining_loss = sum(min(rule.get('weight', 1.0), 0) for rule in context_rules)
         
-        for rule in context_rules:
+        for position, rule in ordered_rules:
             rule_type = rule.get('type', 'keyword')
             rule_value = rule.get('value', '')
             rule_weight = rule.get('weight', 1.0)
+            if rule_weight > 0:
+                remaining_gain -= rule_weight
+            else:
+                remaining_loss -= rule_weight
             
             if rule_type == 'keyword':
                 # 关键词匹配
-                if rule_value.lower() in context_content:
+                if keyword_scanner is not None:
+                    keyword_found = (self.id, position) in keyword_scanner.hits(context_content)
+                else:
+                    keyword_found = rule_value.lower() in context_content
+                if keyword_found:
                     matched_rules += rule_weight
             elif rule_type == 'regex':
-                # 正则表达式匹配
-                try:
-                    if re.search(rule_value, context_content):
-                        matched_rules += rule_weight
-                except re.error:
-                    logger.error(f"无效的正则表达式: {rule_value}")
+                # 正则表达式匹配（预过滤自动机判定不可能匹配时跳过）
+                candidates = None
+                if keyword_scanner is not None:
+                    candidates = keyword_scanner.regex_candidates(context_content)
+                if candidates is None or (self.id, position) in candidates:
+                    try:
+                        if compile_pattern(rule_value).search(context_content):
+                            matched_rules += rule_weight
+                    except (re.error, TypeError):
+                        logger.error(f"无效的正则表达式: {rule_value}")
             elif rule_type == 'sentiment':
                 # 情感倾向匹配（需要情感分析服务）
-                from .utils.sentiment_analyzer import analyze_sentiment
-                sentiment_score = analyze_sentiment(context_content)
+                sentiment_score = features.context_sentiment(context_size, time_window)
                 if rule_value == 'positive' and sentiment_score > 0.3:
                     matched_rules += rule_weight
                 elif rule_value == 'negative' and sentiment_score < -0.3:
@@ -605,10 +725,14 @@ class AgentListeningRule(models.Model):
                     matched_rules += rule_weight
             elif rule_type == 'topic':
                 # 主题相关性匹配（需要主题分析服务）
-                from .utils.topic_analyzer import analyze_topic_similarity
-                topic_similarity = analyze_topic_similarity(context_content, rule_value)
+                topic_similarity = features.context_topic_similarity(context_size, time_window, rule_value)
                 if topic_similarity >= 0.5:  # 可配置的阈值
                     matched_rules += rule_weight
+            
+            if (matched_rules + remaining_loss) / total_rules >= match_threshold:
+                break
+            if (matched_rules + remaining_gain) / total_rules < match_threshold:
+                break
         
         # 计算最终匹配分数
         match_score = matched_rules / total_rules if total_rules > 0 else 0
@@ -618,26 +742,26 @@ class AgentListeningRule(models.Model):
         
         return match_score >= match_threshold
     
-    def _match_custom(self, message):
+    def _match_custom(self, message, features):
         """自定义条件匹配"""
         # 在实际应用中，可以实现自定义的匹配逻辑
         # 例如调用外部服务或使用更复杂的规则
         return False
     
-    def execute_response(self, message):
+    def execute_response(self, message, record_trigger=True):
         """
         执行规则定义的响应行为
         
         参数:
         - message: 消息对象，包含消息内容、发送者、接收者等信息
+        - record_trigger: 是否记录触发统计（试运行时为False，不影响冷却和计数）
         
         返回:
         - 响应结果
         """
-        # 更新统计信息
-        self.trigger_count += 1
-        self.last_triggered = timezone.now()
-        self.save(update_fields=['trigger_count', 'last_triggered', 'updated_at'])
+        # 更新统计信息（写入进程内统计，由后台线程批量写回数据库）
+        if record_trigger:
+            rule_stats.record_trigger(self)
         
         # 根据不同的响应类型执行不同的行为
         if self.response_type == self.ResponseType.AUTO_REPLY:
@@ -715,6 +839,7 @@ class AgentListeningRule(models.Model):
             'type': 'action',
             'action_name': self.response_content.get('action_name', ''),
             'action_params': self.response_content.get('action_params', {}),
+            'message_content': message.get('content', ''),  # 动作参数中没有查询词时使用触发消息的内容
             'agent_id': str(self.agent.id),  # 确保ID是字符串
             'agent_name': self.agent.name,
             'rule_id': str(self.id),  # 添加规则ID
@@ -738,3 +863,80 @@ class AgentListeningRule(models.Model):
             'message_id': message.get('id'),
             'timestamp': timezone.now().isoformat()
         }
+
+
+class ResponseDeadLetter(models.Model):
+    """
+    响应死信记录
+
+    异步消息处理器发送响应失败时按指数退避重试，重试次数用尽后记录在这里，
+    可在管理后台或接口中查看、重放或清除。
+
+    字段说明:
+    - stage: 失败的发送阶段（channel layer 群组推送或注册的处理函数）
+    - response_type: 响应类型
+    - response: 规则响应
+    - context: 上下文信息（只保留可序列化的字段）
+    - attempts: 已尝试的次数
+    - last_error: 最后一次失败的错误信息
+    - replayed_at: 重放成功的时间
+    """
+
+    class Stage(models.TextChoices):
+        CHANNEL = 'channel', _('群组推送')
+        HANDLER = 'handler', _('处理函数')
+
+    stage = models.CharField(_('发送阶段'), max_length=20, choices=Stage.choices)
+    response_type = models.CharField(_('响应类型'), max_length=50, blank=True)
+    response = models.JSONField(_('响应内容'))
+    context = models.JSONField(_('上下文'), default=dict)
+    attempts = models.PositiveIntegerField(_('尝试次数'), default=0)
+    last_error = models.TextField(_('错误信息'), blank=True)
+    created_at = models.DateTimeField(_('创建时间'), auto_now_add=True)
+    replayed_at = models.DateTimeField(_('重放时间'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('响应死信')
+        verbose_name_plural = _('响应死信')
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.get_stage_display()}: {self.response_type} ({self.attempts}次)"
+
+
+class ConversationSummary(models.Model):
+    """
+    群组对话的滚动摘要
+
+    由 summarize_conversation 动作增量更新：每次只读取水位之后的新消息，
+    与上次保留的候选句子一起重新抽取摘要。
+
+    字段说明:
+    - group: 所属群组
+    - summary: 摘要文本
+    - state: 抽取式摘要的状态（词频统计和候选句子）
+    - last_group_message_id: 已总结的最后一条群组消息（GroupMessage）ID
+    - last_message_at / last_message_id: 已总结的最后一条消息中心消息（messaging.Message）的时间和ID
+    - message_count: 已总结的消息数量
+    """
+
+    group = models.OneToOneField(
+        'groups.Group',
+        on_delete=models.CASCADE,
+        related_name='conversation_summary',
+        verbose_name=_('群组')
+    )
+    summary = models.TextField(_('摘要'), blank=True)
+    state = models.JSONField(_('摘要状态'), default=dict, blank=True)
+    last_group_message_id = models.BigIntegerField(_('最后总结的群组消息ID'), default=0)
+    last_message_at = models.DateTimeField(_('最后总结的消息时间'), null=True, blank=True)
+    last_message_id = models.UUIDField(_('最后总结的消息ID'), null=True, blank=True)
+    message_count = models.PositiveIntegerField(_('已总结消息数'), default=0)
+    updated_at = models.DateTimeField(_('更新时间'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('对话摘要')
+        verbose_name_plural = _('对话摘要')
+
+    def __str__(self):
+        return f"{self.group_id}: {self.message_count}条消息"
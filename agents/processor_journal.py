@@ -0,0 +1,382 @@
+"""
+异步消息处理器的本地持久化日志
+
+AsyncMessageProcessor 的队列只在内存中，Daphne 重启时队列中尚未处理的消息会丢失，
+正在处理的消息也会随守护线程一起中断。开启日志后：
+
+- 消息入队前先追加一条记录，处理结束（成功、出错或被丢弃）后追加完成标记
+- 处理器启动时按入队顺序重新放入所有没有完成标记的消息
+- 记录以消息ID为键：日志中已有该消息ID（处理中，或在 COMPLETED_RETENTION 秒内处理完）时
+  再次入队会被忽略，进程重启后重复投递的消息也不会重复处理
+- 每条记录标记写入它的进程（持有者）。持有者由写线程定期续约，
+  重放时只接管已关闭或租约（PROCESSOR_JOURNAL_LEASE 秒）过期的持有者的记录，
+  多个进程共用同一个日志文件时不会重放彼此正在处理的消息；
+  重放过的进程由写线程继续定期接管，之后才过期的持有者留下的消息不需要等到下次重启
+
+日志使用独立的SQLite文件（WAL模式），由一个写线程做组提交：
+写线程每次取出所有已缓冲的记录在一个事务中写入，一次fsync覆盖一批消息，
+入队方只等待自己所在的批次提交完成。
+
+开启方式: RULE_ENGINE_CONFIG['PROCESSOR_JOURNAL_PATH'] = 日志文件路径（为空表示关闭）
+"""
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 入队方等待所在批次提交的最长时间（秒），超时后不再等待，消息照常入队
+DEFAULT_COMMIT_TIMEOUT = 1.0
+
+# 每累计多少个完成标记清理一次已完成的记录
+COMPACT_EVERY = 1000
+
+# 已完成的记录至少保留的时间（秒），在此期间重复投递的消息会被忽略
+COMPLETED_RETENTION = 3600.0
+
+# 内存中记住的最近完成的消息ID数量，用于忽略重复入队
+RECENT_COMPLETED_SIZE = 10000
+
+# 持有者的默认租约（秒），超过该时间未续约视为进程已退出，其未完成的记录可被接管
+DEFAULT_LEASE_TIMEOUT = 30.0
+
+
+def json_safe(value):
+    """
+    去掉字典中无法序列化为JSON的字段（如 channel_layer）
+
+    参数:
+    - value: 消息、上下文等
+
+    返回:
+    - 可以序列化的值
+    """
+    if isinstance(value, dict):
+        return {key: item for key, item in value.items() if _is_serializable(item)}
+    return value
+
+
+def _to_json(value):
+    """序列化消息或上下文"""
+    return json.dumps(json_safe(value), ensure_ascii=False)
+
+
+def _is_serializable(value):
+    """判断值能否写入日志"""
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class _Batch:
+    """一次组提交包含的记录"""
+
+    __slots__ = ('appends', 'completions', 'duplicates', 'committed')
+
+    def __init__(self):
+        self.appends = []
+        self.completions = []
+        # 日志中已有记录的消息ID，由写线程在提交时填入
+        self.duplicates = set()
+        self.committed = threading.Event()
+
+
+class ProcessorJournal:
+    """
+    基于SQLite WAL的追加日志
+
+    数据说明:
+    - entries 表按 seq 保存入队记录，completed_at 为空表示尚未完成，owner 为写入或接管它的进程
+    - owners 表保存各持有者最近一次续约的时间
+    - _pending: 已入队且尚未完成的消息ID
+    - _completed: 最近完成的消息ID（有界）
+    - _recover_handler: 接管到的消息交给该函数重放，为None时写线程不接管
+    """
+
+    def __init__(self, path, commit_timeout=DEFAULT_COMMIT_TIMEOUT, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        """
+        参数:
+        - path: 日志文件路径
+        - commit_timeout: 入队方等待批次提交的最长时间（秒）
+        - lease_timeout: 持有者的租约（秒），写线程每隔三分之一租约续约一次
+        """
+        self.path = str(path)
+        self.commit_timeout = commit_timeout
+        self.lease_timeout = lease_timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        # 写线程和重放共用同一个连接，执行语句时持有该锁
+        self._db_lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._batch = _Batch()
+        self._pending = set()
+        self._completed = OrderedDict()
+        self._completions_since_compact = 0
+        self._renewed_at = 0.0
+        self._claimed_at = 0.0
+        self._recover_handler = None
+        self._connection = None
+        self._thread = None
+        self._running = False
+        self.batch_count = 0
+
+    @classmethod
+    def from_settings(cls):
+        """
+        按 RULE_ENGINE_CONFIG['PROCESSOR_JOURNAL_PATH'] 创建日志
+
+        返回:
+        - ProcessorJournal实例，未配置路径时返回None
+        """
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        path = config.get('PROCESSOR_JOURNAL_PATH')
+        if not path:
+            return None
+        return cls(path, lease_timeout=config.get('PROCESSOR_JOURNAL_LEASE', DEFAULT_LEASE_TIMEOUT))
+
+    def open(self):
+        """打开日志文件、登记本进程为持有者并启动写线程"""
+        with self._lock:
+            if self._running:
+                return
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'message_id TEXT NOT NULL UNIQUE, '
+                'lane TEXT NOT NULL, '
+                'message TEXT NOT NULL, '
+                'context TEXT NOT NULL, '
+                'created_at REAL NOT NULL, '
+                'completed_at REAL, '
+                'owner TEXT)'
+            )
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(entries)')}
+            if 'owner' not in columns:
+                connection.execute('ALTER TABLE entries ADD COLUMN owner TEXT')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, renewed_at REAL NOT NULL)'
+            )
+            self._renewed_at = time.time()
+            connection.execute(
+                'INSERT OR REPLACE INTO owners (owner, renewed_at) VALUES (?, ?)',
+                (self.owner, self._renewed_at)
+            )
+            self._connection = connection
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='processor-journal', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """写入剩余的记录并关闭日志文件"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._has_work.notify()
+        self._thread.join(timeout=5.0)
+        self._thread = None
+        with self._db_lock:
+            # 注销持有者，剩余的记录可由下一个启动的进程立即接管
+            try:
+                self._connection.execute('DELETE FROM owners WHERE owner = ?', (self.owner,))
+            except sqlite3.Error as e:
+                logger.error(f"注销处理器日志持有者失败: {str(e)}", exc_info=True)
+            self._connection.close()
+            self._connection = None
+
+    def recover(self, handler=None):
+        """
+        接管可重放的未完成消息，并登记为处理中
+
+        在一个写事务中把没有持有者、持有者已关闭或租约过期的未完成记录改为本进程持有，
+        多个进程同时启动时每条记录只会被其中一个接管
+
+        参数:
+        - handler: 之后由写线程每隔三分之一租约再接管一次，接管到的消息（格式同返回值）
+          交给该函数重放；为None时只在调用时接管一次
+
+        返回:
+        - 按入队顺序排列的 (消息ID, 通道, 消息, 上下文) 列表
+        """
+        recovered = self._claim()
+        self._recover_handler = handler
+        return recovered
+
+    def _claim(self):
+        """接管过期持有者的未完成记录，返回新接管的消息"""
+        now = time.time()
+        with self._db_lock:
+            connection = self._connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    'DELETE FROM owners WHERE renewed_at < ? AND owner != ?',
+                    (now - self.lease_timeout, self.owner)
+                )
+                rows = connection.execute(
+                    'SELECT seq, message_id, lane, message, context FROM entries WHERE completed_at IS NULL '
+                    'AND (owner IS NULL OR owner NOT IN (SELECT owner FROM owners)) ORDER BY seq'
+                ).fetchall()
+                connection.executemany(
+                    'UPDATE entries SET owner = ? WHERE seq = ?',
+                    [(self.owner, row[0]) for row in rows]
+                )
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+            self._claimed_at = now
+        with self._lock:
+            self._pending.update(row[1] for row in rows)
+        return [
+            (message_id, lane, json.loads(message), json.loads(context))
+            for _, message_id, lane, message, context in rows
+        ]
+
+    def append(self, message_id, lane, message, context):
+        """
+        追加一条入队记录，等待所在批次提交
+
+        参数:
+        - message_id: 消息ID
+        - lane: 优先级通道
+        - message: 消息内容
+        - context: 上下文信息
+
+        返回:
+        - 是否为新消息；消息ID正在处理、刚处理完或日志中已有该消息的记录时返回False
+        """
+        record = (message_id, lane, _to_json(message), _to_json(context or {}), time.time(), self.owner)
+        with self._lock:
+            if message_id in self._pending or message_id in self._completed:
+                return False
+            self._pending.add(message_id)
+            batch = self._batch
+            batch.appends.append(record)
+            self._has_work.notify()
+
+        if not batch.committed.wait(self.commit_timeout):
+            logger.warning(f"处理器日志提交超时，消息 {message_id} 可能未持久化")
+            return True
+        if message_id in batch.duplicates:
+            # 日志中已有记录：已处理完，或由其他进程处理中、等待接管重放
+            with self._lock:
+                self._pending.discard(message_id)
+            return False
+        return True
+
+    def complete(self, message_id):
+        """
+        追加一条完成标记（不等待提交）
+
+        参数:
+        - message_id: 消息ID
+        """
+        with self._lock:
+            if message_id not in self._pending:
+                return
+            self._pending.discard(message_id)
+            self._completed[message_id] = True
+            while len(self._completed) > RECENT_COMPLETED_SIZE:
+                self._completed.popitem(last=False)
+            self._batch.completions.append((time.time(), message_id))
+            self._has_work.notify()
+
+    def pending_count(self):
+        """处理中的消息数量"""
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        """写线程：每次取出全部缓冲记录，在一个事务中提交；空闲时按时续约并接管过期持有者的记录"""
+        renew_interval = self.lease_timeout / 3
+        while True:
+            with self._lock:
+                while self._running and not self._batch.appends and not self._batch.completions:
+                    remaining = self._renewed_at + renew_interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self._has_work.wait(remaining)
+                batch, self._batch = self._batch, _Batch()
+                running = self._running
+
+            if batch.appends or batch.completions or time.time() - self._renewed_at >= renew_interval:
+                self._commit(batch)
+            batch.committed.set()
+
+            if not running:
+                return
+            if self._recover_handler is not None and time.time() - self._claimed_at >= renew_interval:
+                self._replay_expired()
+
+    def _replay_expired(self):
+        """接管租约过期的持有者留下的记录并交给重放函数"""
+        try:
+            recovered = self._claim()
+        except sqlite3.Error as e:
+            # 下一个间隔再试
+            self._claimed_at = time.time()
+            logger.error(f"接管处理器日志中过期的记录失败: {str(e)}", exc_info=True)
+            return
+        if recovered:
+            logger.info(f"从处理器日志接管了 {len(recovered)} 条过期持有者的消息")
+            self._recover_handler(recovered)
+
+    def _commit(self, batch):
+        """提交一个批次，并在同一事务中续约"""
+        with self._db_lock:
+            try:
+                connection = self._connection
+                # 失败时同样按间隔重试，避免写线程空转
+                self._renewed_at = time.time()
+                connection.execute('BEGIN')
+                connection.execute(
+                    'INSERT OR REPLACE INTO owners (owner, renewed_at) VALUES (?, ?)',
+                    (self.owner, self._renewed_at)
+                )
+                duplicates = set()
+                for record in batch.appends:
+                    # 已有的记录（已完成或属于其他持有者）保持不变
+                    cursor = connection.execute(
+                        'INSERT OR IGNORE INTO entries (message_id, lane, message, context, created_at, owner) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        record
+                    )
+                    if cursor.rowcount == 0:
+                        duplicates.add(record[0])
+                if batch.completions:
+                    connection.executemany(
+                        'UPDATE entries SET completed_at = ? WHERE message_id = ?',
+                        batch.completions
+                    )
+                    self._completions_since_compact += len(batch.completions)
+                    if self._completions_since_compact >= COMPACT_EVERY:
+                        connection.execute(
+                            'DELETE FROM entries WHERE completed_at < ?',
+                            (time.time() - COMPLETED_RETENTION,)
+                        )
+                        self._completions_since_compact = 0
+                connection.execute('COMMIT')
+                batch.duplicates = duplicates
+                if batch.appends or batch.completions:
+                    self.batch_count += 1
+            except sqlite3.Error as e:
+                logger.error(f"写入处理器日志失败: {str(e)}", exc_info=True)
+                try:
+                    self._connection.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
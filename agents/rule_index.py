@@ -0,0 +1,509 @@
+"""
+监听规则索引
+
+在进程内维护一份已编译的监听规则索引，按监听范围（群组、直接消息、
+被提及的代理）分桶。索引在首次使用时从数据库整体加载一次，之后由
+agents/signals.py 中的 post_save / post_delete 信号增量更新，
+规则引擎处理每条消息时只需做字典查找，不再查询数据库。
+
+注意：索引是进程级的，其他进程中的规则变更无法通过信号感知，
+因此索引会在超过 RULE_ENGINE_CONFIG['RULE_INDEX_MAX_AGE'] 秒后整体重建。
+"""
+
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+from .matchers import KeywordAutomaton, compile_pattern, required_literals
+
+logger = logging.getLogger(__name__)
+
+# 索引整体重建的默认间隔（秒），0表示只在首次使用时加载
+DEFAULT_RULE_INDEX_MAX_AGE = 300
+
+# 从消息中提取的@名称末尾可能带有的标点
+MENTION_TRAILING_PUNCTUATION = ',.!?;:，。！？；：、）)'
+
+# 独占规则只有在优先级不低于该值（数值不大于）时才会阻止后续规则
+EXCLUSIVE_MAX_PRIORITY = 5
+
+
+def normalize_mention(mention):
+    """
+    标准化提及对象（代理ID或名称），用于提及路由索引的查找
+
+    参数:
+    - mention: 提及对象
+
+    返回:
+    - 去掉@前缀和末尾标点后的小写字符串
+    """
+    return str(mention).strip().lstrip('@').rstrip(MENTION_TRAILING_PUNCTUATION).lower()
+
+
+class CompiledRule:
+    """
+    已编译的监听规则
+
+    在规则加载时一次性解析监听范围和触发条件中的常用字段，
+    规则引擎在热路径上直接读取这些属性，无需反复解析JSON配置。
+    """
+
+    __slots__ = (
+        'rule', 'id', 'agent_id', 'priority', 'trigger_type', 'exclusive',
+        'listen_in_groups', 'listen_in_direct', 'allowed_groups', 'sort_key',
+        'keyword_entries', 'regex_entries', 'agent_name_key', 'stops_evaluation',
+    )
+
+    def __init__(self, rule):
+        """
+        参数:
+        - rule: AgentListeningRule实例
+        """
+        condition = rule.trigger_condition
+        if not isinstance(condition, dict):
+            condition = {}
+
+        self.rule = rule
+        self.id = rule.id
+        self.agent_id = str(rule.agent_id)
+        self.priority = rule.priority
+        self.trigger_type = rule.trigger_type
+        self.exclusive = bool(condition.get('exclusive', False))
+        self.listen_in_groups = rule.listen_in_groups
+        self.listen_in_direct = rule.listen_in_direct
+        self.allowed_groups = frozenset(
+            str(group_id) for group_id in (rule.allowed_groups or [])
+        )
+        self.sort_key = (rule.priority, rule.id)
+        self.keyword_entries = self._collect_keyword_entries(condition)
+        self.regex_entries = self._collect_regex_entries(condition)
+        self.agent_name_key = (
+            normalize_mention(rule.agent.name) if self.trigger_type == 'mention' else None
+        )
+        # 触发后是否停止评估后续（优先级更低的）规则
+        self.stops_evaluation = self.exclusive and self.priority <= EXCLUSIVE_MAX_PRIORITY
+
+    def _collect_keyword_entries(self, condition):
+        """
+        收集需要加入共享关键词自动机的条目
+
+        关键词规则的每个关键词以规则ID为所有者；
+        上下文感知规则中keyword类型的条目以 (规则ID, 条目序号) 为所有者
+        """
+        entries = []
+        if self.trigger_type == 'keyword':
+            keywords = condition.get('keywords')
+            if isinstance(keywords, (list, tuple)):
+                entries.extend((keyword, self.id) for keyword in keywords)
+        elif self.trigger_type == 'context_aware':
+            context_rules = condition.get('context_rules')
+            if isinstance(context_rules, (list, tuple)):
+                for position, context_rule in enumerate(context_rules):
+                    if not isinstance(context_rule, dict):
+                        continue
+                    if context_rule.get('type', 'keyword') == 'keyword':
+                        entries.append(
+                            (context_rule.get('value', ''), (self.id, position))
+                        )
+        return entries
+
+    def _collect_regex_entries(self, condition):
+        """
+        编译正则表达式并收集正则预过滤自动机的条目
+
+        每个必需字面子串以规则ID（上下文规则为 (规则ID, 条目序号)）为所有者；
+        无法提取字面子串的模式以空字符串登记，视为总是候选
+        """
+        patterns = []
+        if self.trigger_type == 'regex':
+            patterns.append((condition.get('pattern'), self.id))
+        elif self.trigger_type == 'context_aware':
+            context_rules = condition.get('context_rules')
+            if isinstance(context_rules, (list, tuple)):
+                for position, context_rule in enumerate(context_rules):
+                    if isinstance(context_rule, dict) and context_rule.get('type') == 'regex':
+                        patterns.append((context_rule.get('value', ''), (self.id, position)))
+
+        entries = []
+        for pattern, owner in patterns:
+            if not isinstance(pattern, str):
+                continue
+            try:
+                # 预先编译，热路径上直接命中编译缓存
+                compile_pattern(pattern)
+                literals = required_literals(pattern)
+            except re.error as e:
+                logger.warning(f"规则 {self.id} 的正则表达式无效: {pattern} ({e})")
+                continue
+            entries.extend((literal, owner) for literal in literals or ('',))
+        return entries
+
+    def __repr__(self):
+        return f"<CompiledRule {self.id} ({self.trigger_type}, P{self.priority})>"
+
+
+class RuleIndex:
+    """
+    进程内监听规则索引
+
+    分桶说明:
+    - group_wide: 在所有群组中监听的规则（allowed_groups为空）
+    - by_group: 只在特定群组中监听的规则，按群组ID分桶
+    - direct: 在直接消息中监听的规则
+    - mention_by_agent: 提及类规则，按代理ID分桶，被提及时不受监听范围限制
+    - mention_targets: 提及路由表，标准化的代理ID和名称 -> 代理ID集合
+    - mention_names: 标准化的代理名称 -> 代理ID集合，用于在文本中查找"@名称"
+      （中文提及后通常紧跟正文，无法按词提取）
+    """
+
+    def __init__(self, max_age=None):
+        """
+        参数:
+        - max_age: 索引整体重建间隔（秒），为None时读取配置
+        """
+        self._lock = threading.RLock()
+        self._max_age = max_age
+        self._loaded_at = None
+        self._rules = {}
+        self._group_wide = {}
+        self._by_group = {}
+        self._direct = {}
+        self._mention_by_agent = {}
+        self._mention_targets = {}
+        self._mention_names = {}
+        # 合并后的有序规则列表缓存，任何变更都会清空
+        self._scope_cache = {}
+        self._keyword_automaton = None
+        self._regex_prefilter = None
+        self._mention_automaton = None
+        self.version = 0
+
+    @property
+    def max_age(self):
+        """索引整体重建间隔（秒）"""
+        if self._max_age is not None:
+            return self._max_age
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        return config.get('RULE_INDEX_MAX_AGE', DEFAULT_RULE_INDEX_MAX_AGE)
+
+    def get_rules(self, message, mentioned_agent_ids=None):
+        """
+        获取可能适用于该消息的规则
+
+        参数:
+        - message: 标准化的消息
+        - mentioned_agent_ids: 已解析的被提及代理ID集合，为None时从消息中解析
+
+        返回:
+        - CompiledRule列表，按优先级排序
+        """
+        self._ensure_loaded()
+
+        group_id = message.get('group_id')
+        if mentioned_agent_ids is None:
+            content = message.get('content')
+            mentioned_agent_ids = self.resolve_mentions(
+                message.get('mentions') or [],
+                content.lower() if isinstance(content, str) else ''
+            )
+        mentions = mentioned_agent_ids
+
+        with self._lock:
+            scope_key = ('group', str(group_id)) if group_id else ('direct',)
+            rules = self._scope_cache.get(scope_key)
+            if rules is None:
+                rules = self._collect_scope(group_id)
+                self._scope_cache[scope_key] = rules
+
+            if not mentions:
+                return list(rules)
+
+            # 被提及代理的提及规则不受监听范围限制
+            merged = {compiled.id: compiled for compiled in rules}
+            for agent_id in mentions:
+                bucket = self._mention_by_agent.get(agent_id)
+                if bucket:
+                    merged.update(bucket)
+
+        return sorted(merged.values(), key=lambda compiled: compiled.sort_key)
+
+    def resolve_mentions(self, mentions, lower_content=''):
+        """
+        把消息中的提及对象解析为拥有提及规则的代理ID
+
+        每个提及对象（代理ID或名称）只做一次字典查找；
+        "@名称"后可能紧跟正文（如"@助手帮我查一下"）而无法按词提取，
+        另用所有代理名称构建的自动机对小写文本扫描一次
+
+        参数:
+        - mentions: 提及对象列表（代理ID或名称）
+        - lower_content: 小写的消息文本
+
+        返回:
+        - 被提及的代理ID集合（字符串）
+        """
+        self._ensure_loaded()
+
+        agent_ids = set()
+        with self._lock:
+            for mention in mentions:
+                targets = self._mention_targets.get(normalize_mention(mention))
+                if targets:
+                    agent_ids.update(targets)
+
+            if lower_content and '@' in lower_content and self._mention_names:
+                if self._mention_automaton is None:
+                    self._mention_automaton = KeywordAutomaton(
+                        (f"@{name}", agent_id)
+                        for name, targets in self._mention_names.items()
+                        for agent_id in targets
+                    )
+                agent_ids.update(self._mention_automaton.scan(lower_content))
+
+        return frozenset(agent_ids)
+
+    def get_keyword_automaton(self):
+        """
+        获取由所有激活规则的关键词构建的共享自动机
+
+        自动机在规则变更后的首次使用时重建
+
+        返回:
+        - KeywordAutomaton实例
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            if self._keyword_automaton is None:
+                self._keyword_automaton = KeywordAutomaton(
+                    entry
+                    for compiled in self._rules.values()
+                    for entry in compiled.keyword_entries
+                )
+            return self._keyword_automaton
+
+    def get_regex_prefilter(self):
+        """
+        获取由所有正则规则的必需字面子串构建的预过滤自动机
+
+        自动机区分大小写，在规则变更后的首次使用时重建
+
+        返回:
+        - KeywordAutomaton实例
+        """
+        self._ensure_loaded()
+
+        with self._lock:
+            if self._regex_prefilter is None:
+                self._regex_prefilter = KeywordAutomaton(
+                    (
+                        entry
+                        for compiled in self._rules.values()
+                        for entry in compiled.regex_entries
+                    ),
+                    case_sensitive=True
+                )
+            return self._regex_prefilter
+
+    def _collect_scope(self, group_id):
+        """合并指定范围内的规则桶并排序"""
+        if group_id:
+            merged = dict(self._group_wide)
+            merged.update(self._by_group.get(str(group_id), {}))
+        else:
+            merged = dict(self._direct)
+        return tuple(sorted(merged.values(), key=lambda compiled: compiled.sort_key))
+
+    def upsert(self, rule):
+        """
+        新增或更新一条规则
+
+        参数:
+        - rule: AgentListeningRule实例
+        """
+        if not self._loaded_at:
+            # 尚未加载时无需增量更新，首次使用时会整体加载
+            return
+
+        with self._lock:
+            self._discard(rule.id)
+            if rule.is_active:
+                self._place(CompiledRule(rule))
+            self._changed()
+
+    def remove(self, rule_id):
+        """
+        从索引中移除一条规则
+
+        参数:
+        - rule_id: 规则ID
+        """
+        if not self._loaded_at:
+            return
+
+        with self._lock:
+            if self._discard(rule_id):
+                self._changed()
+
+    def refresh_agent(self, agent):
+        """
+        代理信息变更后，更新其规则持有的代理对象
+
+        代理名称变更会影响提及路由，其提及规则会重新编译
+
+        参数:
+        - agent: Agent实例
+        """
+        with self._lock:
+            mention_rules = []
+            for compiled in self._rules.values():
+                if compiled.rule.agent_id == agent.id:
+                    compiled.rule.agent = agent
+                    if compiled.trigger_type == 'mention':
+                        mention_rules.append(compiled.rule)
+
+            # 先全部移除再重新放入，旧名称才会从提及路由表中清除
+            for rule in mention_rules:
+                self._discard(rule.id)
+            for rule in mention_rules:
+                self._place(CompiledRule(rule))
+            self._changed()
+
+    def snapshot(self):
+        """
+        导出当前激活规则的快照，供进程池工作进程加载
+
+        返回:
+        - (版本号, AgentListeningRule实例列表)
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return self.version, [compiled.rule for compiled in self._rules.values()]
+
+    def load_snapshot(self, version, rules):
+        """
+        从快照加载索引，不访问数据库，加载后不再定期重建
+
+        参数:
+        - version: 快照的版本号
+        - rules: AgentListeningRule实例列表
+        """
+        with self._lock:
+            self._reset()
+            for rule in rules:
+                self._place(CompiledRule(rule))
+            self._max_age = 0
+            self._loaded_at = time.monotonic()
+            self._changed()
+            self.version = version
+
+    def invalidate(self):
+        """清空索引，下次使用时从数据库整体重建"""
+        with self._lock:
+            self._reset()
+            self._loaded_at = None
+
+    def rebuild(self):
+        """从数据库整体重建索引"""
+        from .models import AgentListeningRule
+
+        rules = list(
+            AgentListeningRule.objects.filter(is_active=True).select_related('agent')
+        )
+
+        with self._lock:
+            self._reset()
+            for rule in rules:
+                self._place(CompiledRule(rule))
+            self._loaded_at = time.monotonic()
+            self._changed()
+
+        logger.info(f"监听规则索引已重建，共 {len(rules)} 条激活规则")
+
+    def _ensure_loaded(self):
+        """确保索引已加载且未过期"""
+        loaded_at = self._loaded_at
+        max_age = self.max_age
+        if loaded_at is None or (max_age and time.monotonic() - loaded_at > max_age):
+            self.rebuild()
+
+    def _reset(self):
+        """清空所有分桶"""
+        self._rules = {}
+        self._group_wide = {}
+        self._by_group = {}
+        self._direct = {}
+        self._mention_by_agent = {}
+        self._mention_targets = {}
+        self._mention_names = {}
+        self._scope_cache = {}
+        self._keyword_automaton = None
+        self._regex_prefilter = None
+        self._mention_automaton = None
+
+    def _changed(self):
+        """索引变更后清空缓存并递增版本号"""
+        self._scope_cache = {}
+        self._keyword_automaton = None
+        self._regex_prefilter = None
+        self._mention_automaton = None
+        self.version += 1
+
+    def _place(self, compiled):
+        """将已编译规则放入对应的分桶"""
+        self._rules[compiled.id] = compiled
+
+        if compiled.listen_in_groups:
+            if compiled.allowed_groups:
+                for group_id in compiled.allowed_groups:
+                    self._by_group.setdefault(group_id, {})[compiled.id] = compiled
+            else:
+                self._group_wide[compiled.id] = compiled
+
+        if compiled.listen_in_direct:
+            self._direct[compiled.id] = compiled
+
+        if compiled.trigger_type == 'mention':
+            self._mention_by_agent.setdefault(compiled.agent_id, {})[compiled.id] = compiled
+            self._mention_targets.setdefault(compiled.agent_id, set()).add(compiled.agent_id)
+            if compiled.agent_name_key:
+                self._mention_targets.setdefault(compiled.agent_name_key, set()).add(compiled.agent_id)
+                self._mention_names.setdefault(compiled.agent_name_key, set()).add(compiled.agent_id)
+
+    def _discard(self, rule_id):
+        """将规则从所有分桶中移除，返回规则是否存在"""
+        compiled = self._rules.pop(rule_id, None)
+        if compiled is None:
+            return False
+
+        self._group_wide.pop(rule_id, None)
+        self._direct.pop(rule_id, None)
+        for group_id in compiled.allowed_groups:
+            bucket = self._by_group.get(group_id)
+            if bucket is not None:
+                bucket.pop(rule_id, None)
+                if not bucket:
+                    del self._by_group[group_id]
+
+        bucket = self._mention_by_agent.get(compiled.agent_id)
+        if bucket is not None:
+            bucket.pop(rule_id, None)
+            if not bucket:
+                del self._mention_by_agent[compiled.agent_id]
+                # 代理已没有提及规则，从提及路由表中移除
+                for key in (compiled.agent_id, compiled.agent_name_key):
+                    for table in (self._mention_targets, self._mention_names):
+                        targets = table.get(key)
+                        if targets is not None:
+                            targets.discard(compiled.agent_id)
+                            if not targets:
+                                del table[key]
+        return True
+
+
+# 全局实例
+rule_index = RuleIndex()
@@ -0,0 +1,313 @@
+"""
+规则匹配进程池
+
+情感分析（jieba 分词、情感词典）和主题相似度（gensim 词向量）都是 CPU 密集型计算，
+在同一进程内会与 Daphne 事件循环和异步消息处理器争抢 GIL。开启进程池模式后，
+特征提取和规则匹配在预热好的工作进程中执行，吞吐量随 CPU 核数扩展。
+
+- 每个工作进程启动时初始化 Django 并预先加载分词器和分析器
+- 规则以带版本号的快照文件下发：主进程规则索引版本变化时写出新快照，
+  工作进程发现任务携带的版本与本地不同时重新加载，不访问数据库
+- 工作进程只返回匹配的规则ID；冷却检查、响应执行和交互记录仍在主进程完成
+
+开启方式: RULE_ENGINE_CONFIG['PROCESS_POOL_WORKERS'] = N（0表示关闭）
+"""
+
+import atexit
+import importlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 工作进程中按文本缓存的特征条目上限，超出后清空重建
+WORKER_FEATURE_CACHE_SIZE = 10000
+
+# 工作进程初始化时预先导入的分析器模块
+WARM_UP_MODULES = ('agents.utils.sentiment_analyzer', 'agents.utils.topic_analyzer')
+
+# 标记当前进程为规则匹配工作进程的环境变量（apps.py 据此跳过后台线程）
+POOL_WORKER_ENV = 'RULE_ENGINE_POOL_WORKER'
+
+# 工作进程内的状态
+_worker_state = {'version': None, 'feature_cache': None, 'warm_up_errors': {}}
+
+
+def _init_worker(settings_module):
+    """
+    工作进程初始化：加载 Django 并预热分词器和分析器
+
+    参数:
+    - settings_module: Django配置模块
+    """
+    os.environ[POOL_WORKER_ENV] = '1'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+
+    import django
+    django.setup()
+
+    import jieba
+    jieba.initialize()
+
+    # 导入失败时该类规则在每条消息上都会走错误分支，记录下来由主进程在启动时报告
+    errors = {}
+    for module_name in WARM_UP_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            errors[module_name] = f"{type(e).__name__}: {e}"
+            logger.error(f"规则匹配工作进程预热 {module_name} 失败: {str(e)}", exc_info=True)
+    _worker_state['warm_up_errors'] = errors
+
+
+def _load_snapshot(version, snapshot_path):
+    """工作进程中按需加载规则快照"""
+    if _worker_state['version'] == version:
+        return
+
+    from .rule_index import rule_index
+
+    with open(snapshot_path, 'rb') as snapshot_file:
+        rules = pickle.load(snapshot_file)
+    rule_index.load_snapshot(version, rules)
+    _worker_state['version'] = version
+
+
+def _get_feature_cache():
+    """获取工作进程内跨任务共享的特征缓存"""
+    from .features import FeatureCache
+
+    cache = _worker_state['feature_cache']
+    if cache is None or len(cache.tokens) + len(cache.sentiment) + len(cache.vectors) > WORKER_FEATURE_CACHE_SIZE:
+        cache = FeatureCache()
+        _worker_state['feature_cache'] = cache
+    return cache
+
+
+def _warm_up(_index=None):
+    """
+    预热任务，确保工作进程已启动并完成初始化
+
+    返回:
+    - (工作进程ID, 预热失败的模块 -> 错误信息)
+    """
+    return os.getpid(), _worker_state['warm_up_errors']
+
+
+def _match_messages(messages, version, snapshot_path):
+    """
+    在工作进程中匹配一组消息
+
+    参数:
+    - messages: 标准化的消息列表（上下文消息已显式附带）
+    - version: 规则快照版本号
+    - snapshot_path: 规则快照文件路径
+
+    返回:
+    - 与messages一一对应的匹配规则ID列表
+    """
+    from .features import MessageFeatures
+    from .matchers import KeywordScanner
+    from .rule_index import rule_index
+
+    _load_snapshot(version, snapshot_path)
+
+    keyword_scanner = KeywordScanner(
+        rule_index.get_keyword_automaton(),
+        rule_index.get_regex_prefilter()
+    )
+    feature_cache = _get_feature_cache()
+
+    results = []
+    for message in messages:
+        features = MessageFeatures(message, feature_cache)
+        matched = []
+        for compiled in rule_index.get_rules(message, features.mentioned_agent_ids):
+            try:
+                if compiled.rule.match_conditions(message, keyword_scanner, features):
+                    matched.append(compiled.id)
+            except Exception as e:
+                logger.error(f"工作进程匹配规则 {compiled.id} 时出错: {str(e)}", exc_info=True)
+        results.append(matched)
+    return results
+
+
+class RuleProcessPool:
+    """
+    规则匹配进程池
+
+    关闭时（默认）规则引擎在当前进程中匹配规则，不产生额外开销。
+    """
+
+    def __init__(self, workers=None):
+        """
+        参数:
+        - workers: 工作进程数量，为None时读取 RULE_ENGINE_CONFIG['PROCESS_POOL_WORKERS']
+        """
+        self._lock = threading.Lock()
+        self._workers = workers
+        self._executor = None
+        self._snapshot_dir = None
+        self._snapshot_version = None
+        self._snapshot_paths = []
+
+    @property
+    def workers(self):
+        """工作进程数量，0表示不使用进程池"""
+        if self._workers is not None:
+            return self._workers
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        return config.get('PROCESS_POOL_WORKERS', 0)
+
+    @property
+    def enabled(self):
+        """是否使用进程池"""
+        return self.workers > 0
+
+    def start(self):
+        """启动工作进程并预热"""
+        with self._lock:
+            if self._executor is not None or not self.enabled:
+                return
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings'),)
+            )
+            self._snapshot_dir = tempfile.mkdtemp(prefix='rule-snapshots-')
+            executor = self._executor
+
+        # 每个工作进程执行一次预热任务，避免第一条消息承担进程启动和模型加载的耗时
+        pids = set()
+        errors = {}
+        for pid, worker_errors in executor.map(_warm_up, range(self.workers)):
+            pids.add(pid)
+            errors.update(worker_errors)
+        for module_name, error in errors.items():
+            logger.error(f"规则匹配工作进程无法导入 {module_name}，相关规则将无法匹配: {error}")
+        logger.info(f"规则匹配进程池已启动，工作进程 {len(pids)} 个")
+
+    def shutdown(self):
+        """关闭工作进程并删除快照文件"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            paths, self._snapshot_paths = self._snapshot_paths, []
+            self._snapshot_version = None
+        if executor is None:
+            return
+
+        executor.shutdown(wait=True, cancel_futures=True)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        try:
+            os.rmdir(self._snapshot_dir)
+        except OSError:
+            pass
+        logger.info("规则匹配进程池已关闭")
+
+    def _current_snapshot(self):
+        """
+        获取当前规则版本的快照文件，版本变化时写出新快照
+
+        返回:
+        - (版本号, 快照文件路径)
+        """
+        from .rule_index import rule_index
+
+        version, rules = rule_index.snapshot()
+        with self._lock:
+            if version == self._snapshot_version:
+                return version, self._snapshot_paths[-1]
+
+            path = os.path.join(self._snapshot_dir, f'rules-{version}.pkl')
+            temp_path = f'{path}.tmp'
+            with open(temp_path, 'wb') as snapshot_file:
+                pickle.dump(rules, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+
+            self._snapshot_version = version
+            self._snapshot_paths.append(path)
+            # 保留上一个版本，正在执行的任务可能仍在读取
+            while len(self._snapshot_paths) > 2:
+                try:
+                    os.remove(self._snapshot_paths.pop(0))
+                except OSError:
+                    pass
+            return version, path
+
+    def match(self, messages):
+        """
+        在工作进程中匹配消息
+
+        参数:
+        - messages: 标准化的消息列表（上下文消息需显式附带在 context_messages 中）
+
+        返回:
+        - 与messages一一对应的匹配规则ID集合列表，进程池不可用时返回None
+        """
+        if not messages:
+            return []
+        if self._executor is None:
+            self.start()
+
+        try:
+            version, path = self._current_snapshot()
+
+            # 按工作进程数量切分，整批消息并行匹配
+            chunk_size = max(1, -(-len(messages) // self.workers))
+            futures = [
+                self._executor.submit(_match_messages, messages[start:start + chunk_size], version, path)
+                for start in range(0, len(messages), chunk_size)
+            ]
+
+            results = []
+            for future in futures:
+                results.extend(frozenset(matched) for matched in future.result())
+            return results
+
+        except BrokenProcessPool as e:
+            logger.error(f"规则匹配进程池已损坏，将重新启动: {str(e)}")
+            self.shutdown()
+            return None
+        except Exception as e:
+            logger.error(f"规则匹配进程池执行出错: {str(e)}", exc_info=True)
+            return None
+
+    def submit(self, fn, *args):
+        """
+        在工作进程中执行其他CPU密集型任务（如对话摘要）
+
+        参数:
+        - fn: 模块级函数（需要可被pickle）
+        - args: 函数参数
+
+        返回:
+        - concurrent.futures.Future，进程池关闭时返回None，由调用方在当前进程中执行
+        """
+        if not self.enabled:
+            return None
+        if self._executor is None:
+            self.start()
+        try:
+            return self._executor.submit(fn, *args)
+        except BrokenProcessPool as e:
+            logger.error(f"规则匹配进程池已损坏，将重新启动: {str(e)}")
+            self.shutdown()
+            return None
+
+
+# 全局实例
+rule_pool = RuleProcessPool()
+atexit.register(rule_pool.shutdown)
@@ -0,0 +1,172 @@
+"""
+监听规则性能分析
+
+可选的规则级埋点：开启后规则引擎记录每条规则的匹配耗时直方图、评估次数、
+命中率和错误次数，并按触发类型汇总，用于在生产负载下定位耗时异常的
+正则或上下文感知规则。
+
+开启方式: RULE_ENGINE_CONFIG['PROFILE_RULES'] = True，或在运行时调用
+rule_profiler.enable()（管理后台和 rules/profile/ 接口均可切换）。
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+
+from .metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# 报告支持的排序字段
+SORT_FIELDS = ('total_ms', 'mean_ms', 'p99_ms', 'max_ms', 'evaluations', 'errors', 'hit_ratio')
+
+
+class RuleProfile:
+    """单条规则的性能统计"""
+
+    def __init__(self, rule):
+        """
+        参数:
+        - rule: AgentListeningRule实例
+        """
+        self.rule_id = rule.id
+        self.rule_name = rule.name
+        self.agent_id = str(rule.agent_id)
+        self.trigger_type = rule.trigger_type
+        self.hits = 0
+        self.errors = 0
+        self.latency = LatencyHistogram()
+
+    def to_dict(self):
+        """导出统计数据"""
+        latency = self.latency.snapshot()
+        evaluations = latency.pop('count')
+        return {
+            'rule_id': str(self.rule_id),
+            'rule_name': self.rule_name,
+            'agent_id': self.agent_id,
+            'trigger_type': self.trigger_type,
+            'evaluations': evaluations,
+            'hits': self.hits,
+            'hit_ratio': round(self.hits / evaluations, 4) if evaluations else 0.0,
+            'errors': self.errors,
+            **latency,
+        }
+
+
+class RuleProfiler:
+    """
+    规则性能分析器
+
+    关闭时规则引擎只做一次布尔判断，不产生额外开销。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._enabled = None
+
+    @property
+    def enabled(self):
+        """是否开启性能分析"""
+        if self._enabled is None:
+            config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+            self._enabled = bool(config.get('PROFILE_RULES', False))
+        return self._enabled
+
+    def enable(self):
+        """开启性能分析"""
+        self._enabled = True
+        logger.info("规则性能分析已开启")
+
+    def disable(self):
+        """关闭性能分析"""
+        self._enabled = False
+        logger.info("规则性能分析已关闭")
+
+    def _get_profile(self, rule):
+        """获取或创建规则的统计对象"""
+        profile = self._profiles.get(rule.id)
+        if profile is None:
+            with self._lock:
+                profile = self._profiles.get(rule.id)
+                if profile is None:
+                    profile = RuleProfile(rule)
+                    self._profiles[rule.id] = profile
+        return profile
+
+    def record(self, rule, elapsed, matched):
+        """
+        记录一次规则评估
+
+        参数:
+        - rule: AgentListeningRule实例
+        - elapsed: 匹配耗时（秒）
+        - matched: 是否命中
+        """
+        profile = self._get_profile(rule)
+        profile.latency.observe(elapsed)
+        if matched:
+            profile.hits += 1
+
+    def record_error(self, rule, elapsed=None):
+        """
+        记录一次规则评估错误
+
+        参数:
+        - rule: AgentListeningRule实例
+        - elapsed: 出错前的耗时（秒），为None时不计入耗时分布
+        """
+        profile = self._get_profile(rule)
+        if elapsed is not None:
+            profile.latency.observe(elapsed)
+        profile.errors += 1
+
+    def reset(self):
+        """清空所有统计"""
+        with self._lock:
+            self._profiles = {}
+
+    def report(self, sort_by='total_ms', limit=None):
+        """
+        生成性能报告
+
+        参数:
+        - sort_by: 排序字段（降序），见 SORT_FIELDS
+        - limit: 最多返回的规则数量
+
+        返回:
+        - 包含规则列表和按触发类型汇总数据的字典
+        """
+        if sort_by not in SORT_FIELDS:
+            sort_by = 'total_ms'
+
+        with self._lock:
+            profiles = list(self._profiles.values())
+
+        rules = [profile.to_dict() for profile in profiles]
+        rules.sort(key=lambda item: item[sort_by], reverse=True)
+
+        by_trigger_type = {}
+        for item in rules:
+            summary = by_trigger_type.setdefault(item['trigger_type'], {
+                'rules': 0, 'evaluations': 0, 'hits': 0, 'errors': 0, 'total_ms': 0.0,
+            })
+            summary['rules'] += 1
+            summary['evaluations'] += item['evaluations']
+            summary['hits'] += item['hits']
+            summary['errors'] += item['errors']
+            summary['total_ms'] = round(summary['total_ms'] + item['total_ms'], 3)
+
+        return {
+            'enabled': self.enabled,
+            'sort_by': sort_by,
+            'rule_count': len(rules),
+            'rules': rules[:limit] if limit else rules,
+            'by_trigger_type': by_trigger_type,
+        }
+
+
+# 全局实例
+rule_profiler = RuleProfiler()
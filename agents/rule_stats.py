@@ -0,0 +1,217 @@
+"""
+监听规则触发统计
+
+规则触发时不再同步写数据库，而是在进程内记录触发次数增量和最近触发时间，
+冷却判断（is_on_cooldown / can_trigger）直接读取内存中的最近触发时间。
+后台线程每隔 RULE_ENGINE_CONFIG['STATS_FLUSH_INTERVAL'] 秒把增量
+以基于 F() 表达式的批量 UPDATE 写回数据库，一次刷新只执行一条（分批时为少数几条）语句。
+
+注意：统计是进程级的，刷新之前其他进程看不到本进程的触发记录，
+数据库中的 trigger_count / last_triggered 最多滞后一个刷新间隔。
+"""
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 默认刷新间隔（秒）
+DEFAULT_STATS_FLUSH_INTERVAL = 5
+
+# 单条UPDATE语句最多涉及的规则数量（SQLite对参数个数有限制）
+FLUSH_BATCH_SIZE = 200
+
+
+class RuleStatsStore:
+    """
+    进程内规则触发统计存储
+
+    数据说明:
+    - pending_counts: 尚未写回数据库的触发次数增量，按规则ID记录
+    - last_triggered: 本进程已知的最近触发时间，冷却判断以此为准
+    - dirty_last_triggered: 尚未写回数据库的最近触发时间
+    """
+
+    def __init__(self, flush_interval=None):
+        """
+        参数:
+        - flush_interval: 刷新间隔（秒），为None时读取配置
+        """
+        self._lock = threading.Lock()
+        self._flush_interval = flush_interval
+        self._pending_counts = {}
+        self._last_triggered = {}
+        self._dirty_last_triggered = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def flush_interval(self):
+        """刷新间隔（秒）"""
+        if self._flush_interval is not None:
+            return self._flush_interval
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        return config.get('STATS_FLUSH_INTERVAL', DEFAULT_STATS_FLUSH_INTERVAL)
+
+    def record_trigger(self, rule, triggered_at=None):
+        """
+        记录一次规则触发
+
+        参数:
+        - rule: AgentListeningRule实例，其内存中的统计字段会同步更新
+        - triggered_at: 触发时间，默认为当前时间
+        """
+        triggered_at = triggered_at or timezone.now()
+
+        with self._lock:
+            self._pending_counts[rule.id] = self._pending_counts.get(rule.id, 0) + 1
+            self._last_triggered[rule.id] = triggered_at
+            self._dirty_last_triggered[rule.id] = triggered_at
+
+        rule.trigger_count = (rule.trigger_count or 0) + 1
+        rule.last_triggered = triggered_at
+        # 由统计写回，之后保存该实例时不视为显式修改
+        rule._saved_last_triggered = triggered_at
+
+    def get_last_triggered(self, rule):
+        """
+        获取规则的最近触发时间
+
+        参数:
+        - rule: AgentListeningRule实例
+
+        返回:
+        - 内存记录与实例字段中较新的时间，均为空时返回None
+        """
+        recorded = self._last_triggered.get(rule.id)
+        if recorded is None:
+            return rule.last_triggered
+        if rule.last_triggered is None:
+            return recorded
+        return max(recorded, rule.last_triggered)
+
+    def sync(self, rule):
+        """
+        规则的最近触发时间被显式保存后（如重置冷却），以保存的时间为准
+
+        完整保存不会写入未修改的 last_triggered（见 AgentListeningRule.save），
+        只有显式写入该字段的保存需要同步
+
+        参数:
+        - rule: AgentListeningRule实例
+        """
+        with self._lock:
+            self._dirty_last_triggered.pop(rule.id, None)
+            if rule.last_triggered is None:
+                self._last_triggered.pop(rule.id, None)
+            else:
+                self._last_triggered[rule.id] = rule.last_triggered
+
+    def forget(self, rule_id):
+        """
+        规则删除后丢弃其统计
+
+        参数:
+        - rule_id: 规则ID
+        """
+        with self._lock:
+            self._pending_counts.pop(rule_id, None)
+            self._last_triggered.pop(rule_id, None)
+            self._dirty_last_triggered.pop(rule_id, None)
+
+    def reset(self):
+        """清空所有统计（不写回数据库）"""
+        with self._lock:
+            self._pending_counts = {}
+            self._last_triggered = {}
+            self._dirty_last_triggered = {}
+
+    def flush(self):
+        """
+        把待写回的统计批量更新到数据库
+
+        返回:
+        - 本次更新的规则数量
+        """
+        from .models import AgentListeningRule
+
+        with self._lock:
+            counts = self._pending_counts
+            last_triggered = self._dirty_last_triggered
+            self._pending_counts = {}
+            self._dirty_last_triggered = {}
+
+        rule_ids = list(set(counts) | set(last_triggered))
+        if not rule_ids:
+            return 0
+
+        try:
+            now = timezone.now()
+            for start in range(0, len(rule_ids), FLUSH_BATCH_SIZE):
+                batch = rule_ids[start:start + FLUSH_BATCH_SIZE]
+                count_cases = [
+                    When(id=rule_id, then=F('trigger_count') + counts[rule_id])
+                    for rule_id in batch if rule_id in counts
+                ]
+                time_cases = [
+                    When(id=rule_id, then=Value(last_triggered[rule_id]))
+                    for rule_id in batch if rule_id in last_triggered
+                ]
+                updates = {'updated_at': now}
+                if count_cases:
+                    updates['trigger_count'] = Case(*count_cases, default=F('trigger_count'))
+                if time_cases:
+                    updates['last_triggered'] = Case(*time_cases, default=F('last_triggered'))
+                AgentListeningRule.objects.filter(id__in=batch).update(**updates)
+        except Exception as e:
+            logger.error(f"写回规则触发统计时出错: {str(e)}", exc_info=True)
+            self._restore(counts, last_triggered)
+            return 0
+
+        logger.debug(f"已写回 {len(rule_ids)} 条规则的触发统计")
+        return len(rule_ids)
+
+    def _restore(self, counts, last_triggered):
+        """写回失败时把增量合并回待写回数据，等待下次刷新"""
+        with self._lock:
+            for rule_id, count in counts.items():
+                self._pending_counts[rule_id] = self._pending_counts.get(rule_id, 0) + count
+            for rule_id, triggered_at in last_triggered.items():
+                self._dirty_last_triggered.setdefault(rule_id, triggered_at)
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='rule-stats-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"规则触发统计刷新线程已启动，间隔 {self.flush_interval} 秒")
+
+    def stop(self):
+        """停止后台刷新线程并写回剩余统计"""
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        """后台刷新循环"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+# 全局实例
+rule_stats = RuleStatsStore()
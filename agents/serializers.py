@@ -1,7 +1,9 @@
 from rest_framework import serializers
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
-from .models import Agent, AgentSkill, AgentSkillAssignment, AgentInteraction, AgentListeningRule
+from .models import Agent, AgentSkill, AgentSkillAssignment, AgentInteraction, AgentListeningRule, ResponseDeadLetter
 
 
 class AgentMinimalSerializer(serializers.ModelSerializer):
@@ -127,14 +129,14 @@ class AgentListeningRuleSerializer(serializers.ModelSerializer):
                     {'trigger_condition': _('正则表达式触发类型必须包含pattern字段，且必须是字符串')}
                 )
                 
-            # 验证正则表达式是否有效
-            try:
-                import re
-                re.compile(trigger_condition['pattern'])
-            except Exception as e:
-                raise serializers.ValidationError(
-                    {'trigger_condition': _('无效的正则表达式: {}').format(str(e))}
-                )
+        # 验证正则表达式是否有效（包括上下文规则中的正则条目）
+        try:
+            AgentListeningRule(
+                trigger_type=trigger_type,
+                trigger_condition=trigger_condition
+            ).validate_patterns()
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.message_dict)
         
         # 验证响应内容
         response_type = data.get('response_type')
@@ -194,4 +196,35 @@ class AgentListeningRuleCreateSerializer(serializers.ModelSerializer):
             )
         
         # 调用父类的验证
-        return AgentListeningRuleSerializer().validate(data) 
\ No newline at end of file
+        return AgentListeningRuleSerializer().validate(data) 
+
+
+class ResponseDeadLetterSerializer(serializers.ModelSerializer):
+    """响应死信序列化器"""
+    stage_display = serializers.ReadOnlyField(source='get_stage_display')
+    
+    class Meta:
+        model = ResponseDeadLetter
+        fields = [
+            'id', 'stage', 'stage_display', 'response_type', 'response', 'context',
+            'attempts', 'last_error', 'created_at', 'replayed_at'
+        ]
+        read_only_fields = fields
+
+
+class RuleBatchProcessSerializer(serializers.Serializer):
+    """规则批量处理请求序列化器"""
+    messages = serializers.ListField(child=serializers.JSONField(), allow_empty=False)
+    context = serializers.DictField(required=False, default=dict)
+    dry_run = serializers.BooleanField(required=False, default=True)
+    
+    def validate_messages(self, value):
+        """验证消息列表：每条消息是文本或消息字典，数量不超过上限"""
+        max_batch_size = getattr(settings, 'RULE_ENGINE_CONFIG', {}).get('MAX_BATCH_SIZE', 1000)
+        if len(value) > max_batch_size:
+            raise serializers.ValidationError(_('单次最多处理{}条消息').format(max_batch_size))
+        
+        for message in value:
+            if not isinstance(message, (str, dict)):
+                raise serializers.ValidationError(_('每条消息必须是文本或消息对象'))
+        return value
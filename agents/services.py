@@ -1,11 +1,105 @@
 import logging
 import json
-from django.db.models import Q
+import threading
+import time
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 from .models import Agent, AgentListeningRule, AgentInteraction
+from .rule_index import rule_index
+from .matchers import KeywordScanner
+from .features import FeatureCache, MessageFeatures
+from .context_store import GroupContextStore, context_store as group_context_store
+from .rule_profiler import rule_profiler
+from .rule_pool import rule_pool
 
 logger = logging.getLogger(__name__)
 
+# 发送者缓存的最大条目数
+SENDER_CACHE_SIZE = 1024
+
+# 提交给进程池的消息保留的字段（上下文中的channel layer等对象无法跨进程传递）
+POOL_MESSAGE_FIELDS = (
+    'id', 'content', 'content_type', 'message_type', 'sender', 'group_id',
+    'mentions', 'timestamp', 'sentiment', 'context_messages',
+)
+
+
+# 合并评估时只对同一群组一组消息中的最后一条评估的触发类型
+# （这些规则依赖群组上下文而非单条消息内容，对突发消息逐条评估大多会被冷却丢弃）
+COALESCED_TRIGGER_TYPES = frozenset({
+    AgentListeningRule.TriggerType.CONTEXT_AWARE,
+    AgentListeningRule.TriggerType.ALL_MESSAGES,
+})
+
+
+class SenderAgentCache:
+    """
+    发送者ID到代理的缓存
+    
+    同时缓存"不是代理"的结果（普通用户或无效ID），避免每条消息都查询数据库。
+    代理保存或删除时由 agents/signals.py 使对应条目失效。
+    """
+    
+    def __init__(self, max_size=SENDER_CACHE_SIZE):
+        """
+        参数:
+        - max_size: 最大缓存条目数，超出时淘汰最久未使用的条目
+        """
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._agents = OrderedDict()
+    
+    def get(self, sender_id):
+        """
+        获取发送者对应的代理
+        
+        参数:
+        - sender_id: 发送者ID
+        
+        返回:
+        - Agent实例，发送者不是代理时返回None
+        """
+        key = str(sender_id)
+        with self._lock:
+            if key in self._agents:
+                self._agents.move_to_end(key)
+                return self._agents[key]
+        
+        try:
+            agent = Agent.objects.filter(id=sender_id).first()
+        except (ValueError, TypeError, ValidationError):
+            # 发送者ID不是代理ID格式（如用户名）
+            agent = None
+        
+        if agent is None:
+            logger.debug(f"发送者 {sender_id} 不是代理，跳过交互记录")
+        
+        with self._lock:
+            self._agents[key] = agent
+            self._agents.move_to_end(key)
+            while len(self._agents) > self._max_size:
+                self._agents.popitem(last=False)
+        return agent
+    
+    def invalidate(self, agent_id=None):
+        """
+        使缓存失效
+        
+        参数:
+        - agent_id: 代理ID，为None时清空全部缓存
+        """
+        with self._lock:
+            if agent_id is None:
+                self._agents.clear()
+            else:
+                self._agents.pop(str(agent_id), None)
+
+
+# 全局实例
+sender_cache = SenderAgentCache()
+
+
 class RuleEngine:
     """
     代理监听规则引擎
@@ -25,50 +119,194 @@ class RuleEngine:
         返回:
         - 规则响应列表
         """
+        return RuleEngine.process_batch([message], context)[0]
+    
+    @staticmethod
+    def process_batch(messages, context=None, dry_run=False, context_store=None, coalesce=False,
+                      agent_ids=None):
+        """
+        批量处理消息，用于历史回放、回填和批量接口
+        
+        整批消息共享同一组关键词/正则预过滤自动机和按文本缓存的特征
+        （分词、情感得分、主题向量），交互记录在整批处理完后一次写入。
+        
+        参数:
+        - messages: 消息列表
+        - context: 所有消息共享的上下文信息
+        - dry_run: 试运行，只计算匹配结果和响应，不记录触发统计和交互
+        - context_store: 群组上下文窗口（GroupContextStore），默认使用全局实例；
+          试运行默认使用本批独立的窗口，不影响线上消息的上下文
+        - coalesce: 合并评估突发消息，上下文感知和所有消息规则（COALESCED_TRIGGER_TYPES）
+          只对每个群组在本批中的最后一条消息评估一次（其上下文窗口已包含之前的消息），
+          提及、关键词等规则仍逐条评估
+        - agent_ids: 只评估这些代理（ID字符串集合）的规则，默认评估所有代理的规则
+        
+        返回:
+        - 与messages一一对应的规则响应列表
+        """
         if context is None:
             context = {}
+        if context_store is None:
+            context_store = GroupContextStore() if dry_run else group_context_store
+        
+        # 所有关键词规则共享一个自动机，正则规则共享一个预过滤自动机，每段文本只扫描一次
+        keyword_scanner = KeywordScanner(
+            rule_index.get_keyword_automaton(),
+            rule_index.get_regex_prefilter()
+        )
+        
+        # 整批共享的特征缓存，相同文本只分析一次
+        feature_cache = FeatureCache()
+        
+        # 本批消息产生的交互记录
+        interactions = []
+        
+        # 进程池模式下先准备整批消息，再一次性提交给工作进程
+        use_pool = rule_pool.enabled
+        prepared = []
+        pool_messages = []
+        
+        # 合并评估时，每个群组只有最后一条消息评估 COALESCED_TRIGGER_TYPES 的规则
+        coalesced_positions = set()
+        if coalesce:
+            last_positions = {}
+            for position, message in enumerate(messages):
+                group_id = (message.get('group_id') if isinstance(message, dict) else None) or context.get('group_id')
+                if group_id:
+                    if group_id in last_positions:
+                        coalesced_positions.add(last_positions[group_id])
+                    last_positions[group_id] = position
+        
+        results = []
+        for position, message in enumerate(messages):
+            skip_trigger_types = COALESCED_TRIGGER_TYPES if position in coalesced_positions else None
             
-        # 转换消息格式，确保包含必要的字段
-        normalized_message = RuleEngine._normalize_message(message, context)
-        
-        # 获取最近的消息历史作为上下文（如果可用）
-        if 'group_id' in normalized_message and 'message_history' in context:
-            group_id = normalized_message['group_id']
-            if group_id in context['message_history']:
-                normalized_message['context_messages'] = context['message_history'][group_id]
-        
-        # 如果消息内容是字符串，尝试进行情感分析
-        if isinstance(normalized_message.get('content', ''), str):
-            content = normalized_message['content']
-            try:
-                from agents.utils.sentiment_analyzer import analyze_sentiment
-                sentiment_score = analyze_sentiment(content)
-                normalized_message['sentiment'] = {
-                    'score': sentiment_score,
-                    'type': 'positive' if sentiment_score > 0.2 else ('negative' if sentiment_score < -0.2 else 'neutral')
-                }
-            except ImportError:
-                logger.warning("情感分析模块未找到，跳过情感分析")
-            except Exception as e:
-                logger.error(f"情感分析过程中出错: {str(e)}")
+            # 转换消息格式，确保包含必要的字段
+            normalized_message = RuleEngine._normalize_message(message, context)
+            
+            # 获取最近的消息历史作为上下文（如果可用）
+            if 'group_id' in normalized_message and 'message_history' in context:
+                group_id = normalized_message['group_id']
+                if group_id in context['message_history']:
+                    normalized_message['context_messages'] = context['message_history'][group_id]
+            
+            # 未显式提供上下文时，把消息记入所在群组的上下文窗口
+            context_window, context_entry = None, None
+            if 'context_messages' not in normalized_message:
+                context_window, context_entry = context_store.record(
+                    normalized_message.get('group_id'), normalized_message
+                )
             
-        # 获取可能适用的规则
-        applicable_rules = RuleEngine._get_applicable_rules(normalized_message)
+            # 消息特征（小写文本、分词、情感得分等）在首次被规则使用时才计算，所有规则共享
+            features = MessageFeatures(
+                normalized_message, feature_cache, context_window, context_entry
+            )
+            
+            if use_pool:
+                prepared.append((normalized_message, features, skip_trigger_types))
+                pool_messages.append(RuleEngine._message_for_pool(normalized_message, features))
+            else:
+                results.append(RuleEngine._evaluate_rules(
+                    normalized_message, keyword_scanner, features, interactions, dry_run,
+                    skip_trigger_types=skip_trigger_types, agent_ids=agent_ids
+                ))
+        
+        if use_pool:
+            # 特征提取和规则匹配在工作进程中并行完成，进程池不可用时在本进程中匹配
+            pool_matches = rule_pool.match(pool_messages)
+            for position, (normalized_message, features, skip_trigger_types) in enumerate(prepared):
+                results.append(RuleEngine._evaluate_rules(
+                    normalized_message, keyword_scanner, features, interactions, dry_run,
+                    matched_rule_ids=pool_matches[position] if pool_matches is not None else None,
+                    skip_trigger_types=skip_trigger_types, agent_ids=agent_ids
+                ))
+        
+        if not dry_run:
+            RuleEngine._save_interactions(interactions)
+        
+        return results
+    
+    @staticmethod
+    def _message_for_pool(normalized_message, features):
+        """
+        构造提交给进程池的消息：只保留匹配需要的字段，并显式附带上下文消息
+        
+        参数:
+        - normalized_message: 标准化的消息
+        - features: 消息特征
+        
+        返回:
+        - 可序列化的消息字典
+        """
+        pool_message = {
+            key: normalized_message[key]
+            for key in POOL_MESSAGE_FIELDS
+            if key in normalized_message
+        }
+        if 'context_messages' not in pool_message:
+            # 上下文窗口中当前消息之前的消息（当前消息由工作进程自行加入）
+            pool_message['context_messages'] = [
+                entry.to_dict() for entry in features.context.entries[:-1]
+            ]
+        return pool_message
+    
+    @staticmethod
+    def _evaluate_rules(normalized_message, keyword_scanner, features, interactions, dry_run=False,
+                        matched_rule_ids=None, skip_trigger_types=None, agent_ids=None):
+        """
+        对单条标准化消息依次评估适用的规则
+        
+        参数:
+        - normalized_message: 标准化的消息
+        - keyword_scanner: 共享的关键词扫描器
+        - features: 消息特征
+        - interactions: 交互记录列表，新记录追加到其中
+        - dry_run: 试运行，不记录触发统计和交互
+        - matched_rule_ids: 进程池中已匹配的规则ID集合，提供时不在本进程中匹配，
+          只检查激活状态和冷却时间
+        - skip_trigger_types: 不评估的触发类型（合并评估时由同组最后一条消息统一评估）
+        - agent_ids: 只评估这些代理的规则，其他代理的规则不参与评估（也不会阻止后续规则）
+        
+        返回:
+        - 规则响应列表
+        """
+        # 获取可能适用的规则（按优先级、规则ID排序，评估顺序和结果不随匹配耗时变化）
+        applicable_rules = RuleEngine._get_applicable_rules(normalized_message, features)
         
         # 存储规则响应
         responses = []
         
+        # 是否记录规则级性能数据
+        profiling = rule_profiler.enabled
+        
         # 遍历规则并检查匹配
-        for rule in applicable_rules:
+        for compiled in applicable_rules:
+            rule = compiled.rule
+            if skip_trigger_types and rule.trigger_type in skip_trigger_types:
+                continue
+            if agent_ids is not None and compiled.agent_id not in agent_ids:
+                continue
+            started = None
             try:
                 # 检查规则是否可以触发
                 if not rule.can_trigger():
                     continue
                 
-                # 检查消息是否匹配规则
-                if rule.match_message(normalized_message):
+                if matched_rule_ids is not None:
+                    matched = compiled.id in matched_rule_ids
+                else:
+                    # 检查消息是否匹配规则
+                    if profiling:
+                        started = time.perf_counter()
+                        matched = rule.match_message(normalized_message, keyword_scanner, features)
+                        rule_profiler.record(rule, time.perf_counter() - started, matched)
+                        started = None
+                    else:
+                        matched = rule.match_message(normalized_message, keyword_scanner, features)
+                
+                if matched:
                     # 执行规则响应
-                    response = rule.execute_response(normalized_message)
+                    response = rule.execute_response(normalized_message, record_trigger=not dry_run)
                     
                     if response:
                         # 添加规则元数据
@@ -79,22 +317,52 @@ class RuleEngine:
                             'priority': rule.priority
                         }
                         
-                        # 记录交互
-                        RuleEngine._record_interaction(rule, normalized_message, response)
+                        # 收集交互记录，处理完所有消息后批量写入
+                        if not dry_run:
+                            RuleEngine._record_interaction(rule, normalized_message, response, interactions)
                         
                         # 添加到响应列表
                         responses.append(response)
                         
                         # 如果是高优先级规则且配置为独占，则停止处理其他规则
-                        if rule.priority <= 5 and rule.trigger_condition.get('exclusive', False):
+                        if compiled.stops_evaluation:
                             break
                             
             except Exception as e:
                 logger.error(f"处理规则 {rule.name} (ID: {rule.id}) 时出错: {str(e)}", exc_info=True)
+                if profiling:
+                    rule_profiler.record_error(
+                        rule, time.perf_counter() - started if started is not None else None
+                    )
                 continue
         
         return responses
     
+    @staticmethod
+    def message_from_group_message(group_message):
+        """
+        把存储的消息转换为规则引擎可处理的格式
+        
+        参数:
+        - group_message: GroupMessage或messaging.Message实例
+          （建议预先prefetch提及代理）
+        
+        返回:
+        - 消息字典
+        """
+        content = group_message.content
+        # GroupMessage使用timestamp字段，messaging.Message使用created_at字段
+        sent_at = getattr(group_message, 'timestamp', None) or group_message.created_at
+        return {
+            'id': str(group_message.id),
+            'content': content.get('text', '') if isinstance(content, dict) else str(content),
+            'message_type': group_message.message_type,
+            'sender': str(group_message.sender_user_id) if group_message.sender_user_id else None,
+            'group_id': str(group_message.group_id) if group_message.group_id else None,
+            'mentions': [str(agent.id) for agent in group_message.mentioned_agents.all()],
+            'timestamp': sent_at.isoformat()
+        }
+    
     @staticmethod
     def _normalize_message(message, context):
         """
@@ -134,8 +402,8 @@ class RuleEngine:
             
         # 处理提及信息
         if 'content' in normalized and isinstance(normalized['content'], str):
-            # 提取@提及
-            mentions = []
+            # 保留调用方提供的提及（如代理ID），再追加从内容中提取的@提及
+            mentions = [str(mention) for mention in normalized.get('mentions') or []]
             content = normalized['content']
             
             # 匹配@用户或@agent:名称格式
@@ -144,83 +412,77 @@ class RuleEngine:
             found_mentions = re.finditer(mention_pattern, content)
             
             for match in found_mentions:
-                mentions.append(match.group(1))
+                if match.group(1) not in mentions:
+                    mentions.append(match.group(1))
             
             normalized['mentions'] = mentions
             
         return normalized
     
     @staticmethod
-    def _get_applicable_rules(message):
+    def _get_applicable_rules(message, features=None):
         """
         获取可能适用于该消息的规则
         
+        规则来自进程内的已编译规则索引（见 rule_index.py），
+        按消息所在的群组/直接消息范围以及被提及的代理分桶查找，不查询数据库
+        
         参数:
         - message: 标准化的消息
+        - features: 可选的消息特征，提供时复用其中已解析的被提及代理
         
         返回:
-        - 规则查询集，按优先级排序
+        - CompiledRule列表，按优先级排序
         """
-        # 基本查询条件：规则必须处于激活状态
-        query = Q(is_active=True)
-        
-        # 根据消息上下文筛选规则
-        group_id = message.get('group_id')
-        
-        if group_id:
-            # 群组消息
-            query &= Q(listen_in_groups=True)
-            
-            # 检查是否限制了特定群组
-            query &= (
-                Q(allowed_groups=[]) |  # 空列表表示所有群组
-                Q(allowed_groups__contains=[str(group_id)])
-            )
-        else:
-            # 直接消息
-            query &= Q(listen_in_direct=True)
-        
-        # 如果消息中有明确提到的代理
-        mentions = message.get('mentions', [])
-        if mentions:
-            # 查找被提及的代理的规则
-            query |= Q(agent__id__in=mentions, trigger_type='mention')
-            
-        # 查询规则并按优先级排序
-        return AgentListeningRule.objects.filter(query).order_by('priority')
+        if features is not None:
+            return rule_index.get_rules(message, features.mentioned_agent_ids)
+        return rule_index.get_rules(message)
     
     @staticmethod
-    def _record_interaction(rule, message, response):
+    def _record_interaction(rule, message, response, interactions):
         """
-        记录代理与消息发送者的交互
+        收集代理与消息发送者的交互记录
         
         参数:
         - rule: 触发的规则
         - message: 消息内容
         - response: 规则响应
+        - interactions: 本条消息的交互记录列表，新记录追加到其中
         """
         # 仅当消息中包含发送者信息时才记录
         sender_id = message.get('sender')
         if not sender_id:
             return
             
-        try:
-            # 查找发送者代理
-            sender_agent = Agent.objects.get(id=sender_id)
-            
-            # 创建交互记录
-            AgentInteraction.objects.create(
-                initiator=sender_agent,
-                receiver=rule.agent,
-                interaction_type='message',
-                content={
-                    'user_message': message.get('content', ''),
-                    'agent_response': response.get('content', '')
-                }
-            )
-        except Agent.DoesNotExist:
+        # 发送者代理通过缓存解析，同一条消息只解析一次
+        sender_agent = sender_cache.get(sender_id)
+        if sender_agent is None:
             # 发送者不是代理，可能是普通用户
-            logger.debug(f"发送者 {sender_id} 不是代理，跳过交互记录")
+            return
+            
+        interactions.append(AgentInteraction(
+            initiator=sender_agent,
+            receiver=rule.agent,
+            interaction_type='message',
+            content={
+                'user_message': message.get('content', ''),
+                'agent_response': response.get('content', '')
+            }
+        ))
+    
+    @staticmethod
+    def _save_interactions(interactions):
+        """
+        批量写入交互记录
+        
+        参数:
+        - interactions: AgentInteraction实例列表
+        """
+        if not interactions:
+            return
+            
+        try:
+            AgentInteraction.objects.bulk_create(interactions)
         except Exception as e:
             logger.error(f"记录交互时出错: {str(e)}")
             
@@ -5,7 +5,14 @@
 import logging
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Agent, AgentListeningRule
+from groups.models import GroupMessage
+from messaging.models import Message
+from task_management.models import Task
+from .models import Agent, AgentListeningRule, AgentSkill
+from .knowledge_index import document_key, knowledge_index
+from .rule_index import rule_index
+from .rule_stats import rule_stats
+from .services import sender_cache
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +32,13 @@ def agent_saved(sender, instance, created, **kwargs):
         if instance.status == 'disabled':
             logger.warning(f"代理已被禁用: {instance.name} (ID: {instance.id})")
             
+        # 同步规则索引中的代理信息（如名称变更会影响提及匹配）
+        if not created:
+            rule_index.refresh_agent(instance)
+            
+        # 发送者缓存可能缓存了旧的代理对象或"不是代理"的结果
+        sender_cache.invalidate(instance.id)
+            
     except Exception as e:
         logger.error(f"处理代理保存信号时出错: {str(e)}", exc_info=True)
 
@@ -36,6 +50,8 @@ def agent_deleted(sender, instance, **kwargs):
     """
     try:
         logger.info(f"代理已删除: {instance.name} (ID: {instance.id})")
+        
+        sender_cache.invalidate(instance.id)
     except Exception as e:
         logger.error(f"处理代理删除信号时出错: {str(e)}", exc_info=True)
 
@@ -55,6 +71,13 @@ def rule_saved(sender, instance, created, **kwargs):
         if not instance.is_active:
             logger.warning(f"监听规则已被禁用: {instance.name} (ID: {instance.id})")
             
+        # 增量更新规则索引，显式保存的最近触发时间覆盖进程内统计
+        # （完整保存只在调用方修改了 last_triggered 时写入它，见 AgentListeningRule.save）
+        rule_index.upsert(instance)
+        update_fields = kwargs.get('update_fields')
+        if created or update_fields is None or 'last_triggered' in update_fields:
+            rule_stats.sync(instance)
+            
     except Exception as e:
         logger.error(f"处理监听规则保存信号时出错: {str(e)}", exc_info=True)
 
@@ -66,5 +89,39 @@ def rule_deleted(sender, instance, **kwargs):
     """
     try:
         logger.info(f"监听规则已删除: {instance.name} (ID: {instance.id})")
+        
+        # 从规则索引和触发统计中移除
+        rule_index.remove(instance.id)
+        rule_stats.forget(instance.id)
+    except Exception as e:
+        logger.error(f"处理监听规则删除信号时出错: {str(e)}", exc_info=True) 
+
+
+@receiver(post_save, sender=GroupMessage)
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=Task)
+@receiver(post_save, sender=AgentSkill)
+def knowledge_source_saved(sender, instance, **kwargs):
+    """
+    知识索引收录的对象（消息、任务、技能）保存后增量更新索引
+    """
+    try:
+        if knowledge_index is not None:
+            knowledge_index.index(instance)
+    except Exception as e:
+        logger.error(f"更新知识索引时出错: {str(e)}", exc_info=True)
+
+
+@receiver(post_delete, sender=GroupMessage)
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=Task)
+@receiver(post_delete, sender=AgentSkill)
+def knowledge_source_deleted(sender, instance, **kwargs):
+    """
+    知识索引收录的对象删除后从索引中移除
+    """
+    try:
+        if knowledge_index is not None:
+            knowledge_index.delete(*document_key(instance))
     except Exception as e:
-        logger.error(f"处理监听规则删除信号时出错: {str(e)}", exc_info=True) 
\ No newline at end of file
+        logger.error(f"从知识索引中删除时出错: {str(e)}", exc_info=True)
@@ -0,0 +1,293 @@
+"""
+群组对话摘要
+
+summarize_conversation 动作使用的本地抽取式摘要，不访问网络：
+
+- 消息按句切分、jieba 分词，累计群组内的词频
+- 句子得分为其中各词的平均词频（越能代表对话中反复出现的话题，得分越高），
+  过短的句子降权；按得分依次选取句子，跳过与已选句子重复度过高的句子，
+  最后按时间顺序输出
+- 每个群组保存一份滚动摘要（ConversationSummary）：词频统计、上次选出的候选句子
+  和已总结的最后一条消息ID。再次总结时只读取水位之后的新消息，与保留的候选句子
+  一起重新选取，代价与新消息数量成正比，与历史长度无关
+
+分词和选句是CPU密集型计算，开启规则匹配进程池（PROCESS_POOL_WORKERS）时在工作进程中执行。
+"""
+
+import logging
+import math
+import re
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db.models import Q
+
+from groups.models import Group, GroupMessage
+from messaging.models import Message
+from .models import ConversationSummary
+from .rule_pool import rule_pool
+
+logger = logging.getLogger(__name__)
+
+# 默认摘要的句子数量
+DEFAULT_SUMMARY_SENTENCES = 5
+
+# 第一次总结或积压过多时最多读取的最近消息数量
+DEFAULT_SUMMARY_HISTORY = 500
+
+# 保留的词频条目上限，超出后只保留出现次数最多的词
+MAX_SUMMARY_TERMS = 5000
+
+# 与已选句子的词重合度（Jaccard）不低于该值时视为重复
+REDUNDANCY_THRESHOLD = 0.5
+
+# 群组摘要更新锁的分段数量，群组按ID散列到固定数量的锁上，锁的数量不随群组增长
+SUMMARY_LOCK_STRIPES = 64
+
+# 参与打分的最短句子长度（字符）
+MIN_SENTENCE_LENGTH = 4
+
+# 少于该词数的句子按比例降权
+SHORT_SENTENCE_TERMS = 4
+
+_SENTENCE_SPLIT = re.compile(r'[。！？!?；;\n]+|(?<=[a-zA-Z])\.\s+')
+
+# 不参与词频统计的常见虚词
+STOPWORDS = frozenset(
+    '的 了 是 在 我 你 他 她 它 我们 你们 他们 这 那 这个 那个 就 也 都 和 与 或 吗 呢 吧 啊 哦 嗯 '
+    '有 没有 不 没 很 还 又 把 被 让 给 对 说 要 会 能 可以 一个 一下 什么 怎么 为什么 '
+    'the a an is are was were be to of and or in on at for it this that with as'.split()
+)
+
+
+def split_sentences(text):
+    """
+    把消息文本切分为句子
+
+    参数:
+    - text: 消息文本
+
+    返回:
+    - 去掉首尾空白后长度足够的句子列表
+    """
+    sentences = (sentence.strip() for sentence in _SENTENCE_SPLIT.split(text or ''))
+    return [sentence for sentence in sentences if len(sentence) >= MIN_SENTENCE_LENGTH]
+
+
+def _terms(text):
+    """分词并去掉标点、单字符和虚词"""
+    import jieba
+
+    terms = []
+    for word in jieba.lcut(text.lower()):
+        word = word.strip()
+        if len(word) < 2 or word in STOPWORDS or not any(char.isalnum() for char in word):
+            continue
+        terms.append(word)
+    return terms
+
+
+def _score(terms, counts):
+    """句子得分：各词的平均对数词频，过短的句子降权"""
+    if not terms:
+        return 0.0
+    score = sum(math.log1p(counts.get(term, 0)) for term in terms) / len(terms)
+    return score * min(1.0, len(terms) / SHORT_SENTENCE_TERMS)
+
+
+def _overlap(terms, other):
+    """两个句子的词重合度"""
+    union = len(terms | other)
+    return len(terms & other) / union if union else 0.0
+
+
+def summarize_messages(state, messages, max_sentences=DEFAULT_SUMMARY_SENTENCES):
+    """
+    用新消息更新滚动摘要（纯函数，可在工作进程中执行）
+
+    参数:
+    - state: 上次的摘要状态（ConversationSummary.state），第一次为空字典
+    - messages: 按时间顺序排列的新消息，每条包含 id、sender、content
+    - max_sentences: 摘要的句子数量
+
+    返回:
+    - (新的摘要状态, 摘要文本)
+    """
+    counts = Counter(state.get('terms', {}))
+    candidates = list(state.get('sentences', []))
+    seq = state.get('seq', 0)
+
+    for message in messages:
+        for text in split_sentences(message.get('content')):
+            terms = _terms(text)
+            counts.update(terms)
+            seq += 1
+            candidates.append({
+                'seq': seq,
+                'message_id': message.get('id'),
+                'sender': message.get('sender'),
+                'text': text,
+                'terms': sorted(set(terms)),
+            })
+
+    if len(counts) > MAX_SUMMARY_TERMS:
+        counts = Counter(dict(counts.most_common(MAX_SUMMARY_TERMS)))
+
+    # 按得分选句，跳过与已选句子重复的句子
+    ranked = sorted(
+        candidates,
+        key=lambda candidate: (_score(candidate['terms'], counts), candidate['seq']),
+        reverse=True
+    )
+    selected = []
+    selected_terms = []
+    for candidate in ranked:
+        if len(selected) >= max_sentences:
+            break
+        terms = set(candidate['terms'])
+        if not terms or any(_overlap(terms, other) >= REDUNDANCY_THRESHOLD for other in selected_terms):
+            continue
+        selected.append(candidate)
+        selected_terms.append(terms)
+    selected.sort(key=lambda candidate: candidate['seq'])
+
+    new_state = {'terms': dict(counts), 'sentences': selected, 'seq': seq}
+    summary = '\n'.join(
+        f"{candidate['sender']}: {candidate['text']}" if candidate.get('sender') else candidate['text']
+        for candidate in selected
+    )
+    return new_state, summary
+
+
+def _message_text(content):
+    """取出存储消息的文本内容"""
+    return content.get('text', '') if isinstance(content, dict) else str(content)
+
+
+def _sender_name(stored_message):
+    """存储消息的发送者名称"""
+    if stored_message.sender_agent_id:
+        return stored_message.sender_agent.name
+    if stored_message.sender_user_id:
+        return stored_message.sender_user.username
+    return None
+
+
+class ConversationSummarizer:
+    """
+    群组对话摘要服务
+
+    同一群组的摘要更新串行执行，避免并发的总结请求重复统计同一批消息。
+    """
+
+    def __init__(self, max_sentences=None, history_limit=None):
+        """
+        参数:
+        - max_sentences: 摘要的句子数量，默认读取 RULE_ENGINE_CONFIG['SUMMARY_MAX_SENTENCES']
+        - history_limit: 每次最多读取的消息数量，默认读取 RULE_ENGINE_CONFIG['SUMMARY_HISTORY_LIMIT']
+        """
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        self.max_sentences = max_sentences or config.get('SUMMARY_MAX_SENTENCES', DEFAULT_SUMMARY_SENTENCES)
+        self.history_limit = history_limit or config.get('SUMMARY_HISTORY_LIMIT', DEFAULT_SUMMARY_HISTORY)
+        self._group_locks = [threading.Lock() for _ in range(SUMMARY_LOCK_STRIPES)]
+
+    def _group_lock(self, group_id):
+        """获取群组的摘要更新锁（分段锁，不同群组可能共用同一把锁）"""
+        return self._group_locks[hash(str(group_id)) % len(self._group_locks)]
+
+    def summarize(self, group_id):
+        """
+        增量更新并返回群组的对话摘要（同步执行，会查询数据库）
+
+        参数:
+        - group_id: 群组ID
+
+        返回:
+        - ConversationSummary实例
+        """
+        with self._group_lock(group_id):
+            group = Group.objects.get(id=group_id)
+            summary, _created = ConversationSummary.objects.get_or_create(group=group)
+
+            messages, watermarks = self._new_messages(summary)
+            if not messages:
+                return summary
+
+            state, text = self._run(summary.state, messages)
+
+            summary.state = state
+            summary.summary = text
+            summary.message_count += len(messages)
+            for field, value in watermarks.items():
+                setattr(summary, field, value)
+            summary.save()
+
+            logger.info(f"群组 {group_id} 的对话摘要已更新，新增消息 {len(messages)} 条")
+            return summary
+
+    def _run(self, state, messages):
+        """在进程池（开启时）或当前线程中计算摘要"""
+        future = rule_pool.submit(summarize_messages, state, messages, self.max_sentences)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                logger.error(f"工作进程计算对话摘要失败，改为在当前进程中计算: {str(e)}", exc_info=True)
+        return summarize_messages(state, messages, self.max_sentences)
+
+    def _new_messages(self, summary):
+        """
+        读取水位之后的群组消息和消息中心消息
+
+        返回:
+        - (按时间顺序排列的消息列表, 需要更新的水位字段)
+        """
+        group_messages = list(
+            GroupMessage.objects.filter(
+                group_id=summary.group_id,
+                message_type=GroupMessage.MessageType.TEXT,
+                id__gt=summary.last_group_message_id
+            ).exclude(
+                sender_type=GroupMessage.SenderType.SYSTEM
+            ).select_related('sender_user', 'sender_agent').order_by('-id')[:self.history_limit]
+        )
+
+        ws_queryset = Message.objects.filter(
+            group_id=summary.group_id,
+            message_type=Message.MessageType.CHAT
+        )
+        if summary.last_message_at is not None:
+            ws_queryset = ws_queryset.filter(
+                Q(created_at__gt=summary.last_message_at)
+                | Q(created_at=summary.last_message_at, id__gt=summary.last_message_id)
+            )
+        ws_messages = list(
+            ws_queryset.select_related('sender_user', 'sender_agent')
+            .order_by('-created_at', '-id')[:self.history_limit]
+        )
+
+        watermarks = {}
+        if group_messages:
+            watermarks['last_group_message_id'] = group_messages[0].id
+        if ws_messages:
+            watermarks['last_message_at'] = ws_messages[0].created_at
+            watermarks['last_message_id'] = ws_messages[0].id
+
+        stored = sorted(
+            group_messages + ws_messages,
+            key=lambda stored_message: getattr(stored_message, 'timestamp', None) or stored_message.created_at
+        )[-self.history_limit:]
+        messages = [
+            {
+                'id': str(stored_message.id),
+                'sender': _sender_name(stored_message),
+                'content': _message_text(stored_message.content),
+            }
+            for stored_message in stored
+        ]
+        return messages, watermarks
+
+
+# 全局实例
+conversation_summarizer = ConversationSummarizer()
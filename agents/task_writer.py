@@ -0,0 +1,350 @@
+"""
+规则任务的批量写入
+
+TASK 类型的规则响应不在处理函数中逐条调用 Task.save()（每次保存都会触发
+状态检查查询和多个信号），而是放入进程内缓冲区，由后台线程每隔
+RULE_ENGINE_CONFIG['TASK_WRITER_FLUSH_INTERVAL'] 秒（或缓冲区达到
+TASK_WRITER_BATCH_SIZE 条时）批量写入：
+
+- 任务、代理分配和系统评论分别用一次 bulk_create 写入
+- 以 "消息ID:规则ID" 作为任务的来源标识（Task.source_key，唯一）去重，
+  同一条消息被重放、重试或重复提交时只创建一个任务
+- 每个批次按群组只广播一次 agent.task_created 事件，包含该群组本批次创建的所有任务
+
+bulk_create 不触发信号，任务的知识索引在写入后直接更新。
+写入失败时整批放回缓冲区等待下次刷新；缓冲区超过 TASK_WRITER_MAX_PENDING 条时，
+最早的任务写入死信（ResponseDeadLetter），可在管理后台重放。
+"""
+
+import atexit
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from groups.models import Group
+from task_management.models import Task, TaskAssignment, TaskComment
+from .knowledge_index import knowledge_index
+from .models import Agent, ResponseDeadLetter
+from .processor_journal import json_safe
+
+logger = logging.getLogger(__name__)
+
+# 默认刷新间隔（秒）
+DEFAULT_TASK_FLUSH_INTERVAL = 1.0
+
+# 缓冲区达到该数量时立即写入
+DEFAULT_TASK_BATCH_SIZE = 200
+
+# 写入失败时缓冲区最多保留的任务数量，超出的最早的任务写入死信
+DEFAULT_TASK_MAX_PENDING = 10000
+
+
+def source_key(response, context):
+    """
+    任务的来源标识
+
+    参数:
+    - response: TASK类型的规则响应
+    - context: 上下文信息
+
+    返回:
+    - "消息ID:规则ID"，没有消息ID时返回None（不去重）
+    """
+    message_id = response.get('message_id') or context.get('message_id')
+    if not message_id:
+        return None
+    return f"{message_id}:{response.get('rule_id', '')}"
+
+
+class TaskWriter:
+    """
+    规则任务的批量写入器
+
+    数据说明:
+    - _pending: 等待写入的 (规则响应, 上下文)，按来源标识去重
+    """
+
+    def __init__(self, flush_interval=None, batch_size=None, max_pending=None):
+        """
+        参数:
+        - flush_interval: 刷新间隔（秒），为None时读取配置
+        - batch_size: 缓冲区达到该数量时立即写入，为None时读取配置
+        - max_pending: 写入失败时缓冲区最多保留的任务数量，为None时读取配置
+        """
+        config = getattr(settings, 'RULE_ENGINE_CONFIG', {})
+        self.flush_interval = flush_interval or config.get('TASK_WRITER_FLUSH_INTERVAL', DEFAULT_TASK_FLUSH_INTERVAL)
+        self.batch_size = batch_size or config.get('TASK_WRITER_BATCH_SIZE', DEFAULT_TASK_BATCH_SIZE)
+        self.max_pending = max_pending or config.get('TASK_WRITER_MAX_PENDING', DEFAULT_TASK_MAX_PENDING)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._unkeyed = 0
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def submit(self, response, context):
+        """
+        提交一个任务创建响应
+
+        参数:
+        - response: TASK类型的规则响应
+        - context: 上下文信息
+
+        返回:
+        - 是否加入缓冲区；同一来源标识已在缓冲区中时返回False
+        """
+        key = source_key(response, context)
+        with self._lock:
+            if key is None:
+                self._unkeyed += 1
+                key = ('unkeyed', self._unkeyed)
+            elif key in self._pending:
+                return False
+            self._pending[key] = (response, context)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+        return True
+
+    def pending_count(self):
+        """等待写入的任务数量"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        把缓冲区中的任务批量写入数据库，并按群组广播
+
+        返回:
+        - 本次创建的任务列表
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+            if not pending:
+                return []
+
+            try:
+                created = self._write(pending)
+            except Exception as e:
+                logger.error(f"批量创建规则任务时出错，{len(pending)} 个任务放回缓冲区: {str(e)}", exc_info=True)
+                self._restore(pending, str(e))
+                return []
+
+        if created:
+            logger.info(f"已批量创建 {len(created)} 个规则任务")
+            self._index(created)
+            self._broadcast(created)
+        return created
+
+    def _restore(self, pending, error):
+        """
+        写入失败时把一批任务放回缓冲区（排在写入期间新提交的任务之前）
+
+        写入期间再次提交的相同来源标识只保留一份；超出 max_pending 的最早的任务写入死信
+        """
+        with self._lock:
+            merged = OrderedDict(pending)
+            for key, entry in self._pending.items():
+                merged.setdefault(key, entry)
+            overflow = []
+            while len(merged) > self.max_pending:
+                overflow.append(merged.popitem(last=False)[1])
+            self._pending = merged
+
+        for response, context in overflow:
+            try:
+                ResponseDeadLetter.objects.create(
+                    stage=ResponseDeadLetter.Stage.HANDLER,
+                    response_type=response.get('type', 'task'),
+                    response=json_safe(response),
+                    context=json_safe(context),
+                    attempts=1,
+                    last_error=error
+                )
+            except Exception as e:
+                logger.error(f"规则任务写入死信失败，任务已丢失: {response.get('task_title', '')}: {str(e)}", exc_info=True)
+        if overflow:
+            logger.error(f"规则任务缓冲区超过 {self.max_pending} 条，{len(overflow)} 个任务已写入死信")
+
+    def _write(self, pending):
+        """
+        写入一批任务、分配和系统评论
+
+        返回:
+        - 创建的任务列表（task.agent 为创建任务的代理）
+        """
+        keys = [key for key in pending if isinstance(key, str)]
+        existing = set(Task.objects.filter(source_key__in=keys).values_list('source_key', flat=True))
+
+        agents = Agent.objects.in_bulk({
+            _as_pk(response.get('agent_id')) for response, _context in pending.values()
+        } - {None})
+        groups = set(Group.objects.filter(id__in={
+            _as_pk(context.get('group_id')) for _response, context in pending.values()
+        } - {None}).values_list('id', flat=True))
+
+        tasks = []
+        task_agents = {}
+        for key, (response, context) in pending.items():
+            if key in existing:
+                continue
+            agent = agents.get(_as_pk(response.get('agent_id')))
+            if agent is None:
+                logger.warning(f"规则任务的代理不存在，已忽略: {response.get('agent_id')}")
+                continue
+            group_id = _as_pk(context.get('group_id'))
+            task = Task(
+                title=(response.get('task_title') or '新任务')[:200],
+                description=response.get('task_description') or '',
+                creator_id=agent.owner_id,
+                group_id=group_id if group_id in groups else None,
+                source_key=key if isinstance(key, str) else None,
+                metadata={
+                    'created_by_agent': str(agent.id),
+                    'rule_id': response.get('rule_id'),
+                    'rule_name': response.get('rule_name'),
+                    'message_id': response.get('message_id') or context.get('message_id'),
+                },
+            )
+            tasks.append(task)
+            task_agents[task.id] = agent
+        if not tasks:
+            return []
+
+        with transaction.atomic():
+            # 其他进程可能已经写入了相同来源标识的任务，冲突的行被忽略
+            Task.objects.bulk_create(tasks, ignore_conflicts=True)
+            inserted = set(Task.objects.filter(id__in=[task.id for task in tasks]).values_list('id', flat=True))
+            tasks = [task for task in tasks if task.id in inserted]
+
+            TaskAssignment.objects.bulk_create([
+                TaskAssignment(
+                    task=task,
+                    assigned_by_id=task.creator_id,
+                    assigned_agent=task_agents[task.id],
+                    is_primary=True,
+                    role='规则创建'
+                )
+                for task in tasks
+            ])
+            TaskComment.objects.bulk_create([
+                TaskComment(
+                    task=task,
+                    content=(
+                        f"代理 {task_agents[task.id].name} 根据规则 {task.metadata['rule_name'] or task.metadata['rule_id']} "
+                        f"创建了任务，任务分配给 {task_agents[task.id].name}"
+                    ),
+                    is_system_comment=True,
+                    metadata={'message_id': task.metadata['message_id']}
+                )
+                for task in tasks
+            ])
+        for task in tasks:
+            task.agent = task_agents[task.id]
+        return tasks
+
+    def _index(self, tasks):
+        """bulk_create 不触发信号，直接更新知识索引"""
+        if knowledge_index is None:
+            return
+        for task in tasks:
+            knowledge_index.index(task)
+
+    def _broadcast(self, tasks):
+        """每个群组广播一次本批次创建的任务"""
+        by_group = defaultdict(list)
+        for task in tasks:
+            if task.group_id:
+                by_group[task.group_id].append(task)
+        if not by_group:
+            return
+
+        channel_layer = get_channel_layer()
+        now = timezone.now()
+        for group_id, group_tasks in by_group.items():
+            try:
+                async_to_sync(channel_layer.group_send)(f"group_{group_id}", {
+                    'type': 'agent.task_created',
+                    'message': {
+                        'id': f"tasks-{now.timestamp()}-{group_id}",
+                        'message_type': 'task_created',
+                        'sender': {
+                            'id': 'system',
+                            'type': 'system',
+                            'name': '任务管理'
+                        },
+                        'payload': {
+                            'tasks': [
+                                {
+                                    'task_id': str(task.id),
+                                    'task_title': task.title,
+                                    'task_description': task.description,
+                                    'agent_id': str(task.agent.id),
+                                    'agent_name': task.agent.name,
+                                    'rule_id': task.metadata.get('rule_id'),
+                                    'message_id': task.metadata.get('message_id'),
+                                }
+                                for task in group_tasks
+                            ],
+                            'task_count': len(group_tasks)
+                        },
+                        'timestamp': now.isoformat(),
+                        'metadata': {
+                            'response_type': 'task',
+                            'rule_engine': 'v1.0'
+                        }
+                    }
+                })
+            except Exception as e:
+                logger.error(f"广播群组 {group_id} 的任务创建事件时出错: {str(e)}", exc_info=True)
+
+    def start(self):
+        """启动后台写入线程"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='rule-task-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"规则任务批量写入线程已启动，间隔 {self.flush_interval} 秒，批次 {self.batch_size} 条")
+
+    def stop(self):
+        """停止后台写入线程并写入剩余任务"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5)
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        """后台写入循环：间隔到期或缓冲区已满时写入"""
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+def _as_pk(value):
+    """代理或群组ID（字符串或整数）转换为主键，无法转换时返回None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# 全局实例
+task_writer = TaskWriter()
@@ -1,13 +1,19 @@
 import pytest
 import asyncio
+import queue
 import threading
 import time
+from unittest import mock
 from unittest.mock import patch, MagicMock
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
 
-from agents.async_processor import AsyncMessageProcessor
-from agents.models import Agent, AgentListeningRule
+from agents.async_processor import (
+    AsyncMessageProcessor, PriorityLaneQueue, classify_lane, partition_key,
+    LANE_MENTION, LANE_GROUP, LANE_BULK
+)
+from agents.models import Agent, AgentListeningRule, ResponseDeadLetter
 
 User = get_user_model()
 
@@ -137,13 +143,14 @@ class AsyncProcessorTestCase(TestCase):
         # 模拟channel_layer
         mock_channel_layer = MagicMock()
         mock_get_channel_layer.return_value = mock_channel_layer
-        mock_channel_layer.group_send = AsyncMock()
+        # 使用标准库的AsyncMock记录await调用（本文件的AsyncMock只模拟调用）
+        mock_channel_layer.group_send = mock.AsyncMock()
         
         # 设置处理器的channel_layer
         self.processor.channel_layer = mock_channel_layer
         
         # 注册处理函数
-        mock_handler = AsyncMock()
+        mock_handler = mock.AsyncMock(return_value={'message_type': 'agent_response'})
         self.processor.register_handler('auto_reply', mock_handler)
         
         # 创建回调函数
@@ -165,13 +172,457 @@ class AsyncProcessorTestCase(TestCase):
         # 等待异步处理
         time.sleep(0.5)
         
-        # 验证group_send被调用
-        args, kwargs = mock_channel_layer.group_send.await_args
+        # 验证一条消息的响应合并为一个agent.batch事件发送到群组
+        mock_channel_layer.group_send.assert_awaited_once()
+        args, kwargs = mock_channel_layer.group_send.call_args
         self.assertEqual(args[0], 'group_group1')
-        self.assertEqual(args[1]['type'], 'agent.message')
+        self.assertEqual(args[1]['type'], 'agent.batch')
         
         # 验证处理函数被调用
         mock_handler.assert_awaited_once()
+    
+    @patch('agents.async_processor.AsyncMessageProcessor._store_dead_letter')
+    @patch('agents.services.RuleEngine.process_message')
+    def test_response_without_group(self, mock_process_message, mock_store_dead_letter):
+        """测试没有群组的消息：响应发送到会话频道组，没有频道组时写入死信"""
+        mock_process_message.return_value = [{'type': 'auto_reply', 'content': '回复'}]
+        stored = threading.Event()
+        mock_store_dead_letter.side_effect = lambda *args: stored.set()
+        
+        processor = AsyncMessageProcessor(workers=1)
+        processor.channel_layer = MagicMock()
+        processor.channel_layer.group_send = mock.AsyncMock()
+        try:
+            context = {'group_id': None, 'room_group_name': 'chat_room1', 'message_id': 'm1'}
+            processor.add_message({'content': '你好'}, context).result(timeout=2)
+            deadline = time.time() + 2
+            while not processor.channel_layer.group_send.await_count and time.time() < deadline:
+                time.sleep(0.01)
+            args, kwargs = processor.channel_layer.group_send.call_args
+            self.assertEqual(args[0], 'chat_room1')
+            self.assertEqual(args[1]['messages'][0]['content'], '回复')
+            
+            processor.add_message({'content': '你好'}, {'message_id': 'm2'}).result(timeout=2)
+            self.assertTrue(stored.wait(timeout=2))
+        finally:
+            processor.stop()
+        
+        self.assertEqual(processor.channel_layer.group_send.await_count, 1)
+        stage, event, context, attempts, error = mock_store_dead_letter.call_args[0]
+        self.assertEqual(stage, ResponseDeadLetter.Stage.CHANNEL)
+        self.assertEqual(event['message_id'], 'm2')
+        self.assertEqual(processor.stats()['dead_letters'], 1)
+
+    @patch('agents.services.RuleEngine.process_message')
+    def test_slow_message_does_not_block_other_workers(self, mock_process_message):
+        """测试一条消息处理缓慢时其他工作线程继续处理"""
+        release = threading.Event()
+        fast_done = threading.Event()
+        
+        def process_message(message, context):
+            if message['content'] == 'slow':
+                release.wait(timeout=5)
+            return []
+        
+        mock_process_message.side_effect = process_message
+        
+        processor = AsyncMessageProcessor(workers=2, queue_size=10)
+        try:
+            processor.add_message({'content': 'slow'})
+            processor.add_message({'content': 'fast'}, callback=lambda responses: fast_done.set())
+            
+            self.assertTrue(fast_done.wait(timeout=2))
+        finally:
+            release.set()
+            processor.stop()
+    
+    @patch('agents.services.RuleEngine.process_message')
+    def test_same_group_processed_in_order(self, mock_process_message):
+        """测试同一群组的消息由一个工作线程按顺序处理，其他群组不受影响"""
+        release = threading.Event()
+        slow_started = threading.Event()
+        other_done = threading.Event()
+        processed = []
+        
+        def process_message(message, context):
+            if message['content'] == 'slow':
+                slow_started.set()
+                release.wait(timeout=5)
+            processed.append((message['group_id'], message['content']))
+            return []
+        
+        mock_process_message.side_effect = process_message
+        
+        processor = AsyncMessageProcessor(workers=4, queue_size=10)
+        slow_shard = processor._shard_index('group:1')
+        other_group = next(
+            str(group_id) for group_id in range(2, 100)
+            if processor._shard_index(f'group:{group_id}') != slow_shard
+        )
+        try:
+            processor.add_message({'content': 'slow', 'group_id': '1'})
+            processor.add_message({'content': '@助手 second', 'group_id': '1'})
+            processor.add_message({'content': 'other', 'group_id': other_group}, callback=lambda responses: other_done.set())
+            
+            self.assertTrue(other_done.wait(timeout=2))
+            self.assertTrue(slow_started.wait(timeout=2))
+            self.assertEqual(processor.hot_partitions()[0], {'key': 'group:1', 'shard': slow_shard, 'queue_size': 1})
+        finally:
+            release.set()
+        
+        deadline = time.time() + 2
+        while len(processed) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        processor.stop()
+        self.assertEqual(
+            [content for group_id, content in processed if group_id == '1'],
+            ['slow', '@助手 second']
+        )
+    
+    @patch('agents.services.RuleEngine.process_batch')
+    def test_group_burst_coalesced(self, mock_process_batch):
+        """测试合并窗口内同一群组的消息一次评估，响应仍按消息分别回调"""
+        done = threading.Event()
+        received = []
+        mock_process_batch.side_effect = lambda messages, coalesce=False: [
+            [{'type': 'notification', 'content': message['content']}] for message in messages
+        ]
+        
+        def callback(responses):
+            received.append(responses[0]['content'])
+            if len(received) == 3:
+                done.set()
+        
+        processor = AsyncMessageProcessor(workers=1, coalesce_window_ms=200)
+        try:
+            for index in range(3):
+                processor.add_message({'content': str(index), 'group_id': '1'}, {'message_id': str(index)}, callback)
+            self.assertTrue(done.wait(timeout=2))
+        finally:
+            processor.stop()
+        
+        mock_process_batch.assert_called_once()
+        messages = mock_process_batch.call_args[0][0]
+        self.assertEqual([message['message_id'] for message in messages], ['0', '1', '2'])
+        self.assertEqual(received, ['0', '1', '2'])
+        self.assertEqual(processor.stats()['coalesced'], 2)
+    
+    @patch('agents.services.RuleEngine.process_message')
+    def test_full_queue_sheds_load(self, mock_process_message):
+        """测试队列已满时丢弃新消息而不是无限增长"""
+        release = threading.Event()
+        started = threading.Event()
+        
+        def process_message(message, context):
+            started.set()
+            release.wait(timeout=5)
+            return []
+        
+        mock_process_message.side_effect = process_message
+        
+        processor = AsyncMessageProcessor(workers=1, queue_size=1, enqueue_timeout=0)
+        try:
+            processor.add_message({'content': '1'})
+            started.wait(timeout=2)
+            queued = processor.add_message({'content': '2'})
+            dropped = processor.add_message({'content': '3'})
+            self.assertIsInstance(dropped.exception(timeout=0), queue.Full)
+            self.assertFalse(queued.done())
+            self.assertEqual(processor.stats()['dropped'], 1)
+        finally:
+            release.set()
+        self.assertEqual(queued.result(timeout=2), [])
+        processor.stop()
+    
+    @patch('agents.services.RuleEngine.process_message')
+    def test_await_responses_on_caller_loop(self, mock_process_message):
+        """测试在调用方的事件循环中等待规则响应，协程回调会被执行"""
+        mock_process_message.return_value = [{'type': 'notification', 'content': '回复'}]
+        callback_responses = []
+        
+        async def callback(responses):
+            callback_responses.extend(responses)
+        
+        async def submit():
+            responses = await processor.process({'content': '你好', 'group_id': '1'}, timeout=2)
+            return responses, asyncio.get_running_loop()
+        
+        processor = AsyncMessageProcessor(workers=1)
+        try:
+            responses, loop = asyncio.run(submit())
+            self.assertEqual(responses, [{'type': 'notification', 'content': '回复'}])
+            
+            future = processor.add_message({'content': '你好', 'group_id': '1'}, callback=callback)
+            future.result(timeout=2)
+            deadline = time.time() + 2
+            while not callback_responses and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(callback_responses, [{'type': 'notification', 'content': '回复'}])
+        finally:
+            processor.stop()
+    
+    @patch('agents.services.RuleEngine.process_message')
+    def test_cancelled_message_not_processed(self, mock_process_message):
+        """测试等待超时后，尚未开始处理的消息不再处理"""
+        release = threading.Event()
+        started = threading.Event()
+        processed = []
+        
+        def process_message(message, context):
+            processed.append(message['content'])
+            started.set()
+            release.wait(timeout=5)
+            return []
+        
+        mock_process_message.side_effect = process_message
+        
+        async def submit():
+            with self.assertRaises(asyncio.TimeoutError):
+                await processor.process({'content': 'queued', 'group_id': '1'}, timeout=0.05)
+        
+        processor = AsyncMessageProcessor(workers=1)
+        try:
+            processor.add_message({'content': 'blocker', 'group_id': '1'})
+            self.assertTrue(started.wait(timeout=2))
+            asyncio.run(submit())
+        finally:
+            release.set()
+        
+        last = processor.add_message({'content': 'last', 'group_id': '1'})
+        last.result(timeout=2)
+        processor.stop()
+        self.assertEqual(processed, ['blocker', 'last'])
+
+
+    @patch('agents.services.RuleEngine.process_message')
+    def test_metrics_snapshot(self, mock_process_message):
+        """测试处理延迟和响应发送指标"""
+        done = threading.Event()
+        mock_process_message.return_value = [{'type': 'auto_reply', 'content': '回复'}]
+        
+        async def failing_handler(response, context):
+            raise RuntimeError('发送失败')
+        
+        processor = AsyncMessageProcessor(workers=1)
+        processor.register_handler('auto_reply', failing_handler)
+        try:
+            processor.add_message({'content': '@助手 你好'}, callback=lambda responses: done.set())
+            self.assertTrue(done.wait(timeout=2))
+            deadline = time.time() + 2
+            while processor.snapshot()['responses'].get('auto_reply') is None and time.time() < deadline:
+                time.sleep(0.01)
+            
+            snapshot = processor.snapshot()
+            self.assertEqual(snapshot['lag'][LANE_MENTION]['count'], 1)
+            self.assertEqual(snapshot['wait'][LANE_GROUP]['count'], 0)
+            self.assertEqual(snapshot['rules']['count'], 1)
+            self.assertEqual(snapshot['responses']['auto_reply']['errors'], 1)
+            self.assertEqual(snapshot['responses']['auto_reply']['error_rate'], 1.0)
+            self.assertEqual(snapshot['lanes'][LANE_MENTION]['oldest_wait_ms'], 0.0)
+        finally:
+            processor.stop()
+    
+    def test_metrics_endpoint_requires_admin(self):
+        """测试处理器指标接口仅管理员可访问"""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get('/api/agents/processor/metrics/').status_code, 403)
+        
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='testpassword')
+        client.force_authenticate(admin)
+        response = client.get('/api/agents/processor/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('lag', response.data)
+        self.assertIn(LANE_MENTION, response.data['lanes'])
+
+    
+    @patch('agents.services.RuleEngine.process_message')
+    def test_responses_sent_as_one_batch(self, mock_process_message):
+        """测试一条消息触发的多个响应合并为一个群组事件，并使用同一发送时间"""
+        from agents.handlers import auto_reply_handler, notification_handler
+        
+        mock_process_message.return_value = [
+            {'type': 'auto_reply', 'content': '回复', 'agent_id': str(self.agent.id)},
+            {'type': 'notification', 'content': '通知', 'agent_id': str(self.agent.id)},
+            {'type': 'unhandled', 'content': '原样推送'},
+        ]
+        sent = []
+        
+        async def group_send(group, event):
+            sent.append((group, event))
+        
+        processor = AsyncMessageProcessor(workers=1)
+        processor.channel_layer = MagicMock(group_send=group_send)
+        processor.register_handler('auto_reply', auto_reply_handler)
+        processor.register_handler('notification', notification_handler)
+        try:
+            processor.add_message(
+                {'content': '你好'}, {'group_id': '1', 'message_id': 'm1'}
+            ).result(timeout=2)
+            deadline = time.time() + 2
+            while not sent and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            processor.stop()
+        
+        self.assertEqual(len(sent), 1)
+        group, event = sent[0]
+        self.assertEqual(group, 'group_1')
+        self.assertEqual(event['type'], 'agent.batch')
+        self.assertEqual(event['message_id'], 'm1')
+        messages = event['messages']
+        self.assertEqual(
+            [message.get('message_type') for message in messages],
+            ['agent_response', 'notification', None]
+        )
+        self.assertEqual(messages[0]['timestamp'], messages[1]['timestamp'])
+        self.assertNotEqual(messages[0]['id'], messages[1]['id'])
+        self.assertEqual(messages[2]['content'], '原样推送')
+    
+    @patch('agents.async_processor.AsyncMessageProcessor._store_dead_letter')
+    @patch('agents.services.RuleEngine.process_message')
+    def test_failed_response_retried_then_dead_lettered(self, mock_process_message, mock_store_dead_letter):
+        """测试处理函数失败后按退避重试，一直失败时写入死信"""
+        mock_process_message.return_value = [{'type': 'auto_reply', 'content': '回复'}]
+        calls = []
+        stored = threading.Event()
+        mock_store_dead_letter.side_effect = lambda *args: stored.set()
+        
+        async def flaky_handler(response, context):
+            calls.append(response['content'])
+            if len(calls) < 2:
+                raise RuntimeError('发送失败')
+        
+        processor = AsyncMessageProcessor(workers=1)
+        processor.retry_base_delay = 0.01
+        processor.register_handler('auto_reply', flaky_handler)
+        try:
+            processor.add_message({'content': '@助手 你好'}).result(timeout=2)
+            deadline = time.time() + 2
+            while len(calls) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(processor.stats()['retries'], 1)
+            
+            # 一直失败：尝试 retry_attempts 次后写入死信
+            processor.retry_attempts = 2
+            calls.append('fail')
+            processor.register_handler('auto_reply', AsyncMock(side_effect=RuntimeError('仍然失败')))
+            processor.add_message({'content': '@助手 再见'}).result(timeout=2)
+            self.assertTrue(stored.wait(timeout=2))
+        finally:
+            processor.stop()
+        
+        stage, response, context, attempts, error = mock_store_dead_letter.call_args[0]
+        self.assertEqual(stage, ResponseDeadLetter.Stage.HANDLER)
+        self.assertEqual(response['content'], '回复')
+        self.assertEqual(attempts, 2)
+        self.assertEqual(error, '仍然失败')
+        self.assertEqual(processor.stats()['dead_letters'], 1)
+    
+    def test_dead_letter_replay_and_purge(self):
+        """测试通过接口重放和清理死信"""
+        dead_letter = ResponseDeadLetter.objects.create(
+            stage=ResponseDeadLetter.Stage.HANDLER,
+            response_type='auto_reply',
+            response={'type': 'auto_reply', 'content': '回复'},
+            context={'group_id': '1'},
+            attempts=5,
+            last_error='发送失败'
+        )
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='testpassword')
+        client = APIClient()
+        client.force_authenticate(admin)
+        url = f'/api/agents/dead-letters/{dead_letter.id}/replay/'
+        
+        # 处理函数未注册时重放失败，累加尝试次数
+        from agents.async_processor import message_processor
+        self.assertEqual(client.post(url).status_code, 502)
+        dead_letter.refresh_from_db()
+        self.assertEqual(dead_letter.attempts, 6)
+        self.assertIsNone(dead_letter.replayed_at)
+        
+        handler = AsyncMock(return_value=None)
+        with patch.dict(message_processor.handlers, {'auto_reply': handler}):
+            response = client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.data['replayed_at'])
+        handler.assert_called_once_with({'type': 'auto_reply', 'content': '回复'}, {'group_id': '1'})
+        
+        response = client.post('/api/agents/dead-letters/purge/', {'replayed_only': True}, format='json')
+        self.assertEqual(response.data['deleted'], 1)
+        self.assertFalse(ResponseDeadLetter.objects.exists())
+
+class PriorityLaneQueueTestCase(SimpleTestCase):
+    """测试优先级通道队列"""
+    
+    def test_mention_lane_served_first(self):
+        """测试提及消息即使后入队也优先取出"""
+        lanes = PriorityLaneQueue(maxsize=10)
+        lanes.put('group', LANE_GROUP)
+        lanes.put('mention', LANE_MENTION)
+        
+        self.assertEqual(lanes.get(timeout=0), (LANE_MENTION, 'mention'))
+        self.assertEqual(lanes.get(timeout=0), (LANE_GROUP, 'group'))
+    
+    def test_weighted_share_prevents_starvation(self):
+        """测试各通道按权重分配处理机会，低优先级通道不会饿死"""
+        lanes = PriorityLaneQueue(weights={LANE_MENTION: 8, LANE_GROUP: 3, LANE_BULK: 1}, maxsize=100)
+        for index in range(50):
+            lanes.put(index, LANE_MENTION)
+            lanes.put(index, LANE_GROUP)
+            lanes.put(index, LANE_BULK)
+        
+        served = [lanes.get(timeout=0)[0] for _ in range(24)]
+        self.assertEqual(served.count(LANE_MENTION), 16)
+        self.assertEqual(served.count(LANE_GROUP), 6)
+        self.assertEqual(served.count(LANE_BULK), 2)
+        # 同一通道内保持先进先出
+        self.assertEqual(lanes.get(timeout=0), (LANE_MENTION, 16))
+    
+    def test_full_lane_does_not_block_other_lanes(self):
+        """测试一个通道已满时其他通道仍可入队"""
+        lanes = PriorityLaneQueue(maxsize=1)
+        lanes.put('bulk', LANE_BULK)
+        
+        with self.assertRaises(queue.Full):
+            lanes.put('bulk', LANE_BULK, timeout=0)
+        lanes.put('mention', LANE_MENTION, timeout=0)
+        self.assertEqual(lanes.qsize(), 2)
+    
+    def test_partition_order_kept_across_lanes(self):
+        """测试同一分区键的元素即使在更高优先级通道中也不会越过更早的元素"""
+        lanes = PriorityLaneQueue(maxsize=10)
+        lanes.put('g1-first', LANE_GROUP, key='group:1')
+        lanes.put('g2', LANE_GROUP, key='group:2')
+        lanes.put('g1-mention', LANE_MENTION, key='group:1')
+        lanes.put('g3-mention', LANE_MENTION, key='group:3')
+        
+        served = [lanes.get(timeout=0)[1] for _ in range(4)]
+        # 提及通道被选中时，先取出同一群组更早的普通消息
+        self.assertEqual(served[0], 'g1-first')
+        self.assertLess(served.index('g1-first'), served.index('g1-mention'))
+        self.assertEqual(sorted(served), ['g1-first', 'g1-mention', 'g2', 'g3-mention'])
+        self.assertEqual(lanes.qsize(), 0)
+        self.assertEqual(lanes.key_sizes(), {})
+    
+    def test_partition_key(self):
+        """测试群组消息和私聊消息的分区键"""
+        self.assertEqual(partition_key({'content': '你好', 'group_id': '1'}), 'group:1')
+        self.assertEqual(partition_key({'content': '你好'}, {'group_id': '2'}), 'group:2')
+        self.assertEqual(
+            partition_key({'sender': '7', 'recipient': '3'}),
+            partition_key({'sender': '3', 'recipient': '7'})
+        )
+        self.assertIsNone(partition_key({'content': '你好'}))
+    
+    def test_classify_lane(self):
+        """测试按消息内容判断通道"""
+        self.assertEqual(classify_lane({'content': '你好', 'group_id': '1'}), LANE_GROUP)
+        self.assertEqual(classify_lane({'content': '@助手 你好', 'group_id': '1'}), LANE_MENTION)
+        self.assertEqual(classify_lane({'content': '你好', 'group_id': '1', 'mentions': ['助手']}), LANE_MENTION)
+        self.assertEqual(classify_lane({'content': '你好'}), LANE_MENTION)
+        self.assertEqual(classify_lane({'content': '你好', 'group_id': '1'}, {'lane': LANE_BULK}), LANE_BULK)
 
 
 class AsyncMock(MagicMock):
@@ -0,0 +1,208 @@
+import importlib.util
+from unittest import mock, skipUnless
+
+import numpy as np
+
+from django.test import TestCase, SimpleTestCase
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from agents.context_store import ContextWindow, GroupContextStore, context_store
+from agents.features import MessageFeatures
+from agents.models import Agent, AgentListeningRule
+from agents.rule_index import rule_index
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+
+User = get_user_model()
+
+
+class ContextWindowTestCase(SimpleTestCase):
+    """测试群组上下文窗口"""
+
+    def _message(self, index, seconds_ago=0):
+        return {
+            'id': str(index),
+            'content': f'Message {index}',
+            'timestamp': (timezone.now() - timezone.timedelta(seconds=seconds_ago)).isoformat()
+        }
+
+    def test_eviction_keeps_concatenated_text(self):
+        """测试淘汰旧消息后拼接文本仍与逐条拼接一致"""
+        window = ContextWindow(max_size=3)
+        for index in range(5):
+            window.append(self._message(index))
+
+        view = window.view()
+        self.assertEqual(len(window), 3)
+        self.assertEqual([entry.id for entry in view.entries], ['2', '3', '4'])
+        self.assertEqual(view.content(0), 'message 2 message 3 message 4')
+        self.assertEqual(view.content(2), 'message 4')
+
+    def test_duplicate_ids_recorded_once(self):
+        """测试同一消息多次记录只保留一份，快照截至指定消息"""
+        window = ContextWindow()
+        first = window.append(self._message(1))
+        window.append(self._message(2))
+
+        self.assertIs(window.append(self._message(1)), first)
+        self.assertEqual(len(window), 2)
+        self.assertEqual(window.view(first).content(0), 'message 1')
+
+    def test_select_respects_size_and_time_window(self):
+        """测试按消息数量和时间窗口选择上下文"""
+        window = ContextWindow()
+        window.append(self._message(1, seconds_ago=600))
+        window.append(self._message(2, seconds_ago=60))
+        window.append(self._message(3))
+        view = window.view()
+
+        self.assertEqual(view.select(5, 300), 1)
+        self.assertEqual(view.select(1, 300), 2)
+        self.assertEqual(view.select(5, 3600), 0)
+
+    def test_store_evicts_least_recent_group(self):
+        """测试群组数量超出上限时淘汰最久未活跃的群组"""
+        store = GroupContextStore(window_size=5, max_groups=2)
+        store.record('a', self._message(1))
+        store.record('b', self._message(2))
+        store.record('a', self._message(3))
+        store.record('c', self._message(4))
+
+        self.assertEqual(store.get_messages('b'), [])
+        self.assertEqual([message['id'] for message in store.get_messages('a')], ['1', '3'])
+        self.assertEqual(store.record(None, self._message(5)), (None, None))
+
+
+class ContextAwareRuleTestCase(TestCase):
+    """测试上下文感知规则使用群组上下文窗口"""
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+        context_store.clear()
+
+        self.sentiment_calls = []
+
+        def analyze_sentiment(text):
+            self.sentiment_calls.append(text)
+            return -0.8
+
+        patcher = mock.patch('agents.utils.sentiment_analyzer.analyze_sentiment', analyze_sentiment)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = User.objects.create_user(
+            username='contextuser',
+            email='context@example.com',
+            password='testpassword'
+        )
+        self.agent = Agent.objects.create(
+            name='上下文代理',
+            role=Agent.Role.ASSISTANT,
+            owner=user,
+            status=Agent.Status.ONLINE
+        )
+
+    def _create_rule(self, context_rules):
+        return AgentListeningRule.objects.create(
+            name='上下文规则',
+            agent=self.agent,
+            trigger_type=AgentListeningRule.TriggerType.CONTEXT_AWARE,
+            trigger_condition={
+                'context_rules': context_rules,
+                'context_size': 3,
+                'time_window': 300,
+                'match_threshold': 1.0
+            },
+            response_type=AgentListeningRule.ResponseType.AUTO_REPLY,
+            response_content={'reply_template': '需要查看错误日志吗？'}
+        )
+
+    def _fired(self, rule, message):
+        responses = RuleEngine.process_message(message)
+        return str(rule.id) in [response['rule_id'] for response in responses]
+
+    def test_history_comes_from_group_window(self):
+        """测试不提供历史消息时，同一群组之前的消息构成上下文"""
+        rule = self._create_rule([
+            {'type': 'keyword', 'value': '数据库'},
+            {'type': 'keyword', 'value': '错误'},
+        ])
+
+        self.assertFalse(self._fired(rule, {'id': '1', 'content': '我在连接数据库', 'group_id': '9'}))
+        self.assertFalse(self._fired(rule, {'id': '2', 'content': '出现了错误', 'group_id': '10'}))
+        self.assertTrue(self._fired(rule, {'id': '3', 'content': '出现了错误', 'group_id': '9'}))
+
+        # 上下文消息查询不访问数据库
+        self.assertEqual(len(context_store.get_messages('9')), 2)
+
+    def test_current_message_counts_toward_context(self):
+        """测试当前消息本身属于上下文：没有历史消息时只由当前消息决定是否触发"""
+        rule = self._create_rule([
+            {'type': 'keyword', 'value': '数据库'},
+            {'type': 'keyword', 'value': '错误'},
+        ])
+
+        self.assertTrue(self._fired(rule, {'id': '1', 'content': '数据库连接错误', 'group_id': '9'}))
+        self.assertFalse(self._fired(rule, {'id': '2', 'content': '数据库', 'group_id': '10'}))
+
+    def test_context_sentiment_scores_joined_text(self):
+        """测试上下文情感得分对窗口内拼接后的文本整体计算一次，相同窗口的规则共享结果"""
+        rule = self._create_rule([{'type': 'sentiment', 'value': 'negative'}])
+        AgentListeningRule.objects.create(
+            name='相同窗口的上下文规则',
+            agent=self.agent,
+            trigger_type=AgentListeningRule.TriggerType.CONTEXT_AWARE,
+            trigger_condition=rule.trigger_condition,
+            response_type=AgentListeningRule.ResponseType.AUTO_REPLY,
+            response_content={'reply_template': '收到'}
+        )
+
+        self.assertTrue(self._fired(rule, {'id': '1', 'content': '太差了', 'group_id': '9'}))
+        self.assertTrue(self._fired(rule, {'id': '2', 'content': '还是不行', 'group_id': '9'}))
+        self.assertEqual(self.sentiment_calls, ['太差了', '太差了 还是不行'])
+
+    @skipUnless(importlib.util.find_spec('gensim'), '需要安装 gensim')
+    def test_context_topic_vector_matches_joined_text(self):
+        """测试按条目缓存的上下文主题向量与对拼接文本整体计算的结果相同"""
+        from agents.utils import topic_analyzer
+
+        class WordVectors(dict):
+            vector_size = 2
+
+        word_vectors = WordVectors({
+            '苹果': np.array([1.0, 0.0]),
+            '香蕉': np.array([0.0, 1.0]),
+            '水果': np.array([1.0, 1.0]),
+        })
+        now = timezone.now()
+        message = {
+            'content': '苹果',
+            'timestamp': now.isoformat(),
+            'context_messages': [
+                {'content': '苹果 香蕉 苹果', 'timestamp': (now - timezone.timedelta(seconds=60)).isoformat()},
+                {'content': '香蕉', 'timestamp': (now - timezone.timedelta(seconds=30)).isoformat()},
+            ],
+        }
+
+        with mock.patch.object(topic_analyzer._analyzer, 'word_vectors', word_vectors):
+            features = MessageFeatures(message)
+            similarity = features.context_topic_similarity(5, 300, '水果')
+            expected = topic_analyzer.analyze_topic_similarity(features.context_content(5, 300), '水果')
+
+        self.assertAlmostEqual(similarity, expected)
+
+    def test_cheap_conditions_evaluated_first(self):
+        """测试关键词条件不满足、阈值已无法达到时不再调用情感分析"""
+        rule = self._create_rule([
+            {'type': 'sentiment', 'value': 'negative'},
+            {'type': 'keyword', 'value': '数据库'},
+        ])
+
+        self.assertFalse(self._fired(rule, {'id': '1', 'content': '太差了', 'group_id': '9'}))
+        self.assertEqual(self.sentiment_calls, [])
+
+        self.assertTrue(self._fired(rule, {'id': '2', 'content': '数据库太差了', 'group_id': '9'}))
+        self.assertEqual(self.sentiment_calls, ['太差了 数据库太差了'])
@@ -0,0 +1,129 @@
+from unittest import mock
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from agents.features import MessageFeatures
+from agents.models import Agent, AgentListeningRule
+from agents.rule_index import rule_index
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+
+User = get_user_model()
+
+
+class MessageFeaturesTestCase(TestCase):
+    """测试消息特征的惰性计算与共享"""
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+
+        # 用计数的情感分析函数替换情感分析模块中的函数
+        self.sentiment_calls = []
+
+        def analyze_sentiment(text):
+            self.sentiment_calls.append(text)
+            return -0.8
+
+        patcher = mock.patch('agents.utils.sentiment_analyzer.analyze_sentiment', analyze_sentiment)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_features_are_lazy_and_memoized(self):
+        """测试特征在首次访问时计算且只计算一次"""
+        features = MessageFeatures({'content': 'Hello World', 'mentions': [1, '2']})
+
+        self.assertEqual(self.sentiment_calls, [])
+        self.assertEqual(features.lower_content, 'hello world')
+        self.assertEqual(features.mentions, frozenset({'1', '2'}))
+
+        self.assertEqual(features.sentiment, -0.8)
+        self.assertEqual(features.sentiment, -0.8)
+        self.assertEqual(features.text_sentiment('Hello World'), -0.8)
+        self.assertEqual(self.sentiment_calls, ['Hello World'])
+
+    def test_provided_sentiment_is_reused(self):
+        """测试调用方提供的情感信息直接使用"""
+        features = MessageFeatures({'content': '好', 'sentiment': {'score': 0.6}})
+
+        self.assertEqual(features.sentiment, 0.6)
+        self.assertEqual(self.sentiment_calls, [])
+
+    def test_sentiment_shared_across_rules(self):
+        """测试多条情绪规则共享一次情感分析"""
+        user = User.objects.create_user(
+            username='featureuser',
+            email='feature@example.com',
+            password='testpassword'
+        )
+        agent = Agent.objects.create(
+            name='特征代理',
+            role=Agent.Role.ASSISTANT,
+            owner=user,
+            status=Agent.Status.ONLINE
+        )
+        for index in range(3):
+            AgentListeningRule.objects.create(
+                agent=agent,
+                name=f'情绪规则{index}',
+                trigger_type=AgentListeningRule.TriggerType.SENTIMENT,
+                trigger_condition={'target_sentiment': 'negative', 'threshold': 0.5},
+                response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+                response_content={'notification_text': '收到'}
+            )
+
+        responses = RuleEngine.process_message({'content': '太糟糕了', 'group_id': '1'})
+
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(self.sentiment_calls, ['太糟糕了'])
+
+    def test_same_priority_rules_evaluated_in_id_order(self):
+        """测试同一优先级的规则按ID顺序评估，独占规则触发后跳过之后的规则，与匹配耗时无关"""
+        user = User.objects.create_user(
+            username='costuser',
+            email='cost@example.com',
+            password='testpassword'
+        )
+        agent = Agent.objects.create(
+            name='耗时代理',
+            role=Agent.Role.ASSISTANT,
+            owner=user,
+            status=Agent.Status.ONLINE
+        )
+        sentiment_rule = AgentListeningRule.objects.create(
+            agent=agent,
+            name='情绪规则',
+            priority=1,
+            trigger_type=AgentListeningRule.TriggerType.SENTIMENT,
+            trigger_condition={'target_sentiment': 'negative', 'threshold': 0.5},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '情绪'}
+        )
+        keyword_rule = AgentListeningRule.objects.create(
+            agent=agent,
+            name='独占关键词规则',
+            priority=1,
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['退款'], 'exclusive': True},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '关键词'}
+        )
+        AgentListeningRule.objects.create(
+            agent=agent,
+            name='之后的关键词规则',
+            priority=1,
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['退款']},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '之后'}
+        )
+
+        for index in range(3):
+            rule_stats.reset()
+            responses = RuleEngine.process_message({'id': f'm{index}', 'content': '我要退款', 'group_id': '1'})
+            self.assertEqual(
+                [response['rule_id'] for response in responses],
+                [str(sentiment_rule.id), str(keyword_rule.id)]
+            )
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+
+from agents.handlers import execute_search_action
+from agents.knowledge_index import KnowledgeIndex, SOURCE_GROUP_MESSAGE, SOURCE_SKILL, SOURCE_TASK
+from agents.models import AgentSkill
+from groups.models import Group, GroupMessage
+from task_management.models import Task
+
+User = get_user_model()
+
+
+class KnowledgeIndexTestCase(TestCase):
+    """测试本地全文知识索引"""
+
+    def setUp(self):
+        """使用临时索引文件，并替换信号和处理函数使用的全局索引"""
+        directory = tempfile.mkdtemp(prefix='knowledge-index-')
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.index = KnowledgeIndex(os.path.join(directory, 'index.sqlite3'))
+        self.index.open()
+        self.addCleanup(self.index.close)
+        for target in ('agents.signals.knowledge_index', 'agents.handlers.knowledge_index'):
+            patcher = patch(target, self.index)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user(username='search_user', password='testpassword')
+        self.group = Group.objects.create(name='搜索群组', owner=self.user)
+        self.other_group = Group.objects.create(name='其他群组', owner=self.user)
+
+    def _post(self, group, text):
+        return GroupMessage.objects.create(group=group, sender_user=self.user, content={'text': text})
+
+    def _search(self, query, **kwargs):
+        self.assertTrue(self.index.flush())
+        return self.index.search(query, **kwargs)
+
+    def test_signals_index_and_search_within_group(self):
+        """测试保存的消息、任务和技能可以搜索到，且不返回其他群组的消息"""
+        message = self._post(self.group, '数据库迁移脚本放在运维仓库的migrations目录')
+        self._post(self.other_group, '另一个群组的数据库迁移计划')
+        task = Task.objects.create(title='数据库迁移', description='周五前完成', creator=self.user, group=self.group)
+        skill = AgentSkill.objects.create(name='运维助手', description='回答数据库和部署相关的问题')
+
+        results = self._search('数据库迁移', group_id=self.group.id)
+        found = [(result['source'], result['object_id']) for result in results]
+        self.assertEqual(found[0], (SOURCE_TASK, str(task.id)))
+        self.assertIn((SOURCE_GROUP_MESSAGE, str(message.id)), found)
+        self.assertIn((SOURCE_SKILL, str(skill.id)), found)
+        self.assertEqual(len(found), 3)
+
+        results = self._search('数据库', sources=[SOURCE_SKILL])
+        self.assertEqual([result['object_id'] for result in results], [str(skill.id)])
+
+    def test_group_content_not_visible_outside_group(self):
+        """测试群组内容和个人任务不会出现在其他群组或不在群组中的搜索结果里"""
+        self._post(self.group, '预算审批表放在财务共享盘')
+        Task.objects.create(title='预算审批', description='个人待办', creator=self.user)
+        skill = AgentSkill.objects.create(name='财务助手', description='解答预算审批流程')
+
+        self.assertEqual(len(self._search('预算审批', group_id=self.group.id)), 2)
+        for group_id in (self.other_group.id, None):
+            results = self._search('预算审批', group_id=group_id)
+            self.assertEqual([(result['source'], result['object_id']) for result in results], [(SOURCE_SKILL, str(skill.id))])
+
+        # 没有群组的动作上下文（如消息中心的私聊消息）只能搜索到公共内容
+        message = asyncio.run(execute_search_action(
+            {'action_name': 'search_knowledge_base', 'message_content': '预算审批'},
+            {'message_id': 'm2'}
+        ))
+        self.assertEqual([result['source'] for result in message['payload']['results']], [SOURCE_SKILL])
+
+    def test_updates_and_deletes_applied_incrementally(self):
+        """测试对象更新后按新内容索引，删除后从索引中移除"""
+        message = self._post(self.group, '明天上午发布新版本')
+        self.assertEqual(len(self._search('发布', group_id=self.group.id)), 1)
+
+        message.content = {'text': '明天下午开会讨论需求'}
+        message.save()
+        self.assertEqual(self._search('发布', group_id=self.group.id), [])
+        self.assertEqual(len(self._search('开会', group_id=self.group.id)), 1)
+
+        message.delete()
+        self.assertEqual(self._search('开会', group_id=self.group.id), [])
+
+    def test_snippet_around_match(self):
+        """测试长文本只返回命中词附近的摘录"""
+        self._post(self.group, '无关内容' * 40 + '备份策略是每天凌晨三点全量备份' + '其他内容' * 40)
+        snippet = self._search('备份策略', group_id=self.group.id)[0]['snippet']
+        self.assertIn('备份策略', snippet)
+        self.assertTrue(snippet.startswith('…') and snippet.endswith('…'))
+        self.assertLessEqual(len(snippet), 82)
+
+    def test_search_action(self):
+        """测试 search_knowledge_base 动作返回排序后的搜索结果"""
+        self._post(self.group, '报销流程：先在系统提交申请再找经理审批')
+        self.assertTrue(self.index.flush())
+
+        message = asyncio.run(execute_search_action(
+            {'action_name': 'search_knowledge_base', 'message_content': '报销流程是什么'},
+            {'group_id': str(self.group.id), 'message_id': 'm1'}
+        ))
+        payload = message['payload']
+        self.assertEqual(len(payload['results']), 1)
+        self.assertIn('报销流程', payload['text'])
+
+    def test_search_action_excludes_triggering_message(self):
+        """测试没有配置查询词时，用触发消息的内容搜索，结果不包含触发消息本身"""
+        answer = self._post(self.group, '报销流程：先在系统提交申请再找经理审批')
+        question = self._post(self.group, '报销流程是什么')
+        self.assertTrue(self.index.flush())
+        self.assertEqual(len(self._search('报销流程是什么', group_id=self.group.id)), 2)
+
+        message = asyncio.run(execute_search_action(
+            {'action_name': 'search_knowledge_base', 'message_content': question.content['text']},
+            {'group_id': str(self.group.id), 'message_id': str(question.id)}
+        ))
+        self.assertEqual(
+            [(result['source'], result['object_id']) for result in message['payload']['results']],
+            [(SOURCE_GROUP_MESSAGE, str(answer.id))]
+        )
+
+    def test_rebuild_command(self):
+        """测试重建命令导入已有数据"""
+        with patch('agents.signals.knowledge_index', None):
+            self._post(self.group, '历史消息里的部署清单')
+        self.assertEqual(self._search('部署清单'), [])
+
+        out = StringIO()
+        with patch('agents.management.commands.rebuild_knowledge_index.knowledge_index', self.index):
+            call_command('rebuild_knowledge_index', '--source', SOURCE_GROUP_MESSAGE, stdout=out)
+        self.assertIn('group_message: 导入 1 条', out.getvalue())
+        self.assertEqual(len(self._search('部署清单', group_id=self.group.id)), 1)
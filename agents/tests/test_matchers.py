@@ -0,0 +1,74 @@
+from django.test import SimpleTestCase
+
+from agents.matchers import (
+    KeywordAutomaton, KeywordScanner, compile_pattern, required_literals
+)
+
+
+class KeywordAutomatonTestCase(SimpleTestCase):
+    """测试多关键词自动机"""
+
+    def test_overlapping_keywords(self):
+        """测试重叠关键词与后缀关键词都能命中"""
+        automaton = KeywordAutomaton([
+            ('he', 1), ('she', 2), ('his', 3), ('hers', 4),
+        ])
+
+        self.assertEqual(automaton.scan('ushers'), {1, 2, 4})
+        self.assertEqual(automaton.scan('his'), {3})
+        self.assertEqual(automaton.scan('xyz'), set())
+
+    def test_case_insensitive_and_chinese(self):
+        """测试不区分大小写及中文关键词"""
+        automaton = KeywordAutomaton([('Hello', 'a'), ('帮助', 'b')])
+
+        self.assertEqual(automaton.scan('HELLO, 需要帮助吗'), {'a', 'b'})
+
+    def test_empty_and_invalid_keywords(self):
+        """测试空关键词始终命中，非字符串关键词被忽略"""
+        automaton = KeywordAutomaton([('', 'empty'), (None, 'none'), ('ok', 'ok')])
+
+        self.assertEqual(automaton.scan(''), {'empty'})
+        self.assertEqual(automaton.scan('ok'), {'empty', 'ok'})
+
+    def test_scanner_caches_per_text(self):
+        """测试扫描器对同一文本只扫描一次"""
+        automaton = KeywordAutomaton([('foo', 1)])
+        scanner = KeywordScanner(automaton)
+
+        first = scanner.hits('foo bar')
+        self.assertIs(scanner.hits('foo bar'), first)
+        self.assertEqual(scanner.hits(None), set())
+
+
+class RegexPrefilterTestCase(SimpleTestCase):
+    """测试正则表达式缓存与字面子串预过滤"""
+
+    def test_compile_pattern_cached(self):
+        """测试同一模式只编译一次"""
+        self.assertIs(compile_pattern(r'订单\d+'), compile_pattern(r'订单\d+'))
+
+    def test_required_literals(self):
+        """测试必需字面子串的提取"""
+        self.assertEqual(required_literals(r'如何(\w+)'), ('如何',))
+        self.assertEqual(required_literals(r'\d+ order(s)? shipped'), (' shipped',))
+        self.assertEqual(set(required_literals(r'(退款|refund)申请单')), {'申请单'})
+        self.assertEqual(set(required_literals(r'退款|refund')), {'退款', 'refund'})
+        self.assertEqual(required_literals(r'\d+'), ())
+        self.assertEqual(required_literals(r'(?i)hello'), ())
+        self.assertEqual(required_literals(r'a?b*'), ())
+
+    def test_prefilter_candidates(self):
+        """测试预过滤只保留可能匹配的规则"""
+        entries = []
+        for owner, pattern in ((1, r'如何(\w+)'), (2, r'退款|refund'), (3, r'\d+')):
+            entries.extend((literal, owner) for literal in required_literals(pattern) or ('',))
+        scanner = KeywordScanner(
+            KeywordAutomaton(),
+            KeywordAutomaton(entries, case_sensitive=True)
+        )
+
+        self.assertEqual(scanner.regex_candidates('我想申请refund'), {2, 3})
+        self.assertEqual(scanner.regex_candidates('我想申请REFUND'), {3})
+        self.assertEqual(scanner.regex_candidates('如何使用'), {1, 3})
+        self.assertIsNone(KeywordScanner(KeywordAutomaton()).regex_candidates('x'))
@@ -0,0 +1,205 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from agents.apps import SERVING_PROCESS_ENV, is_serving_process
+from agents.async_processor import AsyncMessageProcessor, LANE_GROUP
+from agents.processor_journal import ProcessorJournal
+
+
+class ProcessorJournalTestCase(SimpleTestCase):
+    """测试异步消息处理器的持久化日志"""
+
+    def setUp(self):
+        """使用临时目录保存日志文件"""
+        self.directory = tempfile.mkdtemp(prefix='processor-journal-')
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'journal.sqlite3')
+
+    def _open(self):
+        journal = ProcessorJournal(self.path)
+        journal.open()
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_unfinished_messages_recovered_in_order(self):
+        """测试重新打开日志后只返回没有完成标记的消息"""
+        journal = self._open()
+        for index in range(3):
+            self.assertTrue(journal.append(str(index), LANE_GROUP, {'id': str(index)}, {'group_id': '1'}))
+        journal.complete('1')
+        journal.close()
+
+        recovered = self._open().recover()
+        self.assertEqual([item[0] for item in recovered], ['0', '2'])
+        self.assertEqual(recovered[0][2:], ({'id': '0'}, {'group_id': '1'}))
+
+    def test_recover_skips_messages_of_live_owners(self):
+        """测试多个进程共用日志时，只接管已关闭或租约过期的持有者的消息"""
+        live = self._open()
+        self.assertTrue(live.append('live', LANE_GROUP, {}, {}))
+
+        # 仍在运行的持有者的消息不会被其他进程重放
+        other = self._open()
+        self.assertEqual(other.recover(), [])
+
+        # 持有者停止续约、租约过期后由其他进程接管，且只被接管一次
+        time.sleep(0.3)
+        expired = ProcessorJournal(self.path, lease_timeout=0.2)
+        expired.open()
+        self.addCleanup(expired.close)
+        self.assertEqual([item[0] for item in expired.recover()], ['live'])
+        self.assertEqual(self._open().recover(), [])
+
+    def test_expired_owner_messages_claimed_after_start(self):
+        """测试进程快速重启时，旧进程的租约过期后其消息由写线程接管，不需要再次重启"""
+        crashed = self._open()
+        self.assertTrue(crashed.append('m1', LANE_GROUP, {'id': 'm1'}, {}))
+
+        # 旧进程未关闭日志就退出，新进程启动时其租约尚未过期
+        replayed = []
+        claimed = threading.Event()
+        restarted = ProcessorJournal(self.path, lease_timeout=0.3)
+        restarted.open()
+        self.addCleanup(restarted.close)
+        self.assertEqual(restarted.recover(handler=lambda rows: replayed.extend(rows) or claimed.set()), [])
+
+        self.assertTrue(claimed.wait(timeout=3))
+        self.assertEqual([item[0] for item in replayed], ['m1'])
+        self.assertEqual(restarted.pending_count(), 1)
+
+    def test_only_serving_processes_start_processor(self):
+        """测试管理命令和 runserver 的自动重载父进程不启动处理器"""
+        cases = [
+            (['manage.py', 'migrate'], {}, False),
+            (['manage.py', 'shell'], {}, False),
+            (['manage.py', 'runserver'], {}, False),
+            (['manage.py', 'runserver'], {'RUN_MAIN': 'true'}, True),
+            (['manage.py', 'runserver', '--noreload'], {}, True),
+            (['create_test_data.py'], {}, False),
+            (['/usr/local/bin/celery', '-A', 'chatbot_platform', 'worker'], {}, False),
+            (['/usr/local/bin/daphne', 'chatbot_platform.asgi:application'], {SERVING_PROCESS_ENV: '1'}, True),
+        ]
+        for argv, environ, expected in cases:
+            with patch.object(sys, 'argv', argv), patch.dict(os.environ, environ):
+                for name in ('RUN_MAIN', SERVING_PROCESS_ENV):
+                    if name not in environ:
+                        os.environ.pop(name, None)
+                self.assertEqual(is_serving_process(), expected, argv)
+
+    def test_duplicate_message_ids_ignored(self):
+        """测试同一消息ID在处理中或刚处理完时不会再次入队"""
+        journal = self._open()
+        self.assertTrue(journal.append('1', LANE_GROUP, {}, {}))
+        self.assertFalse(journal.append('1', LANE_GROUP, {}, {}))
+        journal.complete('1')
+        self.assertFalse(journal.append('1', LANE_GROUP, {}, {}))
+
+    def test_persisted_message_ids_ignored_after_restart(self):
+        """测试重启后重复投递已完成或其他进程处理中的消息时不会再次入队，也不改写原记录"""
+        first = self._open()
+        self.assertTrue(first.append('done', LANE_GROUP, {}, {}))
+        first.complete('done')
+        self.assertTrue(first.append('live', LANE_GROUP, {}, {}))
+
+        second = self._open()
+        self.assertFalse(second.append('done', LANE_GROUP, {}, {}))
+        self.assertFalse(second.append('live', LANE_GROUP, {}, {}))
+        self.assertEqual(second.pending_count(), 0)
+
+        connection = sqlite3.connect(self.path)
+        self.addCleanup(connection.close)
+        rows = dict(connection.execute(
+            'SELECT message_id, completed_at IS NOT NULL AND owner = ? FROM entries', (first.owner,)
+        ).fetchall())
+        self.assertEqual(rows, {'done': 1, 'live': 0})
+        self.assertEqual(
+            connection.execute("SELECT owner FROM entries WHERE message_id = 'live'").fetchone()[0],
+            first.owner
+        )
+
+    def test_concurrent_appends_share_commits(self):
+        """测试并发入队的记录合并在少数几次提交中"""
+        journal = self._open()
+        threads = [
+            threading.Thread(target=journal.append, args=(str(index), LANE_GROUP, {}, {}))
+            for index in range(50)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(journal.pending_count(), 50)
+        self.assertLess(journal.batch_count, 50)
+
+    @patch('agents.services.RuleEngine.process_message')
+    def test_process_appends_off_event_loop(self, mock_process_message):
+        """测试协程接口在线程池中追加日志记录，等待组提交时不阻塞事件循环"""
+        mock_process_message.return_value = []
+        journal = ProcessorJournal(self.path)
+        append = journal.append
+        append_threads = []
+
+        def recording_append(*args):
+            append_threads.append(threading.current_thread())
+            return append(*args)
+
+        async def submit():
+            return await processor.process({'id': 'off-loop', 'content': '1', 'group_id': '1'}, timeout=2)
+
+        processor = AsyncMessageProcessor(workers=1, journal=journal)
+        processor.start()
+        self.addCleanup(processor.stop)
+        with patch.object(journal, 'append', side_effect=recording_append):
+            self.assertEqual(asyncio.run(submit()), [])
+
+        self.assertEqual(len(append_threads), 1)
+        self.assertIsNot(append_threads[0], threading.current_thread())
+
+    @patch('agents.services.RuleEngine.process_message')
+    def test_processor_replays_after_restart(self, mock_process_message):
+        """测试处理器停止时未处理的消息在下次启动后重放，且不含无法序列化的上下文"""
+        started = threading.Event()
+        release = threading.Event()
+        processed = []
+
+        def process_message(message, context):
+            if message['id'] == 'blocker':
+                started.set()
+                release.wait(timeout=5)
+            processed.append((message['id'], sorted(context)))
+            return []
+
+        mock_process_message.side_effect = process_message
+
+        processor = AsyncMessageProcessor(workers=1, journal=ProcessorJournal(self.path))
+        processor.add_message({'id': 'blocker', 'content': '1', 'group_id': '1'})
+        processor.add_message({'id': 'queued', 'content': '2', 'group_id': '1'}, {'channel_layer': object()})
+        self.assertTrue(started.wait(timeout=2))
+
+        # 停止时正在处理的消息处理完毕，队列中剩余的消息留在日志中
+        stopper = threading.Thread(target=processor.stop)
+        stopper.start()
+        while processor.running:
+            time.sleep(0.01)
+        release.set()
+        stopper.join(timeout=10)
+        self.assertEqual([item[0] for item in processed], ['blocker'])
+
+        done = threading.Event()
+        mock_process_message.side_effect = lambda message, context: done.set() or process_message(message, context)
+        restarted = AsyncMessageProcessor(workers=1, journal=ProcessorJournal(self.path))
+        restarted.start()
+        self.addCleanup(restarted.stop)
+
+        self.assertTrue(done.wait(timeout=2))
+        self.assertEqual(processed[-1], ('queued', []))
@@ -0,0 +1,190 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+
+from agents.models import Agent, AgentListeningRule, AgentInteraction
+from agents.rule_index import rule_index
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+from groups.models import Group, GroupMessage
+from messaging.models import Message
+
+User = get_user_model()
+
+
+class RuleBatchTestCase(TestCase):
+    """测试规则引擎批量处理与历史回放"""
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+
+        self.user = User.objects.create_user(
+            username='batchuser',
+            email='batch@example.com',
+            password='testpassword'
+        )
+        self.agent = Agent.objects.create(
+            name='批量代理',
+            role=Agent.Role.ASSISTANT,
+            owner=self.user,
+            status=Agent.Status.ONLINE
+        )
+        self.rule = AgentListeningRule.objects.create(
+            agent=self.agent,
+            name='部署规则',
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['部署']},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '收到部署消息'}
+        )
+        self.group = Group.objects.create(name='批量群组', owner=self.user)
+
+    def test_process_batch_returns_per_message_responses(self):
+        """测试批量处理按消息返回响应"""
+        sender = Agent.objects.create(name='发送代理', owner=self.user)
+        messages = [
+            {'content': '今晚部署', 'group_id': '1', 'sender': str(sender.id)},
+            {'content': '普通消息', 'group_id': '1', 'sender': str(sender.id)},
+            {'content': '部署完成', 'group_id': '1', 'sender': str(sender.id)},
+        ]
+
+        results = RuleEngine.process_batch(messages)
+
+        self.assertEqual([len(responses) for responses in results], [1, 0, 1])
+        self.assertEqual(AgentInteraction.objects.filter(initiator=sender).count(), 2)
+
+    def test_dry_run_has_no_side_effects(self):
+        """测试试运行不记录触发统计和交互"""
+        self.rule.cooldown_period = 60
+        self.rule.save()
+
+        results = RuleEngine.process_batch(
+            [{'content': '部署'}, {'content': '再次部署'}],
+            dry_run=True
+        )
+
+        # 试运行不进入冷却，两条消息都匹配
+        self.assertEqual([len(responses) for responses in results], [1, 1])
+        self.assertEqual(rule_stats.flush(), 0)
+
+    def test_process_batch_api_validation_and_permissions(self):
+        """测试批量处理接口校验请求，默认试运行，非试运行仅管理员可用"""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = '/api/agents/rules/process_batch/'
+
+        for payload in ({'messages': 'text'}, {'messages': [1]}, {'messages': ['部署'], 'context': []}):
+            self.assertEqual(client.post(url, payload, format='json').status_code, 400)
+
+        response = client.post(url, {'messages': ['部署', {'content': '部署'}]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['dry_run'])
+        self.assertEqual(response.data['response_count'], 2)
+        self.assertEqual(rule_stats.flush(), 0)
+
+        response = client.post(url, {'messages': ['部署'], 'dry_run': False}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+        admin = User.objects.create_superuser(username='batchadmin', email='admin@example.com', password='testpassword')
+        client.force_authenticate(admin)
+        response = client.post(url, {'messages': ['部署'], 'dry_run': False}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(rule_stats.flush(), 1)
+
+    def test_process_batch_api_only_evaluates_own_agents(self):
+        """测试普通用户只能试运行自己的代理的规则，管理员评估所有规则"""
+        other = User.objects.create_user(username='otheruser', email='other@example.com', password='testpassword')
+        other_agent = Agent.objects.create(name='其他代理', owner=other, status=Agent.Status.ONLINE)
+        other_rule = AgentListeningRule.objects.create(
+            agent=other_agent,
+            name='其他部署规则',
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['部署']},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '其他用户的回复'}
+        )
+        client = APIClient()
+        url = '/api/agents/rules/process_batch/'
+
+        client.force_authenticate(self.user)
+        response = client.post(url, {'messages': ['部署']}, format='json')
+        self.assertEqual(
+            [item['rule_id'] for item in response.data['results'][0]['responses']],
+            [str(self.rule.id)]
+        )
+
+        client.force_authenticate(other)
+        response = client.post(url, {'messages': ['部署']}, format='json')
+        self.assertEqual(
+            [item['rule_id'] for item in response.data['results'][0]['responses']],
+            [str(other_rule.id)]
+        )
+
+        admin = User.objects.create_superuser(username='batchadmin', email='admin@example.com', password='testpassword')
+        client.force_authenticate(admin)
+        response = client.post(url, {'messages': ['部署']}, format='json')
+        self.assertEqual(response.data['response_count'], 2)
+
+    def test_coalesce_evaluates_burst_rules_once(self):
+        """测试合并评估时所有消息规则每个群组只评估一次，关键词规则仍逐条评估"""
+        all_rule = AgentListeningRule.objects.create(
+            agent=self.agent,
+            name='群组摘要规则',
+            trigger_type=AgentListeningRule.TriggerType.ALL_MESSAGES,
+            trigger_condition={},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '群组有新消息'}
+        )
+        messages = [
+            {'content': '今晚部署', 'group_id': '1'},
+            {'content': '你好', 'group_id': '2'},
+            {'content': '部署完成', 'group_id': '1'},
+            {'content': '收到', 'group_id': '1'},
+        ]
+
+        results = RuleEngine.process_batch(messages, dry_run=True, coalesce=True)
+
+        fired = [[response['rule_id'] for response in responses] for responses in results]
+        self.assertEqual(fired, [
+            [str(self.rule.id)],
+            [str(all_rule.id)],
+            [str(self.rule.id)],
+            [str(all_rule.id)],
+        ])
+
+    def test_replay_command(self):
+        """测试回放群组历史消息的管理命令"""
+        for text in ['准备部署', '你好', '部署成功']:
+            GroupMessage.objects.create(group=self.group, sender_user=self.user, content={'text': text})
+
+        out = StringIO()
+        call_command('replay_rules', '--group', str(self.group.id), '--dry-run', '--batch-size', '2', stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('回放消息 3 条，规则响应 2 个', output)
+        self.assertIn(f'部署规则 (ID: {self.rule.id}): 2', output)
+
+    def test_benchmark_command(self):
+        """测试基准测试命令覆盖两种消息来源且不产生副作用"""
+        GroupMessage.objects.create(group=self.group, sender_user=self.user, content={'text': '部署中'})
+        Message.objects.create(
+            message_type=Message.MessageType.CHAT,
+            sender_type=Message.SenderType.USER,
+            sender_user=self.user,
+            content={'text': '部署好了吗'}
+        )
+
+        out = StringIO()
+        call_command('benchmark_rules', '--warmup', '0', stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('消息数量: 2', output)
+        self.assertIn('吞吐量', output)
+        self.assertIn(f'部署规则 (ID: {self.rule.id}): 2', output)
+        self.assertEqual(rule_stats.flush(), 0)
+        self.assertFalse(AgentInteraction.objects.exists())
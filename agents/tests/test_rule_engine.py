@@ -4,8 +4,11 @@ from django.test import TestCase
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
-from agents.models import Agent, AgentListeningRule
+from agents.models import Agent, AgentListeningRule, AgentInteraction
 from agents.services import RuleEngine
+from agents.rule_index import rule_index
+from agents.rule_stats import rule_stats
+from agents.context_store import context_store
 
 User = get_user_model()
 
@@ -14,6 +17,11 @@ class RuleEngineTestCase(TestCase):
     
     def setUp(self):
         """设置测试数据"""
+        # 规则索引、触发统计和群组上下文是进程级的，每个测试从干净的状态开始
+        rule_index.invalidate()
+        rule_stats.reset()
+        context_store.clear()
+        
         # 创建测试用户
         self.user = User.objects.create_user(
             username='testuser',
@@ -291,4 +299,36 @@ class RuleEngineTestCase(TestCase):
         responses = RuleEngine.process_message(message)
         
         # 应该匹配上下文规则
-        self.assertTrue(any(r['rule_metadata']['rule_id'] == str(context_rule.id) for r in responses)) 
\ No newline at end of file
+        self.assertTrue(any(r['rule_metadata']['rule_id'] == str(context_rule.id) for r in responses))
+    
+    def test_interactions_recorded_in_batch(self):
+        """测试交互记录按消息批量写入，发送者只解析一次"""
+        sender = Agent.objects.create(
+            name='发送代理',
+            role=Agent.Role.ASSISTANT,
+            owner=self.user,
+            status=Agent.Status.ONLINE
+        )
+        AgentListeningRule.objects.create(
+            name='第二条关键词规则',
+            agent=self.agent,
+            priority=20,
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['测试']},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '收到'}
+        )
+        message = {'content': '这是一个测试', 'sender': str(sender.id), 'group_id': 'group1'}
+        RuleEngine._get_applicable_rules(message)
+        
+        # 一次查询解析发送者，一次批量写入交互记录
+        with self.assertNumQueries(2):
+            responses = RuleEngine.process_message(message)
+        
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(AgentInteraction.objects.filter(initiator=sender).count(), 2)
+        
+        # 普通用户发送者不记录交互，且结果被缓存
+        with self.assertNumQueries(0):
+            RuleEngine._record_interaction(self.keyword_rule, {'sender': 'user1'}, {}, [])
+            RuleEngine._record_interaction(self.keyword_rule, {'sender': 'user1'}, {}, [])
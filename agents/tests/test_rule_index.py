@@ -0,0 +1,200 @@
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+
+from agents.models import Agent, AgentListeningRule
+from agents.rule_index import rule_index
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+
+User = get_user_model()
+
+
+class RuleIndexTestCase(TestCase):
+    """测试进程内监听规则索引"""
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+
+        self.user = User.objects.create_user(
+            username='indexuser',
+            email='index@example.com',
+            password='testpassword'
+        )
+        self.agent = Agent.objects.create(
+            name='索引代理',
+            role=Agent.Role.ASSISTANT,
+            owner=self.user,
+            status=Agent.Status.ONLINE
+        )
+        self.group_rule = self._create_rule('全群组规则', priority=10)
+        self.scoped_rule = self._create_rule(
+            '指定群组规则', priority=5, allowed_groups=['42']
+        )
+        self.direct_rule = self._create_rule(
+            '直接消息规则', priority=1, listen_in_groups=False
+        )
+
+    def _create_rule(self, name, **kwargs):
+        """创建关键词规则"""
+        defaults = {
+            'agent': self.agent,
+            'trigger_type': AgentListeningRule.TriggerType.KEYWORD,
+            'trigger_condition': {'keywords': ['索引']},
+            'response_type': AgentListeningRule.ResponseType.AUTO_REPLY,
+            'response_content': {'reply_template': name},
+        }
+        defaults.update(kwargs)
+        return AgentListeningRule.objects.create(name=name, **defaults)
+
+    def _rule_ids(self, message):
+        return [compiled.id for compiled in RuleEngine._get_applicable_rules(message)]
+
+    def test_scope_buckets(self):
+        """测试按监听范围分桶"""
+        self.assertEqual(
+            self._rule_ids({'group_id': '42'}),
+            [self.scoped_rule.id, self.group_rule.id]
+        )
+        self.assertEqual(self._rule_ids({'group_id': '7'}), [self.group_rule.id])
+        self.assertEqual(
+            self._rule_ids({}),
+            [self.direct_rule.id, self.scoped_rule.id, self.group_rule.id]
+        )
+
+    def test_lookup_without_queries(self):
+        """测试索引加载后获取规则不查询数据库"""
+        self._rule_ids({'group_id': '42'})
+
+        with self.assertNumQueries(0):
+            self._rule_ids({'group_id': '42'})
+            self._rule_ids({'group_id': '7'})
+
+    def test_signal_driven_updates(self):
+        """测试信号驱动的增量更新"""
+        self._rule_ids({'group_id': '7'})
+
+        # 停用规则后应从索引中移除
+        self.group_rule.is_active = False
+        self.group_rule.save()
+        self.assertEqual(self._rule_ids({'group_id': '7'}), [])
+
+        # 新建规则后应立即可见
+        new_rule = self._create_rule('新规则', priority=3)
+        self.assertEqual(self._rule_ids({'group_id': '7'}), [new_rule.id])
+
+        # 删除规则后应从索引中移除
+        new_rule.delete()
+        self.assertEqual(self._rule_ids({'group_id': '7'}), [])
+
+    def test_mentioned_agent_rules_bypass_scope(self):
+        """测试被提及代理的提及规则不受监听范围限制"""
+        mention_rule = self._create_rule(
+            '提及规则',
+            priority=2,
+            trigger_type=AgentListeningRule.TriggerType.MENTION,
+            trigger_condition={},
+            listen_in_groups=False,
+            listen_in_direct=False
+        )
+
+        self.assertNotIn(mention_rule.id, self._rule_ids({'group_id': '7'}))
+        self.assertIn(
+            mention_rule.id,
+            self._rule_ids({'group_id': '7', 'mentions': [str(self.agent.id)]})
+        )
+
+    def test_invalid_regex_rejected_on_save(self):
+        """测试无效的正则表达式在保存时被拒绝"""
+        with self.assertRaises(ValidationError):
+            self._create_rule(
+                '无效正则规则',
+                trigger_type=AgentListeningRule.TriggerType.REGEX,
+                trigger_condition={'pattern': '(未闭合'}
+            )
+
+        self.assertFalse(AgentListeningRule.objects.filter(name='无效正则规则').exists())
+
+    def test_legacy_invalid_regex_rule_can_be_disabled(self):
+        """测试已保存的带有无效正则的旧规则只更新其他字段时不校验，可以被禁用"""
+        rule = self._create_rule(
+            '旧正则规则',
+            trigger_type=AgentListeningRule.TriggerType.REGEX,
+            trigger_condition={'pattern': '订单'}
+        )
+        AgentListeningRule.objects.filter(pk=rule.pk).update(trigger_condition={'pattern': '(未闭合'})
+        rule.refresh_from_db()
+
+        rule.is_active = False
+        rule.save(update_fields=['is_active', 'updated_at'])
+        self.assertFalse(AgentListeningRule.objects.get(pk=rule.pk).is_active)
+
+        with self.assertRaises(ValidationError):
+            rule.save()
+        with self.assertRaises(ValidationError):
+            rule.save(update_fields=['trigger_condition'])
+
+    def test_regex_rules_use_prefilter(self):
+        """测试正则规则经过字面子串预过滤后仍正确匹配"""
+        regex_rule = self._create_rule(
+            '订单规则',
+            priority=2,
+            trigger_type=AgentListeningRule.TriggerType.REGEX,
+            trigger_condition={'pattern': r'订单(\d+)'}
+        )
+
+        responses = RuleEngine.process_message({'content': '查询订单123', 'group_id': '7'})
+        self.assertIn(str(regex_rule.id), [response['rule_id'] for response in responses])
+
+        responses = RuleEngine.process_message({'content': '查询物流', 'group_id': '7'})
+        self.assertNotIn(str(regex_rule.id), [response['rule_id'] for response in responses])
+
+    def test_mention_routing(self):
+        """测试提及路由索引按代理ID和名称解析提及"""
+        mention_rule = self._create_rule(
+            '提及规则',
+            priority=3,
+            allowed_groups=['42'],
+            trigger_type=AgentListeningRule.TriggerType.MENTION,
+            trigger_condition={}
+        )
+        agent_id = str(self.agent.id)
+
+        # 代理ID、名称（忽略@前缀、大小写和末尾标点）都解析到同一代理
+        self.assertEqual(rule_index.resolve_mentions([agent_id]), {agent_id})
+        self.assertEqual(rule_index.resolve_mentions(['索引代理，']), {agent_id})
+        self.assertEqual(rule_index.resolve_mentions(['@索引代理']), {agent_id})
+        self.assertEqual(rule_index.resolve_mentions(['其他代理']), frozenset())
+
+        responses = RuleEngine.process_message({'content': '@索引代理! 在吗', 'group_id': '7'})
+        self.assertIn(str(mention_rule.id), [response['rule_id'] for response in responses])
+
+        # 中文提及后直接跟正文，没有空格分隔
+        self.assertEqual(rule_index.resolve_mentions(['索引代理帮我查一下'], '@索引代理帮我查一下'), {agent_id})
+        responses = RuleEngine.process_message({'content': '@索引代理帮我查一下日志', 'group_id': '7'})
+        self.assertIn(str(mention_rule.id), [response['rule_id'] for response in responses])
+
+        # 没有@前缀时不算提及
+        responses = RuleEngine.process_message({'content': '索引代理帮我查一下日志', 'group_id': '7'})
+        self.assertNotIn(str(mention_rule.id), [response['rule_id'] for response in responses])
+
+    def test_mention_routing_follows_agent_rename(self):
+        """测试代理改名后提及路由随之更新，含空白字符的名称在文本中查找"""
+        self._create_rule(
+            '提及规则',
+            trigger_type=AgentListeningRule.TriggerType.MENTION,
+            trigger_condition={}
+        )
+        agent_id = str(self.agent.id)
+        self.assertEqual(rule_index.resolve_mentions(['索引代理']), {agent_id})
+
+        self.agent.name = 'Index Bot'
+        self.agent.save()
+
+        self.assertEqual(rule_index.resolve_mentions(['索引代理']), frozenset())
+        self.assertEqual(
+            rule_index.resolve_mentions(['index'], 'hi @index bot, help'),
+            {agent_id}
+        )
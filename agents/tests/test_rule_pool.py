@@ -0,0 +1,114 @@
+from unittest import mock
+
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+
+from agents.context_store import context_store
+from agents.models import Agent, AgentListeningRule
+from agents.rule_index import rule_index
+from agents.rule_pool import RuleProcessPool, _warm_up
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+
+User = get_user_model()
+
+
+class RuleProcessPoolTestCase(TestCase):
+    """测试规则匹配进程池"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 启动工作进程的开销较大，整个测试类共用一个进程池
+        cls.pool = RuleProcessPool(workers=1)
+        cls.pool.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+        context_store.clear()
+
+        user = User.objects.create_user(
+            username='pooluser',
+            email='pool@example.com',
+            password='testpassword'
+        )
+        self.agent = Agent.objects.create(
+            name='进程池代理',
+            role=Agent.Role.ASSISTANT,
+            owner=user,
+            status=Agent.Status.ONLINE
+        )
+        self.keyword_rule = self._create_rule(
+            '退款规则',
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['退款']}
+        )
+        self.context_rule = self._create_rule(
+            '上下文规则',
+            trigger_type=AgentListeningRule.TriggerType.CONTEXT_AWARE,
+            trigger_condition={
+                'context_rules': [
+                    {'type': 'keyword', 'value': '订单'},
+                    {'type': 'keyword', 'value': '退款'},
+                ],
+                'match_threshold': 1.0
+            }
+        )
+
+    def _create_rule(self, name, **kwargs):
+        return AgentListeningRule.objects.create(
+            name=name,
+            agent=self.agent,
+            response_type=AgentListeningRule.ResponseType.AUTO_REPLY,
+            response_content={'reply_template': name},
+            **kwargs
+        )
+
+    def test_workers_import_sentiment_analyzer(self):
+        """测试工作进程初始化时能导入情感分析模块，并把预热结果报告给主进程"""
+        pid, errors = self.pool._executor.submit(_warm_up).result()
+        self.assertIsInstance(pid, int)
+        self.assertNotIn('agents.utils.sentiment_analyzer', errors)
+
+    def test_pool_matches_like_local_engine(self):
+        """测试工作进程的匹配结果与本进程一致，上下文消息随任务下发"""
+        messages = [
+            {'id': '1', 'content': '我的订单有问题', 'group_id': '5'},
+            {'id': '2', 'content': '我要退款', 'group_id': '5'},
+        ]
+        normalized = [RuleEngine._normalize_message(message, {}) for message in messages]
+        normalized[1]['context_messages'] = [normalized[0]]
+
+        results = self.pool.match(normalized)
+
+        self.assertEqual(results[0], frozenset())
+        self.assertEqual(results[1], {self.keyword_rule.id, self.context_rule.id})
+
+    def test_snapshot_version_follows_rule_changes(self):
+        """测试规则变更后工作进程加载新版本的快照"""
+        message = RuleEngine._normalize_message({'content': '我要退款', 'group_id': '5'}, {})
+        self.assertIn(self.keyword_rule.id, self.pool.match([message])[0])
+
+        self.keyword_rule.trigger_condition = {'keywords': ['投诉']}
+        self.keyword_rule.save()
+
+        self.assertNotIn(self.keyword_rule.id, self.pool.match([message])[0])
+
+    def test_rule_engine_uses_pool(self):
+        """测试开启进程池后规则引擎使用工作进程的匹配结果，冷却和响应仍在本进程处理"""
+        self.keyword_rule.cooldown_period = 60
+        self.keyword_rule.save()
+
+        with mock.patch('agents.services.rule_pool', self.pool):
+            first = RuleEngine.process_message({'content': '我要退款', 'group_id': '5'})
+            second = RuleEngine.process_message({'content': '我要退款', 'group_id': '5'})
+
+        self.assertEqual([response['rule_id'] for response in first], [str(self.keyword_rule.id)])
+        self.assertEqual(second, [])
@@ -0,0 +1,106 @@
+from django.test import SimpleTestCase, TestCase
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from agents.metrics import LatencyHistogram
+from agents.models import Agent, AgentListeningRule
+from agents.rule_index import rule_index
+from agents.rule_profiler import rule_profiler
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+
+User = get_user_model()
+
+
+class LatencyHistogramTestCase(SimpleTestCase):
+    """测试延迟直方图"""
+
+    def test_quantiles(self):
+        """测试分位数估算落在对应的桶内"""
+        histogram = LatencyHistogram(buckets=(0.001, 0.01, 0.1))
+        for _ in range(90):
+            histogram.observe(0.0005)
+        for _ in range(10):
+            histogram.observe(0.05)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertLessEqual(histogram.quantile(0.5), 0.001)
+        self.assertGreater(histogram.quantile(0.99), 0.01)
+        self.assertLessEqual(histogram.quantile(0.99), 0.05)
+        self.assertEqual(LatencyHistogram().quantile(0.5), 0.0)
+
+
+class RuleProfilerTestCase(TestCase):
+    """测试规则性能分析"""
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+        rule_profiler.reset()
+        rule_profiler.enable()
+        self.addCleanup(rule_profiler.disable)
+
+        self.admin = User.objects.create_superuser(
+            username='profileadmin',
+            email='profile@example.com',
+            password='testpassword'
+        )
+        agent = Agent.objects.create(
+            name='分析代理',
+            role=Agent.Role.ASSISTANT,
+            owner=self.admin,
+            status=Agent.Status.ONLINE
+        )
+        self.rule = AgentListeningRule.objects.create(
+            agent=agent,
+            name='分析规则',
+            trigger_type=AgentListeningRule.TriggerType.REGEX,
+            trigger_condition={'pattern': r'错误码(\d+)'},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '收到'}
+        )
+
+    def test_records_evaluations_and_hits(self):
+        """测试记录评估次数、命中率并按触发类型汇总"""
+        RuleEngine.process_batch([
+            {'content': '错误码500'},
+            {'content': '一切正常'},
+        ], dry_run=True)
+
+        report = rule_profiler.report()
+        self.assertEqual(report['rule_count'], 1)
+        item = report['rules'][0]
+        self.assertEqual(item['rule_id'], str(self.rule.id))
+        self.assertEqual(item['evaluations'], 2)
+        self.assertEqual(item['hits'], 1)
+        self.assertEqual(item['hit_ratio'], 0.5)
+        self.assertEqual(report['by_trigger_type']['regex']['evaluations'], 2)
+
+    def test_profile_endpoint_and_admin_view(self):
+        """测试性能分析接口和管理后台页面"""
+        RuleEngine.process_batch([{'content': '错误码404'}], dry_run=True)
+
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        response = client.get('/api/agents/rules/profile/', {'sort': 'p99_ms'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['sort_by'], 'p99_ms')
+        self.assertEqual(response.data['rules'][0]['rule_name'], '分析规则')
+
+        response = client.post('/api/agents/rules/profile/', {'reset': True}, format='json')
+        self.assertEqual(response.data['rule_count'], 0)
+
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:agents_agentlisteningrule_profile'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '规则性能分析')
+
+    def test_profile_endpoint_requires_admin(self):
+        """测试普通用户不能访问性能分析接口"""
+        user = User.objects.create_user(username='plain', email='plain@example.com', password='testpassword')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        self.assertEqual(client.get('/api/agents/rules/profile/').status_code, 403)
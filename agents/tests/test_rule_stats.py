@@ -0,0 +1,115 @@
+from django.test import TestCase
+from django.utils import timezone
+from django.contrib.auth import get_user_model
+
+from agents.models import Agent, AgentListeningRule
+from agents.rule_index import rule_index
+from agents.rule_stats import rule_stats
+from agents.services import RuleEngine
+
+User = get_user_model()
+
+
+class RuleStatsTestCase(TestCase):
+    """测试规则触发统计的进程内记录与批量写回"""
+
+    def setUp(self):
+        """设置测试数据"""
+        rule_index.invalidate()
+        rule_stats.reset()
+
+        self.user = User.objects.create_user(
+            username='statsuser',
+            email='stats@example.com',
+            password='testpassword'
+        )
+        self.agent = Agent.objects.create(
+            name='统计代理',
+            role=Agent.Role.ASSISTANT,
+            owner=self.user,
+            status=Agent.Status.ONLINE
+        )
+        self.rule = AgentListeningRule.objects.create(
+            agent=self.agent,
+            name='统计规则',
+            trigger_type=AgentListeningRule.TriggerType.KEYWORD,
+            trigger_condition={'keywords': ['统计']},
+            response_type=AgentListeningRule.ResponseType.NOTIFICATION,
+            response_content={'notification_text': '收到'},
+            cooldown_period=60
+        )
+        self.message = {'content': '看一下统计', 'group_id': '1'}
+
+    def test_trigger_and_cooldown_without_writes(self):
+        """测试触发和冷却判断不写数据库"""
+        RuleEngine.process_message(self.message)
+
+        with self.assertNumQueries(0):
+            responses = RuleEngine.process_message(self.message)
+        self.assertEqual(responses, [])
+
+        self.rule.refresh_from_db()
+        self.assertEqual(self.rule.trigger_count, 0)
+        self.assertIsNone(self.rule.last_triggered)
+
+    def test_flush_applies_increments(self):
+        """测试批量写回基于数据库当前值累加"""
+        indexed_rule = rule_index.get_rules(self.message)[0].rule
+        rule_stats.record_trigger(indexed_rule)
+        rule_stats.record_trigger(indexed_rule)
+
+        # 模拟其他进程已写回的触发次数
+        AgentListeningRule.objects.filter(id=self.rule.id).update(trigger_count=5)
+
+        self.assertEqual(rule_stats.flush(), 1)
+        self.rule.refresh_from_db()
+        self.assertEqual(self.rule.trigger_count, 7)
+        self.assertEqual(self.rule.last_triggered, indexed_rule.last_triggered)
+
+        # 没有新的触发时不再更新
+        with self.assertNumQueries(0):
+            self.assertEqual(rule_stats.flush(), 0)
+
+    def test_save_keeps_newer_trigger(self):
+        """测试保存规则时不会用旧的最近触发时间重置冷却"""
+        RuleEngine.process_message(self.message)
+        triggered_at = rule_stats.get_last_triggered(self.rule)
+        self.assertIsNotNone(triggered_at)
+
+        # 模拟管理后台用刷新前读取的实例保存规则
+        stale_rule = AgentListeningRule.objects.get(id=self.rule.id)
+        stale_rule.description = '修改描述'
+        stale_rule.save()
+
+        self.assertEqual(RuleEngine.process_message(self.message), [])
+        self.assertEqual(rule_stats.get_last_triggered(stale_rule), triggered_at)
+
+        # 保存没有写入旧的时间，下次刷新写回内存中的时间
+        rule_stats.flush()
+        self.rule.refresh_from_db()
+        self.assertEqual(self.rule.last_triggered, triggered_at)
+
+    def test_stale_save_keeps_flushed_count(self):
+        """测试用旧实例完整保存规则时不覆盖已写回的触发统计，也不额外查询"""
+        stale_rule = AgentListeningRule.objects.get(id=self.rule.id)
+        RuleEngine.process_message(self.message)
+        rule_stats.flush()
+
+        stale_rule.description = '修改描述'
+        with self.assertNumQueries(1):
+            stale_rule.save()
+
+        self.rule.refresh_from_db()
+        self.assertEqual(self.rule.description, '修改描述')
+        self.assertEqual(self.rule.trigger_count, 1)
+        self.assertIsNotNone(self.rule.last_triggered)
+
+    def test_explicit_last_triggered_resets_cooldown(self):
+        """测试显式修改最近触发时间的保存写入数据库并覆盖进程内统计"""
+        RuleEngine.process_message(self.message)
+        self.assertEqual(RuleEngine.process_message(self.message), [])
+
+        self.rule.last_triggered = timezone.now() - timezone.timedelta(seconds=61)
+        self.rule.save()
+
+        self.assertEqual(len(RuleEngine.process_message(self.message)), 1)
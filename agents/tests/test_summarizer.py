@@ -0,0 +1,113 @@
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, SimpleTestCase
+
+from agents.summarizer import SUMMARY_LOCK_STRIPES, ConversationSummarizer, split_sentences, summarize_messages
+from groups.models import Group, GroupMessage
+from messaging.models import Message
+
+User = get_user_model()
+
+
+class SummarizeMessagesTestCase(SimpleTestCase):
+    """测试抽取式摘要"""
+
+    def _messages(self, texts, start=0):
+        return [
+            {'id': str(start + index), 'sender': '张三', 'content': text}
+            for index, text in enumerate(texts)
+        ]
+
+    def test_split_sentences(self):
+        """测试按标点切句并去掉过短的句子"""
+        self.assertEqual(
+            split_sentences('今晚部署支付服务。好的！数据库迁移准备好了吗？'),
+            ['今晚部署支付服务', '数据库迁移准备好了吗']
+        )
+
+    def test_selects_central_sentences_in_order(self):
+        """测试选出反复讨论的话题，去掉重复句子，并按时间顺序输出"""
+        messages = self._messages([
+            '今晚部署支付服务的新版本',
+            '午饭大家想吃什么',
+            '部署支付服务前先执行数据库迁移',
+            '今晚部署支付服务的新版本',
+            '数据库迁移脚本已经审核通过',
+        ])
+        state, summary = summarize_messages({}, messages, max_sentences=2)
+
+        lines = summary.split('\n')
+        self.assertEqual(len(lines), 2)
+        self.assertNotIn('午饭', summary)
+        self.assertEqual(len(set(lines)), 2)
+        self.assertEqual([sentence['seq'] for sentence in state['sentences']], sorted(
+            sentence['seq'] for sentence in state['sentences']
+        ))
+        self.assertTrue(lines[0].startswith('张三: '))
+
+    def test_incremental_update_keeps_previous_summary(self):
+        """测试增量更新只需要新消息，之前的候选句子和词频保留在状态中"""
+        state, _summary = summarize_messages({}, self._messages([
+            '今晚部署支付服务的新版本',
+            '部署支付服务前先执行数据库迁移',
+        ]), max_sentences=3)
+        state, summary = summarize_messages(state, self._messages([
+            '数据库迁移失败了需要马上回滚并通知运维同事',
+        ], start=2), max_sentences=3)
+
+        self.assertEqual(state['seq'], 3)
+        self.assertIn('今晚部署支付服务的新版本', summary)
+        self.assertIn('数据库迁移失败了需要马上回滚并通知运维同事', summary)
+        self.assertEqual(state['terms']['数据库'], 2)
+
+
+    def test_group_locks_bounded(self):
+        """测试群组摘要锁数量固定，同一群组总是使用同一把锁"""
+        summarizer = ConversationSummarizer()
+        locks = {id(summarizer._group_lock(group_id)) for group_id in range(1000)}
+        self.assertLessEqual(len(locks), SUMMARY_LOCK_STRIPES)
+        self.assertIs(summarizer._group_lock(7), summarizer._group_lock('7'))
+
+
+class ConversationSummarizerTestCase(TestCase):
+    """测试群组对话摘要的增量更新"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='summary_user', password='testpassword')
+        self.group = Group.objects.create(name='摘要群组', owner=self.user)
+        self.summarizer = ConversationSummarizer(max_sentences=3)
+
+    def _post(self, text):
+        return GroupMessage.objects.create(group=self.group, sender_user=self.user, content={'text': text})
+
+    def test_only_new_messages_summarized(self):
+        """测试再次总结时只读取水位之后的消息"""
+        self._post('今晚部署支付服务的新版本')
+        Message.objects.create(
+            message_type=Message.MessageType.CHAT,
+            sender_type=Message.SenderType.USER,
+            sender_user=self.user,
+            group=self.group,
+            content={'text': '部署支付服务前先执行数据库迁移'}
+        )
+        summary = self.summarizer.summarize(self.group.id)
+        self.assertEqual(summary.message_count, 2)
+        self.assertIn('summary_user: 今晚部署支付服务的新版本', summary.summary)
+        self.assertIsNotNone(summary.last_message_id)
+
+        last = self._post('数据库迁移失败了需要马上回滚并通知运维同事')
+        with patch('agents.summarizer.summarize_messages', wraps=summarize_messages) as mock_summarize:
+            summary = self.summarizer.summarize(self.group.id)
+            self.assertEqual(
+                [message['id'] for message in mock_summarize.call_args[0][1]],
+                [str(last.id)]
+            )
+
+            # 没有新消息时不重新计算
+            self.summarizer.summarize(self.group.id)
+            self.assertEqual(mock_summarize.call_count, 1)
+
+        self.assertEqual(summary.message_count, 3)
+        self.assertEqual(summary.last_group_message_id, last.id)
+        self.assertIn('需要马上回滚', summary.summary)
@@ -0,0 +1,152 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from agents.handlers import task_handler
+from agents.models import Agent, ResponseDeadLetter
+from agents.task_writer import TaskWriter
+from groups.models import Group
+from task_management.models import Task, TaskAssignment, TaskComment
+
+User = get_user_model()
+
+
+class TaskWriterTestCase(TestCase):
+    """测试规则任务的批量写入"""
+
+    def setUp(self):
+        """创建测试用户、代理和群组，替换广播使用的通道层"""
+        self.user = User.objects.create_user(username='task_writer_user', password='testpassword')
+        self.agent = Agent.objects.create(
+            name='任务代理',
+            role=Agent.Role.ASSISTANT,
+            owner=self.user,
+            description='用于测试的代理',
+            status=Agent.Status.ONLINE,
+            is_public=True
+        )
+        self.group = Group.objects.create(name='任务群组', owner=self.user)
+        self.other_group = Group.objects.create(name='其他群组', owner=self.user)
+
+        self.writer = TaskWriter(flush_interval=60, batch_size=100)
+        self.channel_layer = MagicMock()
+        self.channel_layer.group_send = AsyncMock()
+        for target, value in (
+            ('agents.task_writer.get_channel_layer', MagicMock(return_value=self.channel_layer)),
+            ('agents.task_writer.knowledge_index', None),
+        ):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _response(self, message_id, rule_id='rule-1', title='整理会议纪要'):
+        return {
+            'type': 'task',
+            'agent_id': str(self.agent.id),
+            'rule_id': rule_id,
+            'rule_name': '会议任务规则',
+            'message_id': message_id,
+            'task_title': title,
+            'task_description': '把今天的会议纪要整理后发到群里',
+        }
+
+    def _context(self, group):
+        return {'group_id': str(group.id), 'message_id': None}
+
+    def test_flush_bulk_creates_task_assignment_and_comment(self):
+        """测试写入任务时同时创建代理分配和系统评论"""
+        self.assertTrue(self.writer.submit(self._response('m1'), self._context(self.group)))
+
+        created = self.writer.flush()
+
+        self.assertEqual(len(created), 1)
+        task = Task.objects.get()
+        self.assertEqual(task.source_key, 'm1:rule-1')
+        self.assertEqual(task.group, self.group)
+        self.assertEqual(task.creator, self.user)
+        self.assertEqual(task.metadata['created_by_agent'], str(self.agent.id))
+        assignment = TaskAssignment.objects.get(task=task)
+        self.assertEqual(assignment.assigned_agent, self.agent)
+        self.assertTrue(assignment.is_primary)
+        self.assertTrue(TaskComment.objects.get(task=task).is_system_comment)
+        self.assertEqual(self.writer.pending_count(), 0)
+
+    def test_duplicate_message_creates_one_task(self):
+        """测试同一条消息重复提交或写入后重放时只创建一个任务"""
+        self.assertTrue(self.writer.submit(self._response('m1'), self._context(self.group)))
+        self.assertFalse(self.writer.submit(self._response('m1'), self._context(self.group)))
+        self.assertEqual(len(self.writer.flush()), 1)
+
+        self.writer.submit(self._response('m1'), self._context(self.group))
+        self.assertEqual(self.writer.flush(), [])
+
+        self.assertEqual(Task.objects.count(), 1)
+        self.assertEqual(TaskAssignment.objects.count(), 1)
+        self.assertEqual(TaskComment.objects.count(), 1)
+
+    def test_one_broadcast_per_group(self):
+        """测试每个批次按群组只广播一次任务创建事件"""
+        self.writer.submit(self._response('m1'), self._context(self.group))
+        self.writer.submit(self._response('m2'), self._context(self.group))
+        self.writer.submit(self._response('m3'), self._context(self.other_group))
+
+        self.assertEqual(len(self.writer.flush()), 3)
+
+        self.assertEqual(self.channel_layer.group_send.await_count, 2)
+        events = {call.args[0]: call.args[1] for call in self.channel_layer.group_send.await_args_list}
+        event = events[f"group_{self.group.id}"]
+        self.assertEqual(event['type'], 'agent.task_created')
+        self.assertEqual(event['message']['payload']['task_count'], 2)
+        self.assertEqual(
+            [task['message_id'] for task in event['message']['payload']['tasks']],
+            ['m1', 'm2']
+        )
+        self.assertEqual(events[f"group_{self.other_group.id}"]['message']['payload']['task_count'], 1)
+
+    def test_task_handler_submits_to_writer(self):
+        """测试任务处理函数只提交到写入器，不单独推送消息"""
+        with patch('agents.handlers.task_writer', self.writer):
+            result = asyncio.run(task_handler(self._response('m1'), self._context(self.group)))
+
+        self.assertIsNone(result)
+        self.assertEqual(self.writer.pending_count(), 1)
+        self.assertEqual(Task.objects.count(), 0)
+
+    def test_failed_write_keeps_tasks(self):
+        """测试批量写入失败时任务放回缓冲区，去重仍然有效，下次刷新时写入"""
+        self.writer.submit(self._response('m1'), self._context(self.group))
+        self.writer.submit(self._response('m2'), self._context(self.group))
+
+        with patch.object(self.writer, '_write', side_effect=RuntimeError('database is locked')):
+            self.assertEqual(self.writer.flush(), [])
+
+        self.assertEqual(self.writer.pending_count(), 2)
+        self.assertFalse(self.writer.submit(self._response('m1'), self._context(self.group)))
+        self.assertTrue(self.writer.submit(self._response('m3'), self._context(self.group)))
+
+        self.assertEqual(len(self.writer.flush()), 3)
+        self.assertEqual(
+            list(Task.objects.order_by('source_key').values_list('source_key', flat=True)),
+            ['m1:rule-1', 'm2:rule-1', 'm3:rule-1']
+        )
+        self.assertEqual(ResponseDeadLetter.objects.count(), 0)
+
+    def test_failed_write_overflow_goes_to_dead_letter(self):
+        """测试写入失败后超出缓冲区上限的最早的任务写入死信"""
+        writer = TaskWriter(flush_interval=60, batch_size=100, max_pending=1)
+        writer.submit(self._response('m1'), self._context(self.group))
+        writer.submit(self._response('m2'), self._context(self.group))
+
+        with patch.object(writer, '_write', side_effect=RuntimeError('database is locked')):
+            self.assertEqual(writer.flush(), [])
+
+        self.assertEqual(writer.pending_count(), 1)
+        dead_letter = ResponseDeadLetter.objects.get()
+        self.assertEqual(dead_letter.stage, ResponseDeadLetter.Stage.HANDLER)
+        self.assertEqual(dead_letter.response['message_id'], 'm1')
+        self.assertEqual(dead_letter.context['group_id'], str(self.group.id))
+        self.assertIn('database is locked', dead_letter.last_error)
+
+        self.assertEqual([task.source_key for task in writer.flush()], ['m2:rule-1'])
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from .views import AgentViewSet, AgentSkillViewSet, AgentInteractionViewSet, AgentListeningRuleViewSet, rule_management_view, agent_management_view, agent_demo
+from .views import AgentViewSet, AgentSkillViewSet, AgentInteractionViewSet, AgentListeningRuleViewSet, ResponseDeadLetterViewSet, rule_management_view, agent_management_view, agent_demo, processor_metrics
 
 # 创建路由器
 router = DefaultRouter()
@@ -11,12 +11,14 @@ router.register(r'agents', AgentViewSet, basename='agent')
 router.register(r'skills', AgentSkillViewSet, basename='skill')
 router.register(r'interactions', AgentInteractionViewSet, basename='interaction')
 router.register(r'rules', AgentListeningRuleViewSet, basename='rule')
+router.register(r'dead-letters', ResponseDeadLetterViewSet, basename='dead-letter')
 
 # 设置应用命名空间
 app_name = 'agents'
 
 # API路由
 api_urlpatterns = [
+    path('processor/metrics/', processor_metrics, name='processor_metrics'),
     path('', include(router.urls)),
 ]
 
@@ -6,6 +6,7 @@ import openai
 from django.conf import settings
 from chatbot_platform.error_utils import ErrorUtils
 from chatbot_platform.error_codes import AgentErrorCodes, RuleErrorCodes
+from ..matchers import compile_pattern
 
 logger = logging.getLogger(__name__)
 
@@ -135,7 +136,7 @@ def test_rule_match(rule, message_data):
         if 'regex_pattern' in conditions and conditions['regex_pattern']:
             pattern = conditions['regex_pattern']
             try:
-                regex = re.compile(pattern, re.IGNORECASE)
+                regex = compile_pattern(pattern, re.IGNORECASE)
                 regex_match = bool(regex.search(content))
                 match_details['regex'] = {
                     'pattern': pattern,
@@ -25,12 +25,13 @@ class TopicAnalyzer:
         except Exception as e:
             logger.error(f"加载词向量模型失败: {str(e)}")
     
-    def get_text_vector(self, text: str) -> np.ndarray:
+    def get_text_vector(self, text: str, words: Optional[List[str]] = None) -> np.ndarray:
         """
         获取文本的向量表示
         
         Args:
             text: 输入文本
+            words: 已有的分词结果，为None时对text分词
             
         Returns:
             文本的向量表示
@@ -38,7 +39,8 @@ class TopicAnalyzer:
         if not self.word_vectors:
             return np.zeros(300)  # 默认向量维度
             
-        words = jieba.lcut(text)
+        if words is None:
+            words = jieba.lcut(text)
         vectors = []
         
         for word in words:
@@ -54,6 +56,39 @@ class TopicAnalyzer:
             
         return np.mean(vectors, axis=0)
     
+    def get_word_vector_sum(self, text: str, words: Optional[List[str]] = None):
+        """
+        获取文本中词向量之和与有词向量的词数
+
+        多段文本的词向量之和相加、再除以总词数，等于对拼接文本调用 get_text_vector 的结果
+        
+        Args:
+            text: 输入文本
+            words: 已有的分词结果，为None时对text分词
+            
+        Returns:
+            (词向量之和, 词数)
+        """
+        if not self.word_vectors:
+            return np.zeros(300), 0
+            
+        if words is None:
+            words = jieba.lcut(text)
+        vectors = []
+        
+        for word in words:
+            try:
+                if word in self.word_vectors:
+                    vectors.append(self.word_vectors[word])
+            except Exception as e:
+                logger.debug(f"获取词向量失败: {word}")
+                continue
+                
+        if not vectors:
+            return np.zeros(self.word_vectors.vector_size), 0
+            
+        return np.sum(vectors, axis=0), len(vectors)
+    
     def calculate_similarity(self, text1: str, text2: str) -> float:
         """
         计算两段文本的主题相似度
@@ -65,10 +100,21 @@ class TopicAnalyzer:
         Returns:
             相似度得分 (0.0 到 1.0)
         """
-        try:
-            vec1 = self.get_text_vector(text1)
-            vec2 = self.get_text_vector(text2)
+        return self.vector_similarity(self.get_text_vector(text1), self.get_text_vector(text2))
+    
+    @staticmethod
+    def vector_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
+        """
+        计算两个文本向量的余弦相似度
+        
+        Args:
+            vec1: 第一个文本向量
+            vec2: 第二个文本向量
             
+        Returns:
+            相似度得分 (0.0 到 1.0)
+        """
+        try:
             # 计算余弦相似度
             similarity = np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
             return float(max(0.0, min(1.0, similarity)))  # 确保结果在[0,1]范围内
@@ -91,4 +137,43 @@ def analyze_topic_similarity(text1: str, text2: str) -> float:
     Returns:
         相似度得分 (0.0 到 1.0)
     """
-    return _analyzer.calculate_similarity(text1, text2) 
\ No newline at end of file
+    return _analyzer.calculate_similarity(text1, text2) 
+
+def get_text_vector(text: str, words: Optional[List[str]] = None) -> np.ndarray:
+    """
+    获取文本的主题向量
+    
+    Args:
+        text: 输入文本
+        words: 已有的分词结果，为None时对text分词
+        
+    Returns:
+        文本的向量表示
+    """
+    return _analyzer.get_text_vector(text, words)
+
+def get_word_vector_sum(text: str, words: Optional[List[str]] = None):
+    """
+    获取文本中词向量之和与有词向量的词数
+    
+    Args:
+        text: 输入文本
+        words: 已有的分词结果，为None时对text分词
+        
+    Returns:
+        (词向量之和, 词数)
+    """
+    return _analyzer.get_word_vector_sum(text, words)
+
+def vector_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
+    """
+    计算两个主题向量的相似度
+    
+    Args:
+        vec1: 第一个文本向量
+        vec2: 第二个文本向量
+        
+    Returns:
+        相似度得分 (0.0 到 1.0)
+    """
+    return TopicAnalyzer.vector_similarity(vec1, vec2)
@@ -1,6 +1,6 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from rest_framework import viewsets, permissions, status, filters
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext_lazy as _
@@ -15,14 +15,18 @@ from chatbot_platform.error_utils import ErrorUtils
 from chatbot_platform.error_codes import AgentErrorCodes
 from .utils import test_rule_match, apply_rule_transformations
 
-from .models import Agent, AgentSkill, AgentInteraction, AgentListeningRule
+from .models import Agent, AgentSkill, AgentInteraction, AgentListeningRule, ResponseDeadLetter
 from .serializers import (
     AgentSerializer, AgentCreateSerializer, AgentSkillSerializer,
     AgentInteractionSerializer, AgentListeningRuleSerializer, 
-    AgentListeningRuleCreateSerializer
+    AgentListeningRuleCreateSerializer, ResponseDeadLetterSerializer,
+    RuleBatchProcessSerializer
 )
 from .permissions import IsAgentOwnerOrAdmin, IsPublicAgentOrOwnerOrAdmin
 from .services import RuleEngine
+from .context_store import GroupContextStore
+from .rule_profiler import rule_profiler
+from .async_processor import message_processor
 
 logger = logging.getLogger('agents')
 
@@ -683,6 +687,172 @@ class AgentListeningRuleViewSet(viewsets.ModelViewSet):
             'responses': responses,
             'response_count': len(responses)
         })
+    
+    @action(detail=False, methods=['get', 'post'], permission_classes=[permissions.IsAdminUser])
+    def profile(self, request):
+        """
+        规则性能分析报告（仅管理员）
+        GET /api/agents/rules/profile/
+        参数:
+          - sort: 排序字段（total_ms, mean_ms, p99_ms, max_ms, evaluations, errors, hit_ratio），默认total_ms
+          - limit: 最多返回的规则数量（可选）
+        POST /api/agents/rules/profile/
+        参数:
+          - enabled: 开启或关闭性能分析（可选）
+          - reset: 是否清空已有统计（可选）
+        """
+        if request.method == 'POST':
+            enabled = request.data.get('enabled')
+            if enabled is not None:
+                if enabled in (True, 'true'):
+                    rule_profiler.enable()
+                else:
+                    rule_profiler.disable()
+            if request.data.get('reset') in (True, 'true'):
+                rule_profiler.reset()
+        
+        try:
+            limit = int(request.query_params.get('limit', 0)) or None
+        except ValueError:
+            return Response(
+                {'error': _('limit必须是整数')},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return Response(rule_profiler.report(
+            sort_by=request.query_params.get('sort', 'total_ms'),
+            limit=limit
+        ))
+    
+    @action(detail=False, methods=['post'])
+    def process_batch(self, request):
+        """
+        批量处理消息，获取每条消息的规则响应
+        POST /api/agent-rules/process_batch/
+        参数:
+          - messages: 消息列表，每条消息是文本或消息对象
+          - context: 所有消息共享的上下文信息（可选）
+          - dry_run: 是否试运行，试运行不记录触发统计和交互（可选，默认true；
+            非试运行需要管理员权限）
+        普通用户只评估自己的代理的规则，管理员评估所有规则
+        """
+        serializer = RuleBatchProcessSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        messages = serializer.validated_data['messages']
+        context = serializer.validated_data['context']
+        dry_run = serializer.validated_data['dry_run']
+        
+        if not dry_run and not request.user.is_staff:
+            return Response(
+                {'error': _('只有管理员可以执行非试运行的批量处理')},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        # 普通用户不能看到其他用户的代理的回复模板和动作参数
+        agent_ids = None
+        if not request.user.is_staff:
+            agent_ids = {
+                str(agent_id)
+                for agent_id in Agent.objects.filter(owner=request.user).values_list('id', flat=True)
+            }
+        
+        # 使用规则引擎批量处理消息，上下文窗口与实时消息隔离
+        results = RuleEngine.process_batch(
+            messages, context, dry_run=dry_run, context_store=GroupContextStore(),
+            agent_ids=agent_ids
+        )
+        
+        return Response({
+            'results': [
+                {
+                    'message': message,
+                    'responses': responses,
+                    'response_count': len(responses)
+                }
+                for message, responses in zip(messages, results)
+            ],
+            'message_count': len(messages),
+            'response_count': sum(len(responses) for responses in results),
+            'dry_run': dry_run
+        })
+
+class ResponseDeadLetterViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    响应死信的API视图集（仅管理员）
+    提供死信的列表、详情、重放和清理功能
+    """
+    queryset = ResponseDeadLetter.objects.all()
+    serializer_class = ResponseDeadLetterSerializer
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [filters.OrderingFilter]
+    ordering_fields = ['created_at', 'attempts']
+    ordering = ['-created_at']
+
+    def get_queryset(self):
+        """
+        根据参数过滤查询集
+        参数:
+          - stage: 发送阶段（channel、handler）
+          - response_type: 响应类型
+          - replayed: 是否已重放（true、false）
+        """
+        queryset = super().get_queryset()
+        
+        stage = self.request.query_params.get('stage')
+        if stage:
+            queryset = queryset.filter(stage=stage)
+            
+        response_type = self.request.query_params.get('response_type')
+        if response_type:
+            queryset = queryset.filter(response_type=response_type)
+            
+        replayed = self.request.query_params.get('replayed')
+        if replayed is not None:
+            queryset = queryset.filter(replayed_at__isnull=replayed != 'true')
+            
+        return queryset
+
+    @action(detail=True, methods=['post'])
+    def replay(self, request, pk=None):
+        """
+        重新发送一条死信
+        POST /api/agents/dead-letters/{id}/replay/
+        """
+        dead_letter = self.get_object()
+        replayed = message_processor.replay_dead_letter(dead_letter)
+        
+        if replayed:
+            logger.info(f"管理员 {request.user.username} 重放了响应死信 {dead_letter.id}")
+        return Response(
+            self.get_serializer(dead_letter).data,
+            status=status.HTTP_200_OK if replayed else status.HTTP_502_BAD_GATEWAY
+        )
+
+    @action(detail=False, methods=['post'])
+    def purge(self, request):
+        """
+        清理死信
+        POST /api/agents/dead-letters/purge/
+        参数:
+          - ids: 要删除的死信ID列表（可选）
+          - replayed_only: 是否只删除已重放的死信（可选，默认false）
+        未提供ids时按查询参数过滤后删除
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        ids = request.data.get('ids')
+        if ids is not None:
+            if not isinstance(ids, list):
+                return Response(
+                    {'error': _('ids必须是列表')},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            queryset = queryset.filter(id__in=ids)
+        if request.data.get('replayed_only') in (True, 'true'):
+            queryset = queryset.filter(replayed_at__isnull=False)
+            
+        deleted, _unused = queryset.delete()
+        logger.info(f"管理员 {request.user.username} 清理了 {deleted} 条响应死信")
+        return Response({'deleted': deleted})
 
 # 添加一个假设的验证函数 (实际实现应根据具体需求)
 def validate_agent_rules(agent):
@@ -700,6 +870,23 @@ def validate_agent_rules(agent):
         logger.error(f"规则验证过程出错: {str(e)}", exc_info=True)
         return {'valid': False, 'message': f'验证过程出错: {str(e)}'}
 
+@api_view(['GET', 'POST'])
+@permission_classes([permissions.IsAdminUser])
+def processor_metrics(request):
+    """
+    异步消息处理器运行指标（仅管理员）
+    GET /api/agents/processor/metrics/
+    返回队列长度、各通道最早消息的等待时间、排队耗时、处理延迟、规则耗时以及各响应类型的发送耗时和失败率
+    POST /api/agents/processor/metrics/
+    参数:
+      - reset: 是否清空延迟统计（可选）
+    """
+    if request.method == 'POST' and request.data.get('reset') in (True, 'true'):
+        message_processor.metrics.reset()
+    
+    return Response(message_processor.snapshot())
+
+
 def rule_management_view(request):
     """代理规则管理页面"""
     if not request.user.is_authenticated:
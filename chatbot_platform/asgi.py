@@ -14,6 +14,8 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_platform.settings')
+# 声明为服务进程：启动异步消息处理器并接管持久化日志中未完成的消息（见 agents.apps）
+os.environ.setdefault('AGENTS_SERVING_PROCESS', '1')
 django.setup()
 
 # 导入messaging应用中定义的WebSocket路由
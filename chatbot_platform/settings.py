@@ -332,3 +332,31 @@ AI_CONFIG = {
 
 # 在测试环境中，是否使用模拟AI响应
 USE_MOCK_AI_IN_TEST = True
+
+# 代理监听规则引擎配置
+RULE_ENGINE_CONFIG = {
+    'RULE_INDEX_MAX_AGE': 300,  # 进程内规则索引整体重建间隔（秒），0表示不定期重建
+    'STATS_FLUSH_INTERVAL': 5,  # 规则触发统计写回数据库的间隔（秒）
+    'MAX_BATCH_SIZE': 1000,  # 批量处理接口单次最多处理的消息数量
+    'PROFILE_RULES': False,  # 是否记录规则级性能数据（匹配耗时、命中率、错误次数）
+    'CONTEXT_WINDOW_SIZE': 50,  # 每个群组在内存中保留的最近消息数量（上下文感知规则使用）
+    'CONTEXT_MAX_GROUPS': 1000,  # 最多保留上下文窗口的群组数量
+    'PROCESSOR_WORKERS': 4,  # 异步消息处理器的工作线程数量（每个线程负责一个按群组哈希的分片）
+    'PROCESSOR_QUEUE_SIZE': 1000,  # 异步消息处理器每个分片每个优先级通道的容量
+    'PROCESSOR_LANE_WEIGHTS': {'mention': 8, 'group': 3, 'bulk': 1},  # 各优先级通道的调度权重
+    'PROCESSOR_ENQUEUE_TIMEOUT': 0.5,  # 队列已满时入队的等待时间（秒），超时后丢弃消息
+    'PROCESSOR_COALESCE_WINDOW_MS': 0,  # 同一群组突发消息的合并窗口（毫秒），上下文感知和所有消息规则对窗口内的消息只评估一次，0表示不合并
+    'PROCESSOR_COALESCE_MAX': 50,  # 合并评估时一组消息的最大数量
+    'PROCESSOR_JOURNAL_PATH': str(BASE_DIR / 'processor_journal.sqlite3'),  # 异步消息处理器持久化日志文件，为空表示不记录
+    'PROCESSOR_JOURNAL_LEASE': 30,  # 处理器日志持有者的租约（秒），进程超过该时间未续约时其未完成的消息可由其他进程接管重放
+    'RESPONSE_RETRY_ATTEMPTS': 5,  # 响应发送失败时的最大尝试次数，用尽后写入死信（ResponseDeadLetter）
+    'RESPONSE_RETRY_BASE_DELAY': 0.5,  # 第一次重试前的等待时间（秒），之后每次翻倍并加入随机抖动
+    'RESPONSE_RETRY_MAX_DELAY': 30,  # 两次重试之间的最长等待时间（秒）
+    'PROCESS_POOL_WORKERS': 0,  # 规则匹配进程池的工作进程数量，0表示在当前进程中匹配
+    'SUMMARY_MAX_SENTENCES': 5,  # 对话总结动作输出的句子数量
+    'SUMMARY_HISTORY_LIMIT': 500,  # 对话总结每次最多读取的消息数量（第一次总结时读取最近的消息）
+    'KNOWLEDGE_INDEX_PATH': str(BASE_DIR / 'knowledge_index.sqlite3'),  # 知识库搜索使用的全文索引文件，为空表示关闭
+    'TASK_WRITER_FLUSH_INTERVAL': 1.0,  # 规则创建的任务批量写入的间隔（秒）
+    'TASK_WRITER_BATCH_SIZE': 200,  # 规则任务缓冲区达到该数量时立即写入
+    'TASK_WRITER_MAX_PENDING': 10000,  # 写入失败时规则任务缓冲区最多保留的数量，超出的最早的任务写入死信
+}
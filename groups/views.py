@@ -22,6 +22,7 @@ from .permissions import (
     IsGroupOwnerOrAdmin, IsGroupMember, IsMessageSender, CanJoinPublicGroup
 )
 from agents.models import Agent
+from agents.context_store import context_store
 
 logger = logging.getLogger(__name__)
 
@@ -396,6 +397,9 @@ class GroupViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             message = serializer.save()
             
+            # 记入群组上下文窗口，供上下文感知规则使用
+            context_store.record_stored_message(message)
+            
             # 检查是否需要触发代理响应
             self._trigger_agent_responses(message)
             
@@ -6,6 +6,7 @@ from django.utils import timezone
 from datetime import datetime
 import logging
 import asyncio
+import queue
 from django.contrib.auth import get_user_model
 
 from .validators import validate_message, create_message
@@ -16,8 +17,13 @@ from agents.models import Agent  # 导入Agent模型
 from chatbot_platform.error_utils import format_websocket_error  # 导入错误处理工具
 from chatbot_platform.error_codes import MessageErrorCodes  # 导入消息错误代码
 from agents.async_processor import message_processor  # 导入异步消息处理器
+from agents.context_store import context_store  # 导入群组上下文窗口
 
 logger = logging.getLogger(__name__)
+
+# 等待异步消息处理器返回代理响应的最长时间（秒）
+AGENT_RESPONSE_TIMEOUT = 30
+
 User = get_user_model()
 
 class MessageConsumer(AsyncWebsocketConsumer):
@@ -25,6 +31,23 @@ class MessageConsumer(AsyncWebsocketConsumer):
     WebSocket消费者，处理实时消息
     """
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 后台任务的引用，事件循环只保存弱引用，未保存引用的任务可能在完成前被回收
+        self._background_tasks = set()
+    
+    def _spawn(self, coroutine):
+        """
+        在后台运行协程，任务结束后释放引用
+        
+        参数:
+        - coroutine: 要运行的协程
+        """
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
     async def connect(self):
         """
         处理WebSocket连接请求
@@ -370,9 +393,12 @@ class MessageConsumer(AsyncWebsocketConsumer):
             'sender': str(message.sender_user.id) if message.sender_user else None,
             'group_id': str(message.group.id) if message.group else None,
             'mentions': [str(agent.id) for agent in message.mentioned_agents.all()],
-            'timestamp': message.timestamp.isoformat()
+            'timestamp': message.created_at.isoformat()
         }
         
+        # 记入群组上下文窗口，规则引擎处理时按消息ID去重
+        context_store.record(message_for_rule['group_id'], message_for_rule)
+        
         # 3. 定义上下文
         context = {
             'group_id': str(message.group.id) if message.group else None,
@@ -382,12 +408,8 @@ class MessageConsumer(AsyncWebsocketConsumer):
             'channel_layer': self.channel_layer
         }
         
-        # 4. 使用异步消息处理器处理消息
-        await database_sync_to_async(message_processor.add_message)(
-            message=message_for_rule, 
-            context=context, 
-            callback=self.handle_agent_responses_callback
-        )
+        # 4. 使用异步消息处理器处理消息（响应由处理器发送，这里不阻塞后续消息的接收）
+        self._spawn(self.handle_agent_responses(message_for_rule, context))
         
         # 5. 检查是否提及了代理（旧的处理方式，保留做后向兼容）
         if not message.mentioned_agents.exists():
@@ -397,16 +419,30 @@ class MessageConsumer(AsyncWebsocketConsumer):
         mentioned_agents = message.mentioned_agents.all()
         for agent in mentioned_agents:
             # 异步处理，避免阻塞WebSocket
-            asyncio.create_task(self.generate_agent_response(message, agent))
+            self._spawn(self.generate_agent_response(message, agent))
 
-    @database_sync_to_async
-    def handle_agent_responses_callback(self, responses):
+    async def handle_agent_responses(self, message, context):
         """
-        处理代理响应的回调函数
+        提交消息到异步处理器，并在当前事件循环中等待代理响应
         
         参数:
-        - responses: 规则引擎生成的响应列表
+        - message: 规则引擎可处理的消息
+        - context: 上下文信息
         """
+        try:
+            responses = await message_processor.process(
+                message, context, timeout=AGENT_RESPONSE_TIMEOUT
+            )
+        except queue.Full:
+            logger.warning(f"异步消息处理队列已满，消息 {context.get('message_id')} 未进行规则处理")
+            return
+        except asyncio.TimeoutError:
+            logger.warning(f"等待消息 {context.get('message_id')} 的代理响应超时")
+            return
+        except Exception as e:
+            logger.error(f"处理代理响应时出错: {str(e)}", exc_info=True)
+            return
+        
         if not responses:
             return
         
@@ -672,6 +708,34 @@ class MessageConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"处理代理消息时发生错误: {str(e)}", exc_info=True)
             
+    async def agent_batch(self, event):
+        """
+        处理代理响应批次事件（同一条消息触发的所有代理响应）
+        
+        参数:
+        - event: 事件数据，包含源消息ID和代理消息列表
+        """
+        try:
+            messages = event.get('messages', [])
+            
+            # 记录代理响应批次
+            logger.info(
+                f"接收到 {len(messages)} 条代理响应，源消息: {event.get('message_id')}",
+                extra={'data': {'message_id': event.get('message_id')}}
+            )
+            
+            # 一帧发送所有代理响应到WebSocket客户端
+            await self.send(text_data=json.dumps({
+                'message_type': 'agent_batch',
+                'payload': {
+                    'message_id': event.get('message_id'),
+                    'messages': messages
+                }
+            }))
+            
+        except Exception as e:
+            logger.error(f"处理代理响应批次时发生错误: {str(e)}", exc_info=True)
+            
     async def agent_notification(self, event):
         """
         处理代理通知事件
@@ -706,7 +770,7 @@ class MessageConsumer(AsyncWebsocketConsumer):
             
             # 记录任务创建消息
             logger.info(
-                f"接收到任务创建: {message.get('payload', {}).get('task_title', '')}",
+                f"接收到任务创建: {message.get('payload', {}).get('task_count', 1)} 个任务",
                 extra={'data': {'message': message}}
             )
             
@@ -14,6 +14,7 @@ from .models import Message, MessageDeliveryStatus
 from .serializers import MessageSerializer, MessageDeliveryStatusSerializer
 from .validators import validate_message, create_message
 from groups.permissions import IsGroupMember
+from agents.context_store import context_store
 from chatbot_platform.error_utils import ErrorUtils
 from chatbot_platform.error_codes import MessageErrorCodes, GroupErrorCodes
 
@@ -157,6 +158,9 @@ class MessageViewSet(viewsets.ModelViewSet):
             # 保存到数据库
             message = Message.from_json_message(message_data)
             
+            # 记入群组上下文窗口，供上下文感知规则使用
+            context_store.record_stored_message(message)
+            
             # 创建消息传递状态记录（标记为已送达，但未读）
             for member in group.get_human_members():
                 if member.user.id != user.id:  # 不给发送者自己创建记录
@@ -242,6 +242,11 @@ class MessageWebSocket {
                 this._trigger('message', { data });
                 break;
                 
+            case "agent_batch":
+                // 同一条消息触发的所有代理响应合并在一帧中
+                data.payload.messages.forEach(message => this._handleIncomingMessage(message));
+                break;
+                
             case "typing":
                 this._trigger('typing', { data });
                 break;
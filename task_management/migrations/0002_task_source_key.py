@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_management', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='source_key',
+            field=models.CharField(blank=True, help_text='由代理规则创建的任务为"消息ID:规则ID"，用于避免同一条消息重复创建任务', max_length=150, null=True, unique=True, verbose_name='来源标识'),
+        ),
+    ]
@@ -104,6 +104,14 @@ class Task(models.Model):
     is_recurring = models.BooleanField(_('是否重复任务'), default=False)
     recurrence_pattern = models.JSONField(_('重复模式'), null=True, blank=True)
     metadata = models.JSONField(_('元数据'), default=dict, blank=True)
+    source_key = models.CharField(
+        _('来源标识'),
+        max_length=150,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text=_('由代理规则创建的任务为"消息ID:规则ID"，用于避免同一条消息重复创建任务')
+    )
     
     class Meta:
         verbose_name = _('任务')